@@ -7,6 +7,7 @@ import os
 import math
 import glob
 import re
+import struct
 import pygame
 import vectors
 from common import *
@@ -33,19 +34,73 @@ def blit_alpha(target, source, location, opacity):
     temp.set_alpha(opacity)        
     target.blit(temp, location)
 
+_png_sizes = {}
+
+def get_png_size(filename):
+    """
+    Reads the size of a PNG image from its header, without loading it.
+    """
+    size = _png_sizes.get(filename, None)
+    if size is None:
+        with open(filename, 'rb') as f:
+            header = f.read(24)
+        if header[:8] != b'\x89PNG\r\n\x1a\n' or header[12:16] != b'IHDR':
+            raise ValueError("'{}' is not a PNG image".format(filename))
+        size = _png_sizes[filename] = struct.unpack('>II', header[16:24])
+    return size
+
 # See: https://www.pygame.org/wiki/Spritesheet
 class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
     COLLISION_HEIGHT = 5.0
-
-    def __init__(self, start_pos_x, start_pos_y, spritesheet_filename, id=None):
-        spritesheet = pygame.image.load(spritesheet_filename).convert()
-
+    # the Crowd moving the avatar (see crowd.AvatarView), None if it moves
+    # by itself
+    crowd = None
+    # moves skip the animation, the height and the sprites, see refine and
+    # scheduler.SimulationScheduler
+    coarse = False
+    # the last moves were coarse
+    unrefined = False
+
+    def __init__(self, start_pos_x, start_pos_y, spritesheet_filename, id=None, headless=False):
+        """
+        Headless avatars (for simulation only) have no images, only the size
+        of the sprite sheet frames is read.
+        """
         self.pos_x = start_pos_x
         self.pos_y = start_pos_y
         self.layer = 1
         self.id = id
 
-        self.images = {}
+        self.dir_id = DIRID_SOUTH
+        self.move_id = MOVEID_STAND
+        self.distance = 0
+
+        self.sprite_layers = set()
+        self.tile_x = None
+        self.tile_y = None
+
+        if headless:
+            self.images = None
+            width, height = get_png_size(spritesheet_filename)
+            image = None
+            rect = pygame.Rect(0, 0, width // 3, height // 4)
+        else:
+            self.images = self._load_images(spritesheet_filename)
+            image = self.images[self.move_id | self.dir_id]
+            rect = image.get_rect()
+        rect.midbottom = (start_pos_x, start_pos_y)
+
+        super().__init__(image, rect)
+
+        # simulated state (pos_x, pos_y, z, layer) after the last and the
+        # previous tick, the rendered position is between them
+        self.state = (self.pos_x, self.pos_y, self.z, self.layer)
+        self.prev_state = self.state
+
+    @staticmethod
+    def _load_images(spritesheet_filename):
+        spritesheet = pygame.image.load(spritesheet_filename).convert()
+        images = {}
         w = spritesheet.get_width() / 3
         h = spritesheet.get_height() / 4
         for dir_id, y in [
@@ -62,21 +117,32 @@ class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
                 rect = pygame.Rect((x, y, w, h))
                 image = pygame.Surface(rect.size, pygame.SRCALPHA, 32).convert_alpha()
                 image.blit(spritesheet, (0, 0), rect)
-                self.images[move | dir_id] = image
-            self.images[MOVEID_CLEG | dir_id] = self.images[MOVEID_STAND | dir_id]
+                images[move | dir_id] = image
+            images[MOVEID_CLEG | dir_id] = images[MOVEID_STAND | dir_id]
+        return images
 
-        self.dir_id = DIRID_SOUTH
-        self.move_id = MOVEID_STAND
-        self.distance = 0
-        image = self.images[self.move_id | self.dir_id]
-        rect = image.get_rect()
-        rect.midbottom = (start_pos_x, start_pos_y)
+    def begin_tick(self):
+        self.prev_state = self.state
 
-        self.sprite_layers = set()
-        self.tile_x = None
-        self.tile_y = None
+    def end_tick(self):
+        self.state = (self.pos_x, self.pos_y, self.z, self.layer)
 
-        super().__init__(image, rect)
+    def interpolate(self, alpha):
+        """
+        Places the sprite between the states of the previous and the last tick
+        for rendering, alpha 0.0 is the previous one, 1.0 the last one. Only
+        the rect and z are changed, the next tick sets them again.
+        """
+        prev_pos_x, prev_pos_y, prev_z, prev_layer = self.prev_state
+        pos_x, pos_y, z, layer = self.state
+        if prev_layer != layer:
+            # no interpolation between layer levels
+            alpha = 1.0
+        self.rect.midbottom = (prev_pos_x + (pos_x - prev_pos_x) * alpha,
+                               prev_pos_y + (pos_y - prev_pos_y) * alpha)
+        self.z = prev_z + (z - prev_z) * alpha
+        for sprite_layer in self.sprite_layers:
+            sprite_layer.update_sprite(self)
 
     def add_to_sprite_layer(self, sprite_layer):
         if sprite_layer not in self.sprite_layers:
@@ -99,21 +165,19 @@ class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
         self.sprite_layers.clear()
 
     def adjust_position(self, world):
-        metadata_layer = world.get_metadata_layer(self.layer).sprite_layer
-        pos_x, pos_y, tile_x, tile_y, tile_avg_height, tile_x_slope, tile_y_slope, sprite, tiles = self.get_map_pos_height_info(world, metadata_layer)
-        if not tile_avg_height is None:
-            h_avg = metadata_layer.tileheight * tile_avg_height
-            h_dx = metadata_layer.tileheight * tile_x_slope
-            h_dy = metadata_layer.tileheight * tile_y_slope
-            rel_x = (pos_x - tile_x * metadata_layer.tilewidth) / metadata_layer.tilewidth - 0.5
-            rel_y = (pos_y - tile_y * metadata_layer.tileheight) / metadata_layer.tileheight - 0.5
-            self.z = h_avg + h_dx * rel_x + h_dy * rel_y;
-            #print("Avatar sprite '{}'; z={} ({} + {} * {} + {} * {})".format(self.id, self.z, h_avg, h_dx, rel_x, h_dy, rel_y))
-        else:
-            self.z = 0
+        pos_x, pos_y = self.get_map_pos()
+        self.z = world.sample_height(pos_x, pos_y, self.layer)
+        #print("Avatar sprite '{}'; z={}".format(self.id, self.z))
 
     def execute_move(self, world, delta_time, step_x, step_y):
-        self.distance += math.sqrt(step_x**2 + step_y**2)
+        if self.coarse:
+            self.pos_x += step_x
+            self.pos_y += step_y
+            self.unrefined = True
+            self.update_tile(world)
+            return
+
+        self.distance += math.sqrt(step_x * step_x + step_y * step_y)
         self.move_id = int(self.distance / 10.) % NUM_MOVES
         if step_x == 0 and step_y == 0:
             dir_id = self.dir_id
@@ -130,18 +194,39 @@ class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
             if step_y >= 0: dir_id = DIRID_SOUTH
             else:           dir_id = DIRID_NORTH
 
-        midbottom = self.rect.midbottom
-        image = self.images[self.move_id | dir_id]
-        rect = image.get_rect()
-        rect.midbottom = midbottom
-        self.image = image
-        self.rect = rect
+        if self.images:
+            midbottom = self.rect.midbottom
+            image = self.images[self.move_id | dir_id]
+            rect = image.get_rect()
+            rect.midbottom = midbottom
+            self.image = image
+            self.rect = rect
 
         self.pos_x += step_x
         self.pos_y += step_y
         self.rect.midbottom = (self.pos_x, self.pos_y)
+        for sprite_layer in self.sprite_layers:
+            sprite_layer.update_sprite(self)
 
         self.dir_id = dir_id
+        self.settle(world)
+
+    def refine(self, world):
+        """
+        Catches up with the coarse moves (see coarse): places the sprite and
+        samples the height at the position, going up or down a level.
+        """
+        self.unrefined = False
+        self.rect.midbottom = (self.pos_x, self.pos_y)
+        for sprite_layer in self.sprite_layers:
+            sprite_layer.update_sprite(self)
+        self.settle(world)
+
+    def settle(self, world):
+        """
+        Samples the height at the position, goes up or down a level if it is
+        beyond the level, and updates the tile of the avatar.
+        """
         self.adjust_position(world)
 
         if self.z >= world.VPIXELS_PER_LAYER:
@@ -154,21 +239,55 @@ class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
             self.move_to_layer_level(world, self.layer - 1)
             self.pos_y += world.VPIXELS_PER_LAYER
             self.adjust_position(world)
+        self.update_tile(world)
 
+    def set_state(self, world, pos_x, pos_y, z, layer, dir_id, move_id, distance):
+        """
+        Puts the avatar into a state of a snapshot (see World.restore), with
+        its sprite and its tile but without collisions, height sampling or
+        trigger events. There is no interpolation from the previous state.
+        """
+        if layer != self.layer:
+            self.move_to_layer_level(world, layer)
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+        self.z = z
+        self.dir_id, self.move_id, self.distance = dir_id, move_id, distance
+        self.unrefined = False
+        if self.images:
+            self.image = self.images[move_id | dir_id]
+            self.rect = self.image.get_rect()
+        self.rect.midbottom = (pos_x, pos_y)
+        for sprite_layer in self.sprite_layers:
+            sprite_layer.update_sprite(self)
+        self.state = self.prev_state = (pos_x, pos_y, z, layer)
+        metadata_sprite_layer = world.get_metadata_layer(layer).sprite_layer
+        self.tile_x = int((pos_x) // metadata_sprite_layer.tilewidth)
+        self.tile_y = int((pos_y) // metadata_sprite_layer.tileheight)
+        world.update_avatar_position(self)
+
+    def update_tile(self, world):
         metadata_sprite_layer = world.get_metadata_layer(self.layer).sprite_layer
         self.tile_x = int((self.pos_x) // metadata_sprite_layer.tilewidth)
         self.tile_y = int((self.pos_y) // metadata_sprite_layer.tileheight)
+        world.update_avatar_position(self)
+        world.update_avatar_triggers(self)
 
     def move_to_layer_level(self, world, new_layer_level):
         self.remove_from_all_sprite_layers()
         self.layer = new_layer_level
         sprite_layer = world.get_avatar_layer(self.layer).sprite_layer
         self.add_to_sprite_layer(sprite_layer)
+        world.update_avatar_position(self)
 
     def check_collision(self, world, hero_pos_x, hero_pos_y, step_x, step_y, metadata_sprite_layer):
         """
         Checks collision of the hero against the world. Its not the best way to
-        handle collision detection but for this demo it is good enough.
+        handle collision detection but for this demo it is good enough. The
+        tiles are checked in the collision grid of the level of the avatar.
+        A step of half a tile or more (e.g. after a long frame) could cut the
+        corner of a tile or jump over it, it is swept instead and ends at the
+        first blocking edge (see CollisionGrid.get_swept_step).
 
         :Returns: steps to add to heros current position.
         """
@@ -180,43 +299,31 @@ class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
         hero_rect.midbottom = (hero_pos_x, hero_pos_y)
 
         # find the tile location of the avatar
-        tile_x = int((hero_pos_x) // metadata_sprite_layer.tilewidth)
-        tile_y = int((hero_pos_y) // metadata_sprite_layer.tileheight)
-
-        # find the tiles around the avatar and extract their rects for collision
-        tile_rects = []
-
-        for dirx, diry, mask in [
-            (-1, -1, 1<<0|1<<2), (0, -1, 1<<0), ( 1, -1, 1<<0|1<<3),
-            (-1,  0,      1<<2), (0,  0,   15), ( 1,  0,      1<<3),
-            (-1,  1, 1<<1|1<<2), (0,  1, 1<<1), ( 1,  1, 1<<1|1<<3)
-        ]:
-            this_sprite = metadata_sprite_layer.content2D[tile_y + diry][tile_x + dirx]
-            if this_sprite is not None:
-                this_tiles = [world.map.tiles.get(k, None) for k in this_sprite.key if k in world.map.tiles]
-                if this_tiles and (int(this_tiles[0].properties.get('BlockIn', 0)) & mask):
-                    tile_rects.append(this_sprite.rect)
-
-        # save the original steps and return them if not canceled
-        res_step_x = step_x
-        res_step_y = step_y
-
-        # x direction, floor or ceil depending on the sign of the step
-        step_x = special_round(step_x)
-
-        # detect a collision and dont move in x direction if colliding
-        if hero_rect.move(step_x, 0).collidelist(tile_rects) > -1:
-            res_step_x = 0
-
-        # y direction, floor or ceil depending on the sign of the step
-        step_y = special_round(step_y)
-
-        # detect a collision and dont move in y direction if colliding
-        if hero_rect.move(0, step_y).collidelist(tile_rects) > -1:
-            res_step_y = 0
+        tilewidth = metadata_sprite_layer.tilewidth
+        tileheight = metadata_sprite_layer.tileheight
+        tile_x = int((hero_pos_x) // tilewidth)
+        tile_y = int((hero_pos_y) // tileheight)
+
+        # steps floored or ceiled depending on their sign
+        round_x = special_round(step_x)
+        round_y = special_round(step_y)
+
+        # the steps are checked one axis at a time against the tiles around
+        # the avatar, that is exact for steps up to a few pixels only: a
+        # longer diagonal step would cut the corner of a tile (or jump over
+        # it), from half a tile on it is swept
+        if abs(step_x) >= tilewidth // 2 or abs(step_y) >= tileheight // 2:
+            left = hero_pos_x - collision_width / 2.0
+            return world.get_collision_grid(self.layer).get_swept_step(
+                left, hero_pos_y - collision_height, left + collision_width, hero_pos_y, step_x, step_y)
+
+        # check the steps against the tiles around the avatar, dont move in a
+        # direction if colliding
+        blocked_x, blocked_y = world.get_collision_grid(self.layer).get_blocked_steps(
+            hero_rect, tile_x, tile_y, round_x, round_y)
 
         # return the step the avatar should do
-        return res_step_x, res_step_y
+        return (0 if blocked_x else step_x), (0 if blocked_y else step_y)
 
     def try_to_move(self, world, delta_time, step_x, step_y):
         collision_width = self.rect.width
@@ -225,36 +332,54 @@ class Avatar(tiledtmxloader.helperspygame.SpriteLayer.Sprite):
             world, self.pos_x, self.pos_y, step_x, step_y, world.get_metadata_layer(self.layer).sprite_layer)
         self.execute_move(world, delta_time, new_step_x, new_step_y)
 
+    def push(self, world, step_x, step_y):
+        """
+        Moves the avatar like try_to_move without walking, e.g. out of another
+        avatar: its direction and animation stay.
+        """
+        dir_id, move_id, distance = self.dir_id, self.move_id, self.distance
+        self.try_to_move(world, 0, step_x, step_y)
+        self.dir_id, self.move_id, self.distance = dir_id, move_id, distance
+        if self.images:
+            self.image = self.images[self.move_id | self.dir_id]
+
+    def get_push(self, other):
+        """
+        Narrowphase of the collision of two avatars of a level: their feet
+        boxes (rect.width wide, COLLISION_HEIGHT high, at the bottom) overlap.
+
+        :Returns: (step_x, step_y) moving this avatar half way out of the
+                  other one along the axis they overlap less, the other one
+                  goes the opposite way, or None if they do not overlap.
+        """
+        dist_x = self.pos_x - other.pos_x
+        dist_y = self.pos_y - other.pos_y
+        overlap_x = (self.rect.width + other.rect.width) / 2.0 - abs(dist_x)
+        overlap_y = self.COLLISION_HEIGHT - abs(dist_y)
+        if overlap_x <= 0 or overlap_y <= 0:
+            return None
+        if overlap_x < overlap_y:
+            return (overlap_x / 2.0 if dist_x >= 0 else -overlap_x / 2.0), 0.0
+        return 0.0, (overlap_y / 2.0 if dist_y >= 0 else -overlap_y / 2.0)
+
+    def move_along(self, world, delta_time, flow_field, speed):
+        """
+        Moves a step of at most speed pixels along a flow field to its target
+        (see pathfinding.FlowField), it has to be of the level of the avatar.
+        """
+        step_x, step_y = flow_field.get_step(self.pos_x, self.pos_y, speed)
+        self.try_to_move(world, delta_time, step_x, step_y)
+
     def get_map_pos(self):
         return (self.pos_x, self.pos_y - self.COLLISION_HEIGHT/2.0)
 
-    def get_map_pos_info(self, world, metadata_layer):
-        pos_x, pos_y = self.get_map_pos()
-        tile_x, tile_y, sprite, tiles = world.get_pos_info(pos_x, pos_y, metadata_layer)
-        return pos_x, pos_y, tile_x, tile_y, sprite, tiles
-
-    def get_map_pos_height_info(self, world, metadata_layer):
-        pos_x, pos_y, tile_x, tile_y, sprite, tiles = self.get_map_pos_info(world, metadata_layer)
-        if tiles and tiles[0]:
-            tile_avg_height = tiles[0].properties.get('Height', None)
-            tile_x_slope = float(tiles[0].properties.get('XSlope', 0.0))
-            tile_y_slope = float(tiles[0].properties.get('YSlope', 0.0))
-            if not tile_avg_height is None:
-                #print("Tile: x={}, y={}, h={}, dx={}, dy={}".format(tile_x, tile_y, tile_avg_height, tile_x_slope, tile_y_slope))
-                tile_avg_height = float(tile_avg_height)
-        else:
-            tile_avg_height = None
-            tile_x_slope = 0.0
-            tile_y_slope = 0.0
-        return pos_x, pos_y, tile_x, tile_y, tile_avg_height, tile_x_slope, tile_y_slope, sprite, tiles
-
 class Hero(Avatar):
-    def __init__(self, start_pos_x, start_pos_y, spritesheet_png):
-        super().__init__(start_pos_x, start_pos_y, spritesheet_png)
+    def __init__(self, start_pos_x, start_pos_y, spritesheet_png, headless=False):
+        super().__init__(start_pos_x, start_pos_y, spritesheet_png, headless=headless)
 
-def create_hero_avatar(start_pos_x, start_pos_y, spritesheet_png):
+def create_hero_avatar(start_pos_x, start_pos_y, spritesheet_png, headless=False):
     full_spritesheet_path = os.path.join(os.path.dirname(__file__), 'data', 'avatars', spritesheet_png)
-    avatar = Hero(start_pos_x, start_pos_y, full_spritesheet_path)
+    avatar = Hero(start_pos_x, start_pos_y, full_spritesheet_path, headless)
     return avatar
 
 def create_avatar(world, layer_id, start_pos_x, start_pos_y, obj_id, obj_props):
@@ -264,6 +389,6 @@ def create_avatar(world, layer_id, start_pos_x, start_pos_y, obj_id, obj_props):
         json.dump(json_data, sys.stdout, cls=JSONDebugEncoder, indent=2, sort_keys=True)
     spritesheet_png = json_data['SpriteSheet']
     full_spritesheet_path = os.path.join(os.path.dirname(__file__), 'data', 'avatars', spritesheet_png)
-    avatar = Avatar(start_pos_x, start_pos_y, full_spritesheet_path, obj_id)
+    avatar = Avatar(start_pos_x, start_pos_y, full_spritesheet_path, obj_id, world.headless)
     world.add_avatar(avatar)
     avatar.add_to_sprite_layer(world.get_avatar_layer(layer_id).sprite_layer)
@@ -0,0 +1,1257 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+import pygame
+import tiledtmxloader
+
+from world import World, CollisionGrid
+from avatar import create_hero_avatar
+from common import *
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+#  -----------------------------------------------------------------------------
+
+def make_synthetic_map(directory, num_tiles_x, num_tiles_y, num_layers, seed=0):
+    """
+    Writes a map of the given size using the floor tiles and returns its path.
+    The first layer is completely filled, the other ones have 1/4 of the tiles.
+    """
+    rnd = random.Random(seed)
+    tiles_png = os.path.join(THIS_DIR, 'data', 'tiles', 'floors.png')
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<map version="1.2" orientation="orthogonal" renderorder="right-down" width="{}" height="{}" tilewidth="32" tileheight="23">'.format(num_tiles_x, num_tiles_y),
+        ' <tileset firstgid="1" name="floors" tilewidth="32" tileheight="23">',
+        '  <image source="{}" width="640" height="621"/>'.format(tiles_png),
+        ' </tileset>',
+    ]
+    for layer_idx in range(num_layers):
+        lines.append(' <layer name="Layer {:02d}" width="{}" height="{}">'.format(layer_idx, num_tiles_x, num_tiles_y))
+        lines.append('  <data encoding="csv">')
+        rows = []
+        for ypos in range(num_tiles_y):
+            row = []
+            for xpos in range(num_tiles_x):
+                if layer_idx == 0 or rnd.random() < 0.25:
+                    row.append(str(rnd.randint(1, 60)))
+                else:
+                    row.append('0')
+            rows.append(','.join(row))
+        lines.append(',\n'.join(rows))
+        lines.append('  </data>')
+        lines.append(' </layer>')
+    lines.append('</map>')
+    file_name = os.path.join(directory, 'synthetic_{}x{}x{}.tmx'.format(num_tiles_x, num_tiles_y, num_layers))
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines))
+    return file_name
+
+def make_synthetic_metadata_map(directory, num_tiles_x, num_tiles_y, seed=0, avatar_layer=False):
+    """
+    Writes a one level map with a metadata layer of the given size and returns
+    its path. Random wall segments (tiles blocking on all edges) cover about
+    a fifth of it. With avatar_layer it gets an empty layer for the avatars.
+    """
+    rnd = random.Random(seed)
+    metadata_png = os.path.join(THIS_DIR, 'data', 'tiles', 'metadata.png')
+    blocked = set()
+    while len(blocked) < num_tiles_x * num_tiles_y // 5:
+        xpos, ypos = rnd.randrange(num_tiles_x), rnd.randrange(num_tiles_y)
+        dir_x, dir_y = rnd.choice([(1, 0), (0, 1)])
+        for idx in range(rnd.randint(3, 20)):
+            blocked.add((xpos + idx * dir_x, ypos + idx * dir_y))
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<map version="1.2" orientation="orthogonal" renderorder="right-down" width="{}" height="{}" tilewidth="32" tileheight="23">'.format(num_tiles_x, num_tiles_y),
+        ' <tileset firstgid="1" name="metadata" tilewidth="32" tileheight="23">',
+        '  <image source="{}" width="640" height="621"/>'.format(metadata_png),
+        '  <tile id="0"><properties><property name="Height" type="float" value="0"/></properties></tile>',
+        '  <tile id="1"><properties><property name="BlockIn" type="int" value="15"/><property name="Height" type="float" value="0"/></properties></tile>',
+        ' </tileset>',
+        ' <layer name="Metadata 01" width="{}" height="{}">'.format(num_tiles_x, num_tiles_y),
+        '  <properties><property name="Level" type="int" value="1"/><property name="Metadata" type="bool" value="true"/></properties>',
+        '  <data encoding="csv">',
+    ]
+    rows = []
+    for ypos in range(num_tiles_y):
+        rows.append(','.join('2' if (xpos, ypos) in blocked else '1' for xpos in range(num_tiles_x)))
+    lines.append(',\n'.join(rows))
+    lines.extend(['  </data>', ' </layer>'])
+    if avatar_layer:
+        lines.extend([
+            ' <layer name="Avatars 01" width="{}" height="{}">'.format(num_tiles_x, num_tiles_y),
+            '  <properties><property name="Level" type="int" value="1"/><property name="Avatar" type="bool" value="true"/></properties>',
+            '  <data encoding="csv">',
+            ',\n'.join(','.join('0' for xpos in range(num_tiles_x)) for ypos in range(num_tiles_y)),
+            '  </data>',
+            ' </layer>'])
+    lines.append('</map>')
+    file_name = os.path.join(directory, 'synthetic_metadata_{}x{}.tmx'.format(num_tiles_x, num_tiles_y))
+    with open(file_name, 'w') as f:
+        f.write('\n'.join(lines))
+    return file_name
+
+def load_sprite_layers(file_name):
+    world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+    resources = tiledtmxloader.helperspygame.ResourceLoaderPygame()
+    resources.load(world_map)
+    return world_map, tiledtmxloader.helperspygame.get_layers_from_map(resources)
+
+def time_it(func, repeat):
+    start = time.perf_counter()
+    for idx in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of the values, fraction between 0 and 1.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+class BlitCountingSurface(pygame.Surface):
+    """
+    Offscreen surface counting the calls of blit.
+    """
+    def __init__(self, size):
+        pygame.Surface.__init__(self, size)
+        self.blit_count = 0
+
+    def blit(self, *args, **kwargs):
+        self.blit_count += 1
+        return pygame.Surface.blit(self, *args, **kwargs)
+
+#  -----------------------------------------------------------------------------
+
+# camera paths: frame index, number of frames, map and camera size -> camera center
+
+def camera_path_pan(idx, num_frames, map_w, map_h, cam_w, cam_h):
+    # left to right through the middle
+    fraction = idx / max(1, num_frames - 1)
+    return cam_w // 2 + fraction * max(0, map_w - cam_w), map_h // 2
+
+def camera_path_diagonal(idx, num_frames, map_w, map_h, cam_w, cam_h):
+    # top left to bottom right
+    fraction = idx / max(1, num_frames - 1)
+    return cam_w // 2 + fraction * max(0, map_w - cam_w), cam_h // 2 + fraction * max(0, map_h - cam_h)
+
+def camera_path_circle(idx, num_frames, map_w, map_h, cam_w, cam_h):
+    # one turn around the center
+    angle = 2 * math.pi * idx / num_frames
+    radius = max(0, min(map_w - cam_w, map_h - cam_h)) / 2
+    return map_w / 2 + radius * math.cos(angle), map_h / 2 + radius * math.sin(angle)
+
+def camera_path_jumps(idx, num_frames, map_w, map_h, cam_w, cam_h):
+    # to another random place every 10 frames
+    rnd = random.Random(idx // 10)
+    return rnd.uniform(cam_w / 2, max(cam_w / 2, map_w - cam_w / 2)), rnd.uniform(cam_h / 2, max(cam_h / 2, map_h - cam_h / 2))
+
+CAMERA_PATHS = {
+    'pan': camera_path_pan,
+    'diagonal': camera_path_diagonal,
+    'circle': camera_path_circle,
+    'jumps': camera_path_jumps,
+}
+
+def render_frame(renderer, mode, surf, layers):
+    if mode == 'layer':
+        surf.fill((0, 0, 0))
+        for layer in layers:
+            renderer.render_layer(surf, layer)
+    elif mode == 'layers':
+        surf.fill((0, 0, 0))
+        renderer.render_layers(surf, layers)
+    elif mode == 'dirty':
+        renderer.render_layers_dirty(surf, layers)
+    elif mode == 'scroll':
+        renderer.render_layers_scroll_reuse(surf, layers)
+
+def run_camera_path(renderer, layers, mode, path, num_frames, map_size, surf):
+    """
+    Renders the frames of a camera path, returns the frame times in seconds,
+    the number of blits and the number of visited tiles.
+    """
+    cam_w, cam_h = surf.get_size()
+    renderer.invalidate()
+    renderer.tiles_visited = 0
+    blits = getattr(surf, 'blit_count', 0)
+    frame_times = []
+    for idx in range(num_frames):
+        pos_x, pos_y = CAMERA_PATHS[path](idx, num_frames, map_size[0], map_size[1], cam_w, cam_h)
+        renderer.set_camera_position_and_size(int(pos_x), int(pos_y), cam_w, cam_h)
+        start = time.perf_counter()
+        render_frame(renderer, mode, surf, layers)
+        frame_times.append(time.perf_counter() - start)
+    return frame_times, getattr(surf, 'blit_count', 0) - blits, renderer.tiles_visited
+
+#  -----------------------------------------------------------------------------
+
+def benchmark_sprites(args):
+    """
+    Dynamic sprites in a SpriteLayer: linear scan against the sprite grid.
+    """
+    screen = pygame.display.set_mode((args.width, args.height))
+    with tempfile.TemporaryDirectory() as directory:
+        world_map, sprite_layers = load_sprite_layers(make_synthetic_map(directory, args.map_size, args.map_size, 1))
+    layer = sprite_layers[0]
+    renderer = tiledtmxloader.helperspygame.RendererPygame()
+    renderer.set_camera_position_and_size(world_map.pixel_width // 2, world_map.pixel_height // 2, args.width, args.height)
+    image = pygame.Surface((24, 32)).convert()
+    rnd = random.Random(0)
+
+    print("~ Map: {}x{} tiles ({}x{} px), screen {}x{}".format(
+        args.map_size, args.map_size, world_map.pixel_width, world_map.pixel_height, args.width, args.height))
+    print("{:>7} {:>7} {:>12} {:>12} {:>12} {:>12}".format(
+        'sprites', 'index', 'query (us)', 'pick (us)', 'remove (us)', 'frame (ms)'))
+    for num_sprites in args.sprites:
+        for sprite in list(layer.sprites):
+            layer.remove_sprite(sprite)
+        sprites = []
+        for idx in range(num_sprites):
+            rect = image.get_rect()
+            rect.midbottom = (rnd.randrange(world_map.pixel_width), rnd.randrange(world_map.pixel_height))
+            sprites.append(tiledtmxloader.helperspygame.SpriteLayer.Sprite(image, rect))
+        layer.add_sprites(sprites)
+
+        def move_sprites():
+            for sprite in sprites:
+                sprite.rect.move_ip(rnd.randint(-1, 1), rnd.randint(-1, 1))
+                layer.update_sprite(sprite)
+
+        def frame():
+            move_sprites()
+            renderer.render_layer(screen, layer)
+
+        def remove_and_add():
+            for sprite in sprites[:100]:
+                layer.remove_sprite(sprite)
+            layer.add_sprites(sprites[:100])
+
+        cam_rect = renderer._render_cam_rect
+        for use_index in (False, True):
+            layer.use_sprite_index = use_index
+            query = time_it(lambda: layer.get_sprites_in_rect(cam_rect), args.repeat)
+            pick = time_it(lambda: renderer.pick_layers_sprites(layer, args.width // 2, args.height // 2), args.repeat)
+            remove = time_it(remove_and_add, args.repeat) / min(100, num_sprites)
+            frame_time = time_it(frame, args.repeat)
+            print("{:>7} {:>7} {:>12.1f} {:>12.1f} {:>12.2f} {:>12.2f}".format(
+                num_sprites, 'grid' if use_index else 'linear',
+                1e6 * query, 1e6 * pick, 1e6 * remove, 1e3 * frame_time))
+    return 0
+
+def benchmark_sort(args):
+    """
+    Depth sorting of moving sprites: sorting every frame against the kept order.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        world_map, sprite_layers = load_sprite_layers(make_synthetic_map(directory, args.map_size, args.map_size, 1))
+    layer = sprite_layers[0]
+    layer.use_sprite_index = True
+    image = pygame.Surface((24, 32))
+    rnd = random.Random(0)
+    sprites = []
+    for idx in range(args.sprites):
+        rect = image.get_rect()
+        rect.midbottom = (rnd.randrange(world_map.pixel_width), rnd.randrange(world_map.pixel_height))
+        sprites.append(tiledtmxloader.helperspygame.SpriteLayer.Sprite(image, rect))
+    layer.add_sprites(sprites)
+    sort_key = lambda spr: spr.get_draw_cond()
+
+    print("~ {} sprites on {}x{} tiles".format(args.sprites, args.map_size, args.map_size))
+    print("{:>8} {:>14} {:>14}".format('moving', 'sort (ms)', 'kept (ms)'))
+    for moving in args.moving:
+        movers = sprites[:int(len(sprites) * moving)]
+
+        def move_sprites():
+            for sprite in movers:
+                sprite.rect.move_ip(0, rnd.randint(-2, 2))
+                layer.update_sprite(sprite)
+
+        # the moving is the same for both, measure it alone to subtract it
+        move = time_it(move_sprites, args.repeat)
+        sort = time_it(lambda: (move_sprites(), sorted(layer.sprites, key=sort_key)), args.repeat)
+        kept = time_it(lambda: (move_sprites(), layer.get_sprites_in_draw_order()), args.repeat)
+        assert [sort_key(spr) for spr in layer.get_sprites_in_draw_order()] == sorted(map(sort_key, layer.sprites))
+        print("{:>7.0%} {:>14.3f} {:>14.3f}".format(moving, 1e3 * (sort - move), 1e3 * max(0.0, kept - move)))
+    return 0
+
+def benchmark_layers(args):
+    """
+    Rendering maps with many layers: render_layer per layer against render_layers.
+    """
+    screen = pygame.display.set_mode((args.width, args.height))
+    renderer = tiledtmxloader.helperspygame.RendererPygame()
+    print("{:>8} {:>7} {:>16} {:>16}".format('tiles', 'layers', 'per layer (ms)', 'one pass (ms)'))
+    for num_layers in args.layers:
+        with tempfile.TemporaryDirectory() as directory:
+            world_map, sprite_layers = load_sprite_layers(make_synthetic_map(directory, args.map_size, args.map_size, num_layers))
+        renderer.set_camera_position_and_size(world_map.pixel_width // 2, world_map.pixel_height // 2, args.width, args.height)
+
+        def per_layer():
+            for layer in sprite_layers:
+                renderer.render_layer(screen, layer)
+
+        # the first call looks at all the tiles of the layers once
+        renderer.render_layers(screen, sprite_layers)
+        per_layer_time = time_it(per_layer, args.repeat)
+        one_pass_time = time_it(lambda: renderer.render_layers(screen, sprite_layers), args.repeat)
+        print("{:>8} {:>7} {:>16.2f} {:>16.2f}".format(
+            '{0}x{0}'.format(args.map_size), num_layers, 1e3 * per_layer_time, 1e3 * one_pass_time))
+    return 0
+
+def benchmark_render(args):
+    """
+    Rendering of scripted camera paths over the test map and synthetic maps.
+    """
+    maps = []
+    if not args.no_test_map:
+        file_name = os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+        with contextlib.redirect_stdout(io.StringIO()):
+            world = World(tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name))
+            # show all the levels
+            world.set_camera_layer_level(max(world.world_layers))
+        maps.append(('test.tmx', world.map, world.all_sprite_layers, world.renderer))
+    with tempfile.TemporaryDirectory() as directory:
+        for map_size in args.map_sizes:
+            for num_layers in args.layers:
+                file_name = make_synthetic_map(directory, map_size, map_size, num_layers)
+                world_map, sprite_layers = load_sprite_layers(file_name)
+                maps.append((os.path.basename(file_name), world_map, sprite_layers, \
+                             tiledtmxloader.helperspygame.RendererPygame()))
+
+    surf = pygame.Surface((args.width, args.height))
+    counting_surf = BlitCountingSurface((args.width, args.height))
+    results = []
+    print("{:<28} {:<9} {:<7} {:>9} {:>9} {:>9} {:>8} {:>8}".format(
+        'map', 'path', 'mode', 'mean (ms)', 'p95 (ms)', 'p99 (ms)', 'blits', 'tiles'))
+    for name, world_map, layers, renderer in maps:
+        map_size = (world_map.pixel_width, world_map.pixel_height)
+        for path in args.paths:
+            for mode in args.modes:
+                frame_times, blits, tiles = run_camera_path(renderer, layers, mode, path, args.frames, map_size, surf)
+                # again to count the blits, the counting slows the rendering down
+                unused, blits, unused = run_camera_path(renderer, layers, mode, path, args.frames, map_size, counting_surf)
+                result = {
+                    'map': name,
+                    'map_size': [world_map.width, world_map.height],
+                    'layers': sum(1 for layer in layers if not layer.is_object_group),
+                    'path': path,
+                    'mode': mode,
+                    'frames': args.frames,
+                    'mean_ms': 1e3 * sum(frame_times) / len(frame_times),
+                    'p95_ms': 1e3 * percentile(frame_times, 0.95),
+                    'p99_ms': 1e3 * percentile(frame_times, 0.99),
+                    'blits_per_frame': blits / args.frames,
+                    'tiles_per_frame': tiles / args.frames,
+                }
+                results.append(result)
+                print("{map:<28} {path:<9} {mode:<7} {mean_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} {blits_per_frame:>8.0f} {tiles_per_frame:>8.0f}".format(**result))
+
+    if args.json:
+        report = {
+            'screen': [args.width, args.height],
+            'pygame': pygame.version.ver,
+            'python': sys.version.split()[0],
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("~ Written", args.json)
+    return 0
+
+def get_walkable_tiles(world, level):
+    """
+    Tiles of a level with metadata not blocking the avatars.
+    """
+    metadata_layer = world.get_metadata_layer(level).sprite_layer
+    tiles = []
+    for tile_y, row in enumerate(metadata_layer.content2D):
+        for tile_x, sprite in enumerate(row):
+            if sprite is not None:
+                tile = world.map.tiles.get(sprite.key[0], None)
+                if tile is not None and not int(tile.properties.get('BlockIn', 0)):
+                    tiles.append((tile_x, tile_y))
+    return tiles
+
+class RandomWalker():
+    """
+    Moves an avatar in a random direction changed every second, back to the
+    middle of the map near its border.
+    """
+    def __init__(self, avatar, world, rnd):
+        self.avatar = avatar
+        self.rnd = rnd
+        self.ticks = 0
+        self.step_x = 0.0
+        self.step_y = 0.0
+        self.max_x = world.map.pixel_width
+        self.max_y = world.map.pixel_height
+        self.margin = 3 * world.map.tilewidth
+
+    def tick(self, world, tick_ms):
+        avatar = self.avatar
+        if self.ticks % 60 == 0:
+            angle = self.rnd.uniform(0, 2 * math.pi)
+            self.step_x = 0.15 * tick_ms * math.cos(angle)
+            self.step_y = 0.106 * tick_ms * math.sin(angle)
+        if not (self.margin < avatar.pos_x < self.max_x - self.margin) or \
+           not (self.margin < avatar.pos_y < self.max_y - self.margin):
+            self.step_x = math.copysign(self.step_x, self.max_x / 2 - avatar.pos_x)
+            self.step_y = math.copysign(self.step_y, self.max_y / 2 - avatar.pos_y)
+        self.ticks += 1
+        avatar.try_to_move(world, tick_ms, self.step_x, self.step_y)
+
+def create_headless_worlds(world_map, num_worlds, num_avatars, seed=0):
+    """
+    Headless worlds sharing the map, with random walking avatars on the
+    walkable tiles of the first level.
+    """
+    rnd = random.Random(seed)
+    worlds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for idx in range(num_worlds):
+            world = World(world_map, headless=True)
+            level = min(world.world_layers)
+            metadata_layer = world.get_metadata_layer(level).sprite_layer
+            tiles = get_walkable_tiles(world, level)
+            walkers = []
+            for avatar_idx in range(num_avatars):
+                tile_x, tile_y = rnd.choice(tiles)
+                avatar = create_hero_avatar((tile_x + 0.5) * metadata_layer.tilewidth, (tile_y + 0.5) * metadata_layer.tileheight, 'ch_01_00.png', headless=True)
+                world.add_avatar(avatar)
+                avatar.add_to_sprite_layer(world.get_avatar_layer(level).sprite_layer)
+                walkers.append(RandomWalker(avatar, world, rnd))
+            worlds.append((world, walkers))
+    return worlds
+
+def benchmark_simulation(args):
+    """
+    Headless worlds: simulation throughput in avatar ticks per second.
+    """
+    file_name = args.map or os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+    world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+    tick_ms = 1000.0 / args.tick_rate
+    print("~ Map: {}, {} avatars per world, {} ticks".format(os.path.basename(file_name), args.avatars, args.ticks))
+    print("{:>7} {:>16} {:>14} {:>20} {:>10}".format('worlds', 'build (ms/world)', 'tick (ms)', 'avatar ticks/s', 'realtime'))
+    for num_worlds in args.worlds:
+        start = time.perf_counter()
+        worlds = create_headless_worlds(world_map, num_worlds, args.avatars)
+        build_time = (time.perf_counter() - start) / num_worlds
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tick in range(args.ticks):
+                for world, walkers in worlds:
+                    world.begin_tick()
+                    for walker in walkers:
+                        walker.tick(world, tick_ms)
+                    world.end_tick()
+        run_time = time.perf_counter() - start
+        avatar_ticks = num_worlds * args.avatars * args.ticks
+        print("{:>7} {:>16.2f} {:>14.3f} {:>20,.0f} {:>9.1f}x".format(
+            num_worlds, 1e3 * build_time, 1e3 * run_time / args.ticks,
+            avatar_ticks / run_time, args.ticks * tick_ms / 1e3 / run_time))
+    return 0
+
+def benchmark_lod(args):
+    """
+    Random walking avatars all ticked or ticked by their distance to the
+    camera (scheduler.SimulationScheduler): ms per tick.
+    """
+    from scheduler import SimulationScheduler
+
+    tick_ms = 1000.0 / args.tick_rate
+    print("~ {} ticks, synthetic maps with {:g} tiles per avatar, camera in the middle".format(args.ticks, args.tiles_per_avatar))
+    print("{:>8} {:>9} {:>10} {:>10} {:>9} {:>22}".format('avatars', 'map', 'all (ms)', 'lod (ms)', 'speedup', 'near/medium/far ticks'))
+    with tempfile.TemporaryDirectory() as directory:
+        for num_avatars in args.avatars:
+            size = max(16, int(math.sqrt(num_avatars * args.tiles_per_avatar)))
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(
+                make_synthetic_metadata_map(directory, size, size, avatar_layer=True))
+            times = []
+            for use_scheduler in (False, True):
+                world, walkers = create_headless_worlds(world_map, 1, num_avatars)[0]
+                level = min(world.world_layers)
+                world.set_camera_layer_level(level)
+                world.set_camera_position(world_map.pixel_width / 2.0, world_map.pixel_height / 2.0, 0.0)
+                scheduler = SimulationScheduler(world)
+                for walker in walkers:
+                    scheduler.add(walker.avatar, walker.tick)
+                num_updates = [0, 0, 0]
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for tick in range(args.ticks):
+                        if use_scheduler:
+                            scheduler.tick(tick_ms)
+                            num_updates = [total + count for total, count in zip(num_updates, scheduler.num_updates)]
+                        else:
+                            world.begin_tick()
+                            for walker in walkers:
+                                walker.tick(world, tick_ms)
+                            world.end_tick()
+                times.append((time.perf_counter() - start) / args.ticks)
+            all_time, lod_time = times
+            print("{:>8} {:>9} {:>10.3f} {:>10.3f} {:>8.1f}x {:>22}".format(num_avatars, "{}x{}".format(size, size),
+                1e3 * all_time, 1e3 * lod_time, all_time / lod_time,
+                '/'.join("{:.0f}".format(float(count) / args.ticks) for count in num_updates)))
+    return 0
+
+def scan_triggers(world, triggers, avatar_triggers, avatars):
+    """
+    The trigger events without the index: every avatar against every
+    trigger of its level, each tick.
+
+    :Returns: number of events.
+    """
+    num_events = 0
+    for avatar in avatars:
+        inside = tuple(trigger for trigger in triggers if trigger.level == avatar.layer and trigger.contains(avatar.pos_x, avatar.pos_y))
+        old_inside = avatar_triggers.get(avatar, ())
+        if inside != old_inside:
+            avatar_triggers[avatar] = inside
+            num_events += len(set(inside).symmetric_difference(old_inside))
+    return num_events
+
+def benchmark_triggers(args):
+    """
+    Random walking avatars raising the events of random trigger regions,
+    found in the trigger grids of the world or by scanning all triggers:
+    ms per tick.
+    """
+    from world import Trigger
+
+    tick_ms = 1000.0 / args.tick_rate
+    print("~ {} avatars, {} ticks, synthetic maps with {:g} tiles per avatar".format(args.avatars, args.ticks, args.tiles_per_avatar))
+    print("{:>9} {:>10} {:>11} {:>10} {:>9} {:>9}".format('triggers', 'none (ms)', 'index (ms)', 'scan (ms)', 'speedup', 'events'))
+    size = max(16, int(math.sqrt(args.avatars * args.tiles_per_avatar)))
+    with tempfile.TemporaryDirectory() as directory:
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(
+            make_synthetic_metadata_map(directory, size, size, avatar_layer=True))
+        for num_triggers in args.triggers:
+            times = []
+            events = []
+            for mode in ('none', 'index', 'scan'):
+                world, walkers = create_headless_worlds(world_map, 1, args.avatars)[0]
+                level = min(world.world_layers)
+                rnd = random.Random(1)
+                triggers = []
+                for idx in range(num_triggers):
+                    left = rnd.uniform(0, world_map.pixel_width - 4 * world_map.tilewidth)
+                    top = rnd.uniform(0, world_map.pixel_height - 4 * world_map.tileheight)
+                    triggers.append(Trigger(level, left, top,
+                                            left + rnd.uniform(1, 4) * world_map.tilewidth,
+                                            top + rnd.uniform(1, 4) * world_map.tileheight, id=idx))
+                num_events = [0]
+                if mode == 'index':
+                    for trigger in triggers:
+                        world.add_trigger(trigger)
+                    world.trigger_listeners.append(lambda avatar, trigger, entered: num_events.__setitem__(0, num_events[0] + 1))
+                avatars = [walker.avatar for walker in walkers]
+                avatar_triggers = {}
+                if mode == 'index':
+                    for avatar in avatars:
+                        world.update_avatar_triggers(avatar)
+                elif mode == 'scan':
+                    scan_triggers(world, triggers, avatar_triggers, avatars)
+                num_events[0] = 0
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for tick in range(args.ticks):
+                        world.begin_tick()
+                        for walker in walkers:
+                            walker.tick(world, tick_ms)
+                        world.end_tick()
+                        if mode == 'scan':
+                            num_events[0] += scan_triggers(world, triggers, avatar_triggers, avatars)
+                times.append((time.perf_counter() - start) / args.ticks)
+                events.append(num_events[0])
+            none_time, index_time, scan_time = times
+            if events[1] != events[2]:
+                print("~ Different events for {} triggers: {} {}".format(num_triggers, events[1], events[2]))
+            print("{:>9} {:>10.3f} {:>11.3f} {:>10.3f} {:>8.1f}x {:>9}".format(num_triggers,
+                1e3 * none_time, 1e3 * index_time, 1e3 * scan_time,
+                max(scan_time - none_time, 0.0) / max(index_time - none_time, 1e-9), events[1]))
+    return 0
+
+def benchmark_snapshot(args):
+    """
+    Saving and loading a world: loading the map and creating the world and
+    its avatars against World.snapshot and World.restore, and the sizes of
+    full and delta snapshots.
+    """
+    print("~ synthetic maps with {:g} tiles per avatar, {:g}% of the avatars moved for the delta".format(
+        args.tiles_per_avatar, 100.0 * args.moved))
+    print("{:>8} {:>9} {:>10} {:>10} {:>11} {:>10} {:>11}".format(
+        'avatars', 'map', 'load (ms)', 'save (ms)', 'restore (ms)', 'full (kB)', 'delta (kB)'))
+    with tempfile.TemporaryDirectory() as directory:
+        for num_avatars in args.avatars:
+            size = max(16, int(math.sqrt(num_avatars * args.tiles_per_avatar)))
+            file_name = make_synthetic_metadata_map(directory, size, size, avatar_layer=True)
+            start = time.perf_counter()
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+            world, walkers = create_headless_worlds(world_map, 1, num_avatars)[0]
+            load_time = time.perf_counter() - start
+            with contextlib.redirect_stdout(io.StringIO()):
+                for tick in range(10):
+                    for walker in walkers:
+                        walker.tick(world, 16.0)
+            start = time.perf_counter()
+            full = world.snapshot()
+            save_time = time.perf_counter() - start
+            with contextlib.redirect_stdout(io.StringIO()):
+                for walker in walkers[:int(num_avatars * args.moved)]:
+                    walker.tick(world, 16.0)
+            delta = world.snapshot(full)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                world.restore(full)
+            restore_time = time.perf_counter() - start
+            if world.snapshot() != full:
+                print("~ Different snapshot after restoring it")
+            print("{:>8} {:>9} {:>10.1f} {:>10.2f} {:>11.2f} {:>10.1f} {:>11.1f}".format(
+                num_avatars, "{}x{}".format(size, size), 1e3 * load_time, 1e3 * save_time, 1e3 * restore_time,
+                len(full) / 1024.0, len(delta) / 1024.0))
+    return 0
+
+def make_scripted_recording(file_name, num_frames, tick_rate=60.0, seed=0):
+    """
+    A recording of the demo on a map without a player: the arrow keys change
+    every half second, the frame times jitter around 60 fps.
+    """
+    from main import create_demo_world, DemoSimulation
+    from replay import InputRecording, get_state_hash
+
+    rnd = random.Random(seed)
+    recording = InputRecording(file_name, tick_rate)
+    with contextlib.redirect_stdout(io.StringIO()):
+        world, hero = create_demo_world(file_name, headless=True)
+        simulation = DemoSimulation(world, hero, recording.tick_rate, recording.max_catch_up)
+        keys = 0
+        for idx in range(num_frames):
+            if idx % 30 == 0:
+                keys = rnd.randrange(16)
+            dt = rnd.choice([16, 16, 17, 17, 33])
+            simulation.tick(dt, keys)
+            simulation.update_camera()
+            recording.add_frame(dt, keys, get_state_hash(world))
+    return recording
+
+def benchmark_replay(args):
+    """
+    Headless replay of a recording of the demo (see main.py --record) as fast
+    as possible, checking the state of each frame: ms per frame.
+    """
+    from main import replay_headless
+    from replay import InputRecording
+
+    if args.recording:
+        recording = InputRecording.load(args.recording)
+        print("~ Recording: {}, {} frames".format(args.recording, len(recording)))
+    else:
+        file_name = args.map or os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+        recording = make_scripted_recording(file_name, args.frames)
+        print("~ Scripted recording on {}, {} frames".format(os.path.basename(file_name), len(recording)))
+    print("{:>6} {:>12} {:>12} {:>12} {:>16}".format('run', 'mean (ms)', 'median (ms)', 'max (ms)', 'first difference'))
+    for run in range(args.runs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            frame_times, first_difference = replay_headless(recording, args.map)
+        frame_times.sort()
+        print("{:>6} {:>12.4f} {:>12.4f} {:>12.4f} {:>16}".format(run, 1e3 * sum(frame_times) / len(frame_times),
+            1e3 * frame_times[len(frame_times) // 2], 1e3 * frame_times[-1],
+            '-' if first_difference is None else first_difference))
+    return 0
+
+def check_collision_tiles(world, rect, tile_x, tile_y, step_x, step_y, metadata_layer):
+    """
+    The collision check before the collision grids: looks up the tiles
+    around the avatar and collides the rects of the blocking ones.
+    """
+    tile_rects = []
+    for dir_x, dir_y, mask in CollisionGrid.NEIGHBOURS:
+        sprite = metadata_layer.content2D[tile_y + dir_y][tile_x + dir_x]
+        if sprite is not None:
+            tiles = [world.map.tiles.get(k, None) for k in sprite.key if k in world.map.tiles]
+            if tiles and (int(tiles[0].properties.get('BlockIn', 0)) & mask):
+                tile_rects.append(sprite.rect)
+    return rect.move(step_x, 0).collidelist(tile_rects) > -1, rect.move(0, step_y).collidelist(tile_rects) > -1
+
+def benchmark_collision(args):
+    """
+    Collision checks of random moves, tile lookups against the collision grid.
+    """
+    file_name = args.map or os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+    world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        world = World(world_map, headless=True)
+    rnd = random.Random(0)
+    print("~ Map: {}, {} checks per level".format(os.path.basename(file_name), args.checks))
+    print("{:>6} {:>14} {:>14} {:>9} {:>9}".format('level', 'tiles (us)', 'grid (us)', 'speedup', 'blocked'))
+    for level in sorted(world.world_layers):
+        if not world.get_collision_grid(level):
+            continue
+        metadata_layer = world.get_metadata_layer(level).sprite_layer
+        collision_grid = world.get_collision_grid(level)
+        tilewidth, tileheight = metadata_layer.tilewidth, metadata_layer.tileheight
+        checks = []
+        for idx in range(args.checks):
+            pos_x = rnd.uniform(tilewidth, (collision_grid.num_tiles_x - 1) * tilewidth - 1)
+            pos_y = rnd.uniform(tileheight, (collision_grid.num_tiles_y - 1) * tileheight - 1)
+            rect = pygame.Rect(0, 0, 32, 5)
+            rect.midbottom = (pos_x, pos_y)
+            checks.append((rect, int(pos_x // tilewidth), int(pos_y // tileheight),
+                           special_round(rnd.uniform(-3, 3)), special_round(rnd.uniform(-3, 3))))
+
+        start = time.perf_counter()
+        expected = [check_collision_tiles(world, *check, metadata_layer) for check in checks]
+        tiles_time = time.perf_counter() - start
+        start = time.perf_counter()
+        captured = [collision_grid.get_blocked_steps(*check) for check in checks]
+        grid_time = time.perf_counter() - start
+        if captured != expected:
+            print("~ Different results for level", level)
+            return 1
+        num_blocked = sum(1 for blocked_x, blocked_y in captured if blocked_x or blocked_y)
+        print("{:>6} {:>14.2f} {:>14.2f} {:>8.1f}x {:>8.1f}%".format(level, 1e6 * tiles_time / args.checks,
+            1e6 * grid_time / args.checks, tiles_time / grid_time, 100.0 * num_blocked / args.checks))
+    return 0
+
+def check_collision_final(world, avatar, step_x, step_y):
+    """
+    The collision check before the swept steps: only the final offset of
+    the steps is checked against the tiles around the avatar.
+    """
+    metadata_layer = world.get_metadata_layer(avatar.layer).sprite_layer
+    rect = pygame.Rect(0, 0, avatar.rect.width, avatar.COLLISION_HEIGHT)
+    rect.midbottom = (avatar.pos_x, avatar.pos_y)
+    tile_x = int(avatar.pos_x // metadata_layer.tilewidth)
+    tile_y = int(avatar.pos_y // metadata_layer.tileheight)
+    blocked_x, blocked_y = world.get_collision_grid(avatar.layer).get_blocked_steps(
+        rect, tile_x, tile_y, special_round(step_x), special_round(step_y))
+    return (0 if blocked_x else step_x), (0 if blocked_y else step_y)
+
+def benchmark_sweep(args):
+    """
+    Collision checks of avatars: the final offset of the step only against
+    the swept steps, for normal steps and for long ones (e.g. after a long
+    frame) which could jump over tiles.
+    """
+    file_name = args.map or os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+    world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        world = World(world_map, headless=True)
+    rnd = random.Random(0)
+    print("~ Map: {}, {} checks per level and step length".format(os.path.basename(file_name), args.checks))
+    print("{:>6} {:>8} {:>12} {:>12} {:>9} {:>11} {:>9}".format(
+        'level', 'step', 'final (us)', 'swept (us)', 'slowdown', 'tunnelled', 'contacts'))
+    avatar = create_hero_avatar(0, 0, 'ch_01_00.png', headless=True)
+    for level in sorted(world.world_layers):
+        collision_grid = world.get_collision_grid(level)
+        if not collision_grid:
+            continue
+        metadata_layer = world.get_metadata_layer(level).sprite_layer
+        tilewidth, tileheight = metadata_layer.tilewidth, metadata_layer.tileheight
+        avatar.layer = level
+        for step_length in args.step_lengths:
+            checks = []
+            for idx in range(args.checks):
+                angle = rnd.uniform(0, 2 * math.pi)
+                checks.append((rnd.uniform(tilewidth, (collision_grid.num_tiles_x - 1) * tilewidth - 1),
+                               rnd.uniform(tileheight, (collision_grid.num_tiles_y - 1) * tileheight - 1),
+                               step_length * math.cos(angle), step_length * math.sin(angle)))
+
+            final_time = swept_time = 0.0
+            num_tunnelled = num_contacts = 0
+            for pos_x, pos_y, step_x, step_y in checks:
+                avatar.pos_x, avatar.pos_y = pos_x, pos_y
+                start = time.perf_counter()
+                final_steps = check_collision_final(world, avatar, step_x, step_y)
+                final_time += time.perf_counter() - start
+                start = time.perf_counter()
+                swept_steps = avatar.check_collision(world, pos_x, pos_y, step_x, step_y, metadata_layer)
+                swept_time += time.perf_counter() - start
+                # passing a blocking edge with the step of the final check
+                left = pos_x - avatar.rect.width / 2.0
+                contact_time, slide_x, slide_y = collision_grid.sweep(
+                    left, pos_y - avatar.COLLISION_HEIGHT, left + avatar.rect.width, pos_y, *final_steps)
+                num_tunnelled += contact_time < 1.0
+                num_contacts += swept_steps != (step_x, step_y)
+            print("{:>6} {:>8g} {:>12.2f} {:>12.2f} {:>8.2f}x {:>10.1f}% {:>8.1f}%".format(level, step_length,
+                1e6 * final_time / args.checks, 1e6 * swept_time / args.checks, swept_time / final_time,
+                100.0 * num_tunnelled / args.checks, 100.0 * num_contacts / args.checks))
+    return 0
+
+def benchmark_spatial(args):
+    """
+    Avatars near a position: the spatial hash of the world against a scan of
+    all avatars, and the cost of keeping the hash up to date.
+    """
+    file_name = args.map or os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+    world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+    rnd = random.Random(0)
+    print("~ Map: {}, {} queries of radius {:g}".format(os.path.basename(file_name), args.queries, args.radius))
+    print("{:>8} {:>12} {:>12} {:>9} {:>12} {:>9}".format('avatars', 'scan (us)', 'hash (us)', 'speedup', 'update (us)', 'found'))
+    for num_avatars in args.avatars:
+        with contextlib.redirect_stdout(io.StringIO()):
+            world = World(world_map, headless=True)
+        level = min(world.world_layers)
+        map_width = world_map.width * world_map.tilewidth
+        map_height = world_map.height * world_map.tileheight
+        for idx in range(num_avatars):
+            avatar = create_hero_avatar(rnd.uniform(0, map_width), rnd.uniform(0, map_height), 'ch_01_00.png', headless=True)
+            avatar.layer = level
+            world.add_avatar(avatar)
+        avatars = list(world.avatars)
+        queries = [(rnd.uniform(0, map_width), rnd.uniform(0, map_height)) for idx in range(args.queries)]
+        radius_squared = args.radius * args.radius
+
+        start = time.perf_counter()
+        expected = []
+        for pos_x, pos_y in queries:
+            expected.append(set(avatar for avatar in avatars if avatar.layer == level and
+                                (avatar.pos_x - pos_x) ** 2 + (avatar.pos_y - pos_y) ** 2 <= radius_squared))
+        scan_time = time.perf_counter() - start
+        start = time.perf_counter()
+        captured = [world.get_avatars_in_radius(level, pos_x, pos_y, args.radius) for pos_x, pos_y in queries]
+        hash_time = time.perf_counter() - start
+        if [set(found) for found in captured] != expected:
+            print("~ Different results for {} avatars".format(num_avatars))
+            return 1
+
+        # a tick of walking avatars
+        for avatar in avatars:
+            avatar.pos_x += rnd.uniform(-2, 2)
+            avatar.pos_y += rnd.uniform(-2, 2)
+        start = time.perf_counter()
+        for avatar in avatars:
+            world.update_avatar_position(avatar)
+        update_time = time.perf_counter() - start
+        num_found = sum(len(found) for found in captured)
+        print("{:>8} {:>12.2f} {:>12.2f} {:>8.1f}x {:>12.3f} {:>9.1f}".format(num_avatars,
+            1e6 * scan_time / args.queries, 1e6 * hash_time / args.queries, scan_time / hash_time,
+            1e6 * update_time / num_avatars, float(num_found) / args.queries))
+    return 0
+
+def benchmark_avatars(args):
+    """
+    Avatar-versus-avatar collisions: broadphase pairs and resolution of the
+    overlaps, avatars one by one (World) or all at once (Crowd).
+    """
+    from crowd import Crowd
+
+    spritesheet = os.path.join(THIS_DIR, 'data', 'avatars', 'ch_01_00.png')
+    print("~ {}".format("Map: " + os.path.basename(args.map) if args.map else
+                        "Synthetic maps with {:g} tiles per avatar".format(args.tiles_per_avatar)))
+    print("{:>8} {:>9} {:>8} {:>9} {:>12} {:>13} {:>17} {:>11}".format(
+        'avatars', 'map', 'pairs', 'overlaps', 'pairs (ms)', 'resolve (ms)', 'crowd pairs (ms)', 'crowd (ms)'))
+    with tempfile.TemporaryDirectory() as directory:
+        for num_avatars in args.avatars:
+            file_name = args.map
+            if not file_name:
+                size = max(16, int(math.sqrt(num_avatars * args.tiles_per_avatar)))
+                file_name = make_synthetic_metadata_map(directory, size, size, avatar_layer=True)
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+            rnd = random.Random(0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                world = World(world_map, headless=True)
+                crowd_world = World(world_map, headless=True)
+                level = min(world.world_layers)
+                metadata_layer = world.get_metadata_layer(level).sprite_layer
+                crowd = Crowd(crowd_world)
+                tiles = get_walkable_tiles(world, level)
+                for idx in range(num_avatars):
+                    tile_x, tile_y = rnd.choice(tiles)
+                    pos_x = (tile_x + rnd.random()) * metadata_layer.tilewidth
+                    pos_y = (tile_y + rnd.random()) * metadata_layer.tileheight
+                    avatar = create_hero_avatar(pos_x, pos_y, 'ch_01_00.png', headless=True)
+                    avatar.layer = level
+                    world.add_avatar(avatar)
+                    crowd.add(pos_x, pos_y, spritesheet, layer=level)
+
+            start = time.perf_counter()
+            pairs = world.get_avatar_pairs(level)
+            pairs_time = time.perf_counter() - start
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                num_overlaps = world.resolve_avatar_collisions()
+                resolve_time = time.perf_counter() - start
+            start = time.perf_counter()
+            crowd.get_avatar_pairs()
+            crowd_pairs_time = time.perf_counter() - start
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                push_x, push_y, crowd_overlaps = crowd.get_avatar_pushes()
+                crowd._move(*crowd._collide(push_x, push_y))
+                crowd_time = time.perf_counter() - start
+            if crowd_overlaps != num_overlaps:
+                print("~ Different overlaps for {} avatars: {} {}".format(num_avatars, num_overlaps, crowd_overlaps))
+                return 1
+            print("{:>8} {:>9} {:>8} {:>9} {:>12.3f} {:>13.3f} {:>17.3f} {:>11.3f}".format(
+                num_avatars, "{}x{}".format(world_map.width, world_map.height), len(pairs), num_overlaps,
+                1e3 * pairs_time, 1e3 * resolve_time, 1e3 * crowd_pairs_time, 1e3 * crowd_time))
+    return 0
+
+def benchmark_pathfinding(args):
+    """
+    A* paths between random walkable tiles: queries per second.
+    """
+    from pathfinding import Pathfinder
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = [make_synthetic_metadata_map(directory, size, size) for size in args.map_sizes]
+        if not args.no_test_map:
+            file_names.append(os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx'))
+        print("~ {} queries per map, {} workers".format(args.queries, args.workers))
+        print("{:>28} {:>10} {:>10} {:>10} {:>10} {:>8}".format('map', 'build (ms)', 'queries/s', 'cached/s', 'batch/s', 'found'))
+        for file_name in file_names:
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+            with contextlib.redirect_stdout(io.StringIO()):
+                world = World(world_map, headless=True)
+            start = time.perf_counter()
+            pathfinder = Pathfinder(world, max_cached_paths=2 * args.queries, max_workers=args.workers)
+            pathfinder.nav_grid.get_components()
+            build_time = time.perf_counter() - start
+            nav_grid = pathfinder.nav_grid
+            nodes = [node for node in range(len(nav_grid.walkable)) if nav_grid.walkable[node]]
+            queries = [(nav_grid.get_tile(rnd.choice(nodes)), nav_grid.get_tile(rnd.choice(nodes))) for idx in range(args.queries)]
+
+            start = time.perf_counter()
+            paths = [pathfinder.find_path(start_tile, goal_tile) for start_tile, goal_tile in queries]
+            search_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for start_tile, goal_tile in queries:
+                pathfinder.find_path(start_tile, goal_tile)
+            cached_time = time.perf_counter() - start
+            pathfinder._paths.clear()
+            start = time.perf_counter()
+            pathfinder.find_paths(queries)
+            batch_time = time.perf_counter() - start
+            pathfinder.close()
+
+            num_found = sum(1 for path in paths if path is not None)
+            print("{:>28} {:>10.1f} {:>10.1f} {:>10.0f} {:>10.1f} {:>7.0f}%".format(
+                "{} ({}x{})".format(os.path.basename(file_name), nav_grid.num_tiles_x, nav_grid.num_tiles_y),
+                1e3 * build_time, args.queries / search_time, args.queries / cached_time,
+                args.queries / batch_time, 100.0 * num_found / args.queries))
+    return 0
+
+def get_path_cost(nav_grid, nodes):
+    cost = 0.0
+    for node, next_node in zip(nodes, nodes[1:]):
+        cost += dict(nav_grid.get_neighbours(node))[next_node]
+    return cost
+
+def benchmark_hpa(args):
+    """
+    HPA* against flat A*: latency of the queries, cost of the paths.
+    """
+    from pathfinding import Pathfinder, ClusterGraph
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = [make_synthetic_metadata_map(directory, size, size) for size in args.map_sizes]
+        if not args.no_test_map:
+            file_names.append(os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx'))
+        print("~ {} queries per map, clusters of {} tiles".format(args.queries, args.cluster_size))
+        print("{:>28} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            'map', 'build (s)', 'load (s)', 'A* (ms)', 'HPA* (ms)', 'abstract', 'cost'))
+        for file_name in file_names:
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+            with contextlib.redirect_stdout(io.StringIO()):
+                world = World(world_map, headless=True)
+            flat = Pathfinder(world)
+            nav_grid = flat.nav_grid
+            nav_grid.get_components()
+            # saved next to the copy of the map, not the original
+            cluster_file_name = os.path.join(directory, os.path.basename(
+                ClusterGraph.get_file_name(world, args.cluster_size)))
+            start = time.perf_counter()
+            hierarchical = Pathfinder(world, cluster_size=args.cluster_size, cluster_file_name=cluster_file_name)
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            ClusterGraph(nav_grid, args.cluster_size).load(cluster_file_name)
+            load_time = time.perf_counter() - start
+            hierarchical.nav_grid.get_components()
+
+            nodes = [node for node in range(len(nav_grid.walkable)) if nav_grid.walkable[node]]
+            queries = [(rnd.choice(nodes), rnd.choice(nodes)) for idx in range(args.queries)]
+            flat_paths = []
+            start = time.perf_counter()
+            for start_node, goal_node in queries:
+                flat_paths.append(flat._search(start_node, goal_node))
+            flat_time = time.perf_counter() - start
+            paths = []
+            start = time.perf_counter()
+            for start_node, goal_node in queries:
+                paths.append(hierarchical._search(start_node, goal_node))
+            hierarchical_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for start_node, goal_node in queries:
+                hierarchical.cluster_graph.find_abstract_path(start_node, goal_node)
+            abstract_time = time.perf_counter() - start
+            flat.close()
+            hierarchical.close()
+
+            flat_cost = sum(get_path_cost(nav_grid, path) for path in flat_paths if path is not None)
+            cost = sum(get_path_cost(nav_grid, path) for path in paths if path is not None)
+            assert [path is None for path in paths] == [path is None for path in flat_paths]
+            print("{:>28} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.1f}%".format(
+                "{} ({}x{})".format(os.path.basename(file_name), nav_grid.num_tiles_x, nav_grid.num_tiles_y),
+                build_time, load_time, 1e3 * flat_time / args.queries, 1e3 * hierarchical_time / args.queries,
+                1e3 * abstract_time / args.queries, 100.0 * cost / flat_cost if flat_cost else 100.0))
+    return 0
+
+def benchmark_flowfield(args):
+    """
+    Flow fields: time to make one, to sample it for an avatar and for a crowd,
+    against an A* path per avatar.
+    """
+    import numpy
+    from pathfinding import Pathfinder, FlowFieldCache
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = [make_synthetic_metadata_map(directory, size, size) for size in args.map_sizes]
+        if not args.no_test_map:
+            file_names.append(os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx'))
+        print("~ {} avatars heading to the same tile".format(args.avatars))
+        print("{:>28} {:>10} {:>10} {:>12} {:>12}".format('map', 'field (ms)', 'step (us)', 'crowd (ms)', 'A* (ms)'))
+        for file_name in file_names:
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+            with contextlib.redirect_stdout(io.StringIO()):
+                world = World(world_map, headless=True)
+            flow_fields = FlowFieldCache(world)
+            nav_grid = flow_fields.nav_grid
+            level = nav_grid.levels[0]
+            nodes = [node for node in range(nav_grid.tiles_per_level) if nav_grid.walkable[node]]
+            target = nav_grid.get_tile(rnd.choice(nodes))
+            flow_fields.get_edges(level)
+            start = time.perf_counter()
+            flow_field = flow_fields.get_field(*target)
+            field_time = time.perf_counter() - start
+
+            starts = [nav_grid.get_tile(rnd.choice(nodes)) for idx in range(args.avatars)]
+            xs = numpy.array([(tile_x + rnd.random()) * nav_grid.tilewidth for level, tile_x, tile_y in starts])
+            ys = numpy.array([(tile_y + rnd.random()) * nav_grid.tileheight for level, tile_x, tile_y in starts])
+            start = time.perf_counter()
+            for pos_x, pos_y in zip(xs.tolist(), ys.tolist()):
+                flow_field.get_step(pos_x, pos_y, 2.0)
+            step_time = (time.perf_counter() - start) / args.avatars
+            start = time.perf_counter()
+            flow_field.get_steps(xs, ys, 2.0)
+            crowd_time = time.perf_counter() - start
+
+            pathfinder = Pathfinder(world)
+            pathfinder.nav_grid.get_components()
+            num_paths = min(args.avatars, args.max_paths)
+            start = time.perf_counter()
+            for start_tile in starts[:num_paths]:
+                pathfinder.find_path(start_tile, target)
+            path_time = (time.perf_counter() - start) / num_paths * args.avatars
+            pathfinder.close()
+            flow_fields.close()
+            print("{:>28} {:>10.2f} {:>10.2f} {:>12.3f} {:>12.1f}".format(
+                "{} ({}x{})".format(os.path.basename(file_name), nav_grid.num_tiles_x, nav_grid.num_tiles_y),
+                1e3 * field_time, 1e6 * step_time, 1e3 * crowd_time, 1e3 * path_time))
+    return 0
+
+def benchmark_crowd(args):
+    """
+    Avatars moved one by one or all at once by a Crowd: ms per tick.
+    """
+    import numpy
+    from crowd import Crowd
+
+    file_name = args.map or os.path.join(THIS_DIR, 'data', 'maps', 'test.tmx')
+    world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name)
+    tick_ms = 1000.0 / args.tick_rate
+    spritesheet = os.path.join(THIS_DIR, 'data', 'avatars', 'ch_01_00.png')
+    print("~ Map: {}, {} ticks, budget {:.1f} ms per tick".format(os.path.basename(file_name), args.ticks, tick_ms))
+    print("{:>8} {:>12} {:>12} {:>9}".format('avatars', 'scalar (ms)', 'crowd (ms)', 'speedup'))
+    for num_avatars in args.avatars:
+        scalar_time = None
+        if num_avatars <= args.max_scalar:
+            world, walkers = create_headless_worlds(world_map, 1, num_avatars)[0]
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for tick in range(args.ticks):
+                    world.begin_tick()
+                    for walker in walkers:
+                        walker.tick(world, tick_ms)
+                    world.end_tick()
+            scalar_time = (time.perf_counter() - start) / args.ticks
+
+        # same random walk as RandomWalker, for all avatars at once
+        rnd = numpy.random.default_rng(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            world = World(world_map, headless=True)
+            level = min(world.world_layers)
+            metadata_layer = world.get_metadata_layer(level).sprite_layer
+            crowd = Crowd(world)
+            tiles = get_walkable_tiles(world, level)
+            for idx in rnd.integers(len(tiles), size=num_avatars):
+                tile_x, tile_y = tiles[idx]
+                crowd.add((tile_x + 0.5) * metadata_layer.tilewidth, (tile_y + 0.5) * metadata_layer.tileheight, spritesheet, layer=level)
+        margin = 3 * world_map.tilewidth
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tick in range(args.ticks):
+                if tick % 60 == 0:
+                    angle = rnd.uniform(0, 2 * math.pi, num_avatars)
+                    crowd.step_x = 0.15 * tick_ms * numpy.cos(angle)
+                    crowd.step_y = 0.106 * tick_ms * numpy.sin(angle)
+                outside = (crowd.pos_x <= margin) | (crowd.pos_x >= world_map.pixel_width - margin) | \
+                          (crowd.pos_y <= margin) | (crowd.pos_y >= world_map.pixel_height - margin)
+                crowd.step_x[outside] = numpy.copysign(crowd.step_x, world_map.pixel_width / 2 - crowd.pos_x)[outside]
+                crowd.step_y[outside] = numpy.copysign(crowd.step_y, world_map.pixel_height / 2 - crowd.pos_y)[outside]
+                crowd.tick()
+        crowd_time = (time.perf_counter() - start) / args.ticks
+        print("{:>8} {:>12} {:>12.3f} {:>9}".format(num_avatars,
+            '-' if scalar_time is None else "{:.3f}".format(1e3 * scalar_time), 1e3 * crowd_time,
+            '-' if scalar_time is None else "{:.1f}x".format(scalar_time / crowd_time)))
+    return 0
+
+#  -----------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='World Benchmarks')
+    parser.add_argument('--width', type=int, default=1024, help="screen width")
+    parser.add_argument('--height', type=int, default=768, help="screen height")
+    parser.add_argument('--repeat', type=int, default=20, help="repetitions of each measurement")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parser_sprites = subparsers.add_parser('sprites', help=benchmark_sprites.__doc__.strip())
+    parser_sprites.add_argument('--map-size', type=int, default=256, help="map size in tiles")
+    parser_sprites.add_argument('--sprites', type=int, nargs='+', default=[100, 1000, 10000], help="numbers of sprites")
+    parser_sprites.set_defaults(func=benchmark_sprites)
+
+    parser_render = subparsers.add_parser('render', help=benchmark_render.__doc__.strip())
+    parser_render.add_argument('--map-sizes', type=int, nargs='*', default=[64, 256], help="sizes of the synthetic maps in tiles")
+    parser_render.add_argument('--layers', type=int, nargs='+', default=[1, 4, 16], help="numbers of layers of the synthetic maps")
+    parser_render.add_argument('--no-test-map', action="store_true", help="only use the synthetic maps")
+    parser_render.add_argument('--paths', nargs='+', choices=sorted(CAMERA_PATHS), default=sorted(CAMERA_PATHS), help="camera paths")
+    parser_render.add_argument('--modes', nargs='+', choices=['layer', 'layers', 'dirty', 'scroll'], default=['layers'], help="rendering methods")
+    parser_render.add_argument('--frames', type=int, default=300, help="frames per camera path")
+    parser_render.add_argument('--json', help="write the results to this JSON file")
+    parser_render.set_defaults(func=benchmark_render)
+
+    parser_simulation = subparsers.add_parser('simulation', help=benchmark_simulation.__doc__.strip())
+    parser_simulation.add_argument('--map', help="map file (default: data/maps/test.tmx)")
+    parser_simulation.add_argument('--worlds', type=int, nargs='+', default=[1, 10, 100], help="numbers of worlds")
+    parser_simulation.add_argument('--avatars', type=int, default=10, help="avatars per world")
+    parser_simulation.add_argument('--ticks', type=int, default=600, help="simulated ticks")
+    parser_simulation.add_argument('--tick-rate', type=float, default=60.0, help="ticks per second")
+    parser_simulation.set_defaults(func=benchmark_simulation)
+
+    parser_lod = subparsers.add_parser('lod', help=benchmark_lod.__doc__.strip())
+    parser_lod.add_argument('--avatars', type=int, nargs='*', default=[100, 1000, 10000], help="numbers of avatars")
+    parser_lod.add_argument('--tiles-per-avatar', type=float, default=16.0, help="size of the synthetic maps")
+    parser_lod.add_argument('--ticks', type=int, default=300, help="simulated ticks")
+    parser_lod.add_argument('--tick-rate', type=float, default=60.0, help="ticks per second")
+    parser_lod.set_defaults(func=benchmark_lod)
+
+    parser_triggers = subparsers.add_parser('triggers', help=benchmark_triggers.__doc__.strip())
+    parser_triggers.add_argument('--avatars', type=int, default=1000, help="number of avatars")
+    parser_triggers.add_argument('--triggers', type=int, nargs='*', default=[10, 100, 1000], help="numbers of triggers")
+    parser_triggers.add_argument('--tiles-per-avatar', type=float, default=16.0, help="size of the synthetic maps")
+    parser_triggers.add_argument('--ticks', type=int, default=60, help="simulated ticks")
+    parser_triggers.add_argument('--tick-rate', type=float, default=60.0, help="ticks per second")
+    parser_triggers.set_defaults(func=benchmark_triggers)
+
+    parser_snapshot = subparsers.add_parser('snapshot', help=benchmark_snapshot.__doc__.strip())
+    parser_snapshot.add_argument('--avatars', type=int, nargs='*', default=[100, 1000, 10000], help="numbers of avatars")
+    parser_snapshot.add_argument('--tiles-per-avatar', type=float, default=16.0, help="size of the synthetic maps")
+    parser_snapshot.add_argument('--moved', type=float, default=0.1, help="fraction of the avatars moved for the delta snapshot")
+    parser_snapshot.set_defaults(func=benchmark_snapshot)
+
+    parser_replay = subparsers.add_parser('replay', help=benchmark_replay.__doc__.strip())
+    parser_replay.add_argument('--recording', help="input recording of the demo (default: a scripted one)")
+    parser_replay.add_argument('--map', help="map file (default: the map of the recording, data/maps/test.tmx for the scripted one)")
+    parser_replay.add_argument('--frames', type=int, default=3600, help="frames of the scripted recording")
+    parser_replay.add_argument('--runs', type=int, default=3, help="number of replays")
+    parser_replay.set_defaults(func=benchmark_replay)
+
+    parser_collision = subparsers.add_parser('collision', help=benchmark_collision.__doc__.strip())
+    parser_collision.add_argument('--map', help="map file (default: data/maps/test.tmx)")
+    parser_collision.add_argument('--checks', type=int, default=100000, help="collision checks per level")
+    parser_collision.set_defaults(func=benchmark_collision)
+
+    parser_sweep = subparsers.add_parser('sweep', help=benchmark_sweep.__doc__.strip())
+    parser_sweep.add_argument('--map', help="map file (default: data/maps/test.tmx)")
+    parser_sweep.add_argument('--checks', type=int, default=20000, help="collision checks per level and step length")
+    parser_sweep.add_argument('--step-lengths', type=float, nargs='*', default=[2.5, 16, 64, 256], help="step lengths in pixels")
+    parser_sweep.set_defaults(func=benchmark_sweep)
+
+    parser_spatial = subparsers.add_parser('spatial', help=benchmark_spatial.__doc__.strip())
+    parser_spatial.add_argument('--map', help="map file (default: data/maps/test.tmx)")
+    parser_spatial.add_argument('--avatars', type=int, nargs='*', default=[10, 100, 1000, 10000], help="numbers of avatars")
+    parser_spatial.add_argument('--queries', type=int, default=1000, help="radius queries")
+    parser_spatial.add_argument('--radius', type=float, default=64.0, help="radius of the queries in pixels")
+    parser_spatial.set_defaults(func=benchmark_spatial)
+
+    parser_avatars = subparsers.add_parser('avatars', help=benchmark_avatars.__doc__.strip())
+    parser_avatars.add_argument('--map', help="map file (default: synthetic maps)")
+    parser_avatars.add_argument('--avatars', type=int, nargs='*', default=[100, 1000, 5000, 20000], help="numbers of avatars")
+    parser_avatars.add_argument('--tiles-per-avatar', type=float, default=4.0, help="size of the synthetic maps")
+    parser_avatars.set_defaults(func=benchmark_avatars)
+
+    parser_pathfinding = subparsers.add_parser('pathfinding', help=benchmark_pathfinding.__doc__.strip())
+    parser_pathfinding.add_argument('--map-sizes', type=int, nargs='*', default=[128, 512], help="sizes of the synthetic maps in tiles")
+    parser_pathfinding.add_argument('--no-test-map', action="store_true", help="only use the synthetic maps")
+    parser_pathfinding.add_argument('--queries', type=int, default=200, help="path queries per map")
+    parser_pathfinding.add_argument('--workers', type=int, default=4, help="threads of the batch queries")
+    parser_pathfinding.set_defaults(func=benchmark_pathfinding)
+
+    parser_hpa = subparsers.add_parser('hpa', help=benchmark_hpa.__doc__.strip())
+    parser_hpa.add_argument('--map-sizes', type=int, nargs='*', default=[128, 512], help="sizes of the synthetic maps in tiles")
+    parser_hpa.add_argument('--no-test-map', action="store_true", help="only use the synthetic maps")
+    parser_hpa.add_argument('--queries', type=int, default=100, help="path queries per map")
+    parser_hpa.add_argument('--cluster-size', type=int, default=16, help="size of the clusters in tiles")
+    parser_hpa.set_defaults(func=benchmark_hpa)
+
+    parser_flowfield = subparsers.add_parser('flowfield', help=benchmark_flowfield.__doc__.strip())
+    parser_flowfield.add_argument('--map-sizes', type=int, nargs='*', default=[128, 256], help="sizes of the synthetic maps in tiles")
+    parser_flowfield.add_argument('--no-test-map', action="store_true", help="only use the synthetic maps")
+    parser_flowfield.add_argument('--avatars', type=int, default=1000, help="avatars heading to the target")
+    parser_flowfield.add_argument('--max-paths', type=int, default=100, help="A* paths searched, the others are extrapolated")
+    parser_flowfield.set_defaults(func=benchmark_flowfield)
+
+    parser_crowd = subparsers.add_parser('crowd', help=benchmark_crowd.__doc__.strip())
+    parser_crowd.add_argument('--map', help="map file (default: data/maps/test.tmx)")
+    parser_crowd.add_argument('--avatars', type=int, nargs='+', default=[100, 1000, 10000], help="numbers of avatars")
+    parser_crowd.add_argument('--max-scalar', type=int, default=1000, help="most avatars moved one by one")
+    parser_crowd.add_argument('--ticks', type=int, default=300, help="simulated ticks")
+    parser_crowd.add_argument('--tick-rate', type=float, default=60.0, help="ticks per second")
+    parser_crowd.set_defaults(func=benchmark_crowd)
+
+    parser_layers = subparsers.add_parser('layers', help=benchmark_layers.__doc__.strip())
+    parser_layers.add_argument('--map-size', type=int, default=128, help="map size in tiles")
+    parser_layers.add_argument('--layers', type=int, nargs='+', default=[1, 5, 20], help="numbers of layers")
+    parser_layers.set_defaults(func=benchmark_layers)
+
+    parser_sort = subparsers.add_parser('sort', help=benchmark_sort.__doc__.strip())
+    parser_sort.add_argument('--map-size', type=int, default=256, help="map size in tiles")
+    parser_sort.add_argument('--sprites', type=int, default=5000, help="number of sprites")
+    parser_sort.add_argument('--moving', type=float, nargs='+', default=[0.01, 0.1, 1.0], help="fractions of moving sprites")
+    parser_sort.set_defaults(func=benchmark_sort)
+
+    args = parser.parse_args()
+    init_headless_display()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
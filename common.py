@@ -6,6 +6,7 @@ import sys
 import json
 import math
 import array
+import pygame
 import tiledtmxloader
 
 # This class escapes a string, by replacing control characters by their hexadecimal equivalents
@@ -46,3 +47,15 @@ def special_round(value):
     if value < 0:
         return math.floor(value)
     return math.ceil(value)
+
+def init_headless_display(width=1, height=1):
+    """
+    Initializes pygame without opening a window (SDL dummy video driver), the
+    maps and avatars can be loaded as usual and rendered onto offscreen
+    surfaces. Must be called before the pygame display is initialized.
+
+    :Returns: the display surface, it is never shown.
+    """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    return pygame.display.set_mode((width, height))
@@ -0,0 +1,473 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+
+from avatar import *
+from world import CollisionGrid
+
+#  -----------------------------------------------------------------------------
+
+def round_half_away(values):
+    """
+    Rounds like pygame.Rect does with float coordinates.
+    """
+    return numpy.where(values >= 0, numpy.floor(values + 0.5), numpy.ceil(values - 0.5))
+
+def special_round_array(values):
+    """
+    Vectorized common.special_round.
+    """
+    return numpy.where(values < 0, numpy.floor(values), numpy.ceil(values))
+
+class LevelGrids():
+    """
+    The collision grid of a world level as arrays indexed [tile_y, tile_x]:
+    the BlockIn bits (shared with the grid) and the rects of the tiles.
+    """
+    def __init__(self, world, level):
+        self.world = world
+        self.level = level
+        metadata_layer = world.get_metadata_layer(level).sprite_layer
+        collision_grid = world.get_collision_grid(level)
+        self.tilewidth = metadata_layer.tilewidth
+        self.tileheight = metadata_layer.tileheight
+        shape = (collision_grid.num_tiles_y, collision_grid.num_tiles_x)
+        self.block_in = numpy.frombuffer(collision_grid.masks, numpy.uint8).reshape(shape)
+        self.rect_left = numpy.zeros(shape, numpy.int64)
+        self.rect_top = numpy.zeros(shape, numpy.int64)
+        self.rect_right = numpy.zeros(shape, numpy.int64)
+        self.rect_bottom = numpy.zeros(shape, numpy.int64)
+        for idx, rect in enumerate(collision_grid.rects):
+            if rect is not None:
+                tile_y, tile_x = divmod(idx, collision_grid.num_tiles_x)
+                self.rect_left[tile_y, tile_x], self.rect_top[tile_y, tile_x], \
+                    self.rect_right[tile_y, tile_x], self.rect_bottom[tile_y, tile_x] = rect
+
+    def get_tile_indices(self, pos_x, pos_y):
+        """
+        Tile indices of world positions, negative ones wrap around like list
+        indices do.
+        """
+        num_tiles_y, num_tiles_x = self.block_in.shape
+        tile_x = numpy.floor_divide(pos_x, self.tilewidth).astype(numpy.int64)
+        tile_y = numpy.floor_divide(pos_y, self.tileheight).astype(numpy.int64)
+        return tile_x, tile_y, tile_x % num_tiles_x, tile_y % num_tiles_y
+
+    def get_blocked_steps(self, pos_x, pos_y, width, height, step_x, step_y):
+        """
+        Vectorized Avatar.check_collision: which steps in x and y direction
+        are blocked by the neighbour tiles.
+        """
+        left = round_half_away(pos_x).astype(numpy.int64) - width // 2
+        top = round_half_away(pos_y).astype(numpy.int64) - height
+        right = left + width
+        bottom = top + height
+        step_x = special_round_array(step_x).astype(numpy.int64)
+        step_y = special_round_array(step_y).astype(numpy.int64)
+        num_tiles_y, num_tiles_x = self.block_in.shape
+        tile_x, tile_y, idx_x, idx_y = self.get_tile_indices(pos_x, pos_y)
+        blocked_x = numpy.zeros(len(pos_x), bool)
+        blocked_y = numpy.zeros(len(pos_x), bool)
+        for dir_x, dir_y, mask in CollisionGrid.NEIGHBOURS:
+            cell_x = (idx_x + dir_x) % num_tiles_x
+            cell_y = (idx_y + dir_y) % num_tiles_y
+            blocks = (self.block_in[cell_y, cell_x] & mask) != 0
+            if not blocks.any():
+                continue
+            rect_left = self.rect_left[cell_y, cell_x]
+            rect_top = self.rect_top[cell_y, cell_x]
+            rect_right = self.rect_right[cell_y, cell_x]
+            rect_bottom = self.rect_bottom[cell_y, cell_x]
+            # like pygame.Rect.colliderect
+            blocked_x |= blocks & (left + step_x < rect_right) & (right + step_x > rect_left) & \
+                         (top < rect_bottom) & (bottom > rect_top)
+            blocked_y |= blocks & (left < rect_right) & (right > rect_left) & \
+                         (top + step_y < rect_bottom) & (bottom + step_y > rect_top)
+        return blocked_x, blocked_y
+
+    def get_swept_steps(self, pos_x, pos_y, width, height, step_x, step_y):
+        """
+        The steps of half a tile or more, swept one by one like in
+        Avatar.check_collision.
+
+        :Returns: the indices of the swept steps and their steps in x and y
+                  direction.
+        """
+        swept = numpy.nonzero((numpy.abs(step_x) >= self.tilewidth // 2) | (numpy.abs(step_y) >= self.tileheight // 2))[0]
+        swept_x = numpy.zeros(len(swept))
+        swept_y = numpy.zeros(len(swept))
+        collision_grid = self.world.get_collision_grid(self.level)
+        for idx, avatar_idx in enumerate(swept.tolist()):
+            avatar_left = pos_x[avatar_idx] - width[avatar_idx] / 2.0
+            swept_x[idx], swept_y[idx] = collision_grid.get_swept_step(
+                avatar_left, pos_y[avatar_idx] - height, avatar_left + width[avatar_idx], pos_y[avatar_idx],
+                step_x[avatar_idx], step_y[avatar_idx])
+        return swept, swept_x, swept_y
+
+#  -----------------------------------------------------------------------------
+
+class Crowd():
+    """
+    Moves many avatars at once: their state is kept in arrays (struct of
+    arrays, e.g. crowd.pos_x[idx]) and a tick does the collisions, the
+    movement, the animation frame and the height of all of them in
+    vectorized passes, with the same results as Avatar.try_to_move.
+
+    Set the steps of the next tick in step_x and step_y. The avatars are
+    AvatarViews of the arrays, call sync_sprites before rendering them.
+
+    Example::
+
+        crowd = Crowd(world)
+        avatars = [crowd.add(x, y, spritesheet) for x, y in positions]
+        while running:
+            crowd.step_x[:] = ...
+            crowd.tick()
+            crowd.sync_sprites(alpha)
+            render()
+    """
+    # (name, type) of the arrays, prev_* is the state of the previous tick
+    ARRAYS = [
+        ('pos_x', numpy.float64), ('pos_y', numpy.float64), ('z', numpy.float64),
+        ('layer', numpy.int64),
+        ('prev_pos_x', numpy.float64), ('prev_pos_y', numpy.float64), ('prev_z', numpy.float64),
+        ('prev_layer', numpy.int64),
+        ('step_x', numpy.float64), ('step_y', numpy.float64),
+        ('distance', numpy.float64), ('dir_id', numpy.int64), ('move_id', numpy.int64),
+        ('tile_x', numpy.int64), ('tile_y', numpy.int64),
+        ('width', numpy.int64),
+    ]
+
+    def __init__(self, world, capacity=64, avatar_collisions=True):
+        self.world = world
+        # push the avatars overlapping each other apart after each tick
+        self.avatar_collisions = avatar_collisions
+        self.count = 0
+        self.avatars = []
+        self._level_grids = {}
+        self._arrays = dict((name, numpy.zeros(capacity, dtype)) for name, dtype in self.ARRAYS)
+
+    def __len__(self):
+        return self.count
+
+    def get_level_grids(self, level):
+        grids = self._level_grids.get(level, None)
+        if grids is None:
+            grids = self._level_grids[level] = LevelGrids(self.world, level)
+        return grids
+
+    def add(self, pos_x, pos_y, spritesheet_filename, id=None, layer=1):
+        """
+        Adds an avatar to the crowd and to the world.
+
+        :Returns: the AvatarView of the new avatar.
+        """
+        capacity = len(self._arrays['pos_x'])
+        if self.count == capacity:
+            for name, values in self._arrays.items():
+                self._arrays[name] = numpy.concatenate([values, numpy.zeros(capacity, values.dtype)])
+        idx = self.count
+        self.count += 1
+        avatar = AvatarView(self, idx, pos_x, pos_y, spritesheet_filename, id, self.world.headless)
+        avatar.layer = layer
+        avatar.prev_state = avatar.state
+        self._arrays['width'][idx] = avatar.rect.width
+        self.avatars.append(avatar)
+        self.world.add_avatar(avatar)
+        avatar.add_to_sprite_layer(self.world.get_avatar_layer(layer).sprite_layer)
+        avatar.sprite_level = layer
+        return avatar
+
+    def _get_levels(self, layer, indices=None):
+        """
+        Yields the grids of the levels and the indices of their avatars.
+        """
+        if indices is None:
+            indices = numpy.arange(len(layer))
+        levels = numpy.unique(layer[indices])
+        for level in levels:
+            on_level = indices if len(levels) == 1 else indices[layer[indices] == level]
+            yield self.get_level_grids(int(level)), on_level
+
+    def get_avatar_pairs(self):
+        """
+        Broadphase of the avatar collisions: the pairs of avatars of the same
+        level in the same or next cells of a grid with cells as large as the
+        widest feet box, so only these can overlap.
+
+        :Returns: arrays idx_a, idx_b of the pairs, idx_a < idx_b, sorted.
+        """
+        pairs_a = []
+        pairs_b = []
+        if not self.count:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+        cell_width = max(int(self.width.max()), 1)
+        for grids, on_level in self._get_levels(self.layer):
+            cell_x = numpy.floor_divide(self.pos_x[on_level], cell_width).astype(numpy.int64)
+            cell_y = numpy.floor_divide(self.pos_y[on_level], Avatar.COLLISION_HEIGHT).astype(numpy.int64)
+            # a key per cell, with room for the next cells
+            row_length = cell_x.max() - cell_x.min() + 3
+            keys = (cell_y - cell_y.min() + 1) * row_length + (cell_x - cell_x.min() + 1)
+            order = numpy.argsort(keys, kind='stable')
+            sorted_keys = keys[order]
+            for offset_x, offset_y in ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+                # the avatars of the cell at the offset, the other half of the
+                # next cells finds the same pairs
+                next_keys = sorted_keys + (offset_y * row_length + offset_x)
+                first = numpy.searchsorted(sorted_keys, next_keys, 'left')
+                counts = numpy.searchsorted(sorted_keys, next_keys, 'right') - first
+                idx_a = numpy.repeat(order, counts)
+                idx_b = order[numpy.repeat(first - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())]
+                if offset_x == 0 and offset_y == 0:
+                    in_order = idx_a < idx_b
+                    idx_a = idx_a[in_order]
+                    idx_b = idx_b[in_order]
+                pairs_a.append(on_level[idx_a])
+                pairs_b.append(on_level[idx_b])
+        if not pairs_a:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+        pairs_a = numpy.concatenate(pairs_a)
+        pairs_b = numpy.concatenate(pairs_b)
+        idx_a = numpy.minimum(pairs_a, pairs_b)
+        idx_b = numpy.maximum(pairs_a, pairs_b)
+        order = numpy.lexsort((idx_b, idx_a))
+        return idx_a[order], idx_b[order]
+
+    def get_avatar_pushes(self):
+        """
+        Narrowphase of the avatar collisions, like Avatar.get_push for the
+        pairs of get_avatar_pairs.
+
+        :Returns: arrays push_x, push_y of the sums of the steps moving the
+                  avatars out of each other, number of overlapping pairs.
+        """
+        idx_a, idx_b = self.get_avatar_pairs()
+        pos_x, pos_y = self.pos_x, self.pos_y
+        dist_x = pos_x[idx_a] - pos_x[idx_b]
+        dist_y = pos_y[idx_a] - pos_y[idx_b]
+        overlap_x = (self.width[idx_a] + self.width[idx_b]) / 2.0 - numpy.abs(dist_x)
+        overlap_y = Avatar.COLLISION_HEIGHT - numpy.abs(dist_y)
+        overlapping = (overlap_x > 0) & (overlap_y > 0)
+        along_x = overlap_x < overlap_y
+        push_x = numpy.where(overlapping & along_x, numpy.where(dist_x >= 0, overlap_x, -overlap_x) / 2.0, 0.0)
+        push_y = numpy.where(overlapping & ~along_x, numpy.where(dist_y >= 0, overlap_y, -overlap_y) / 2.0, 0.0)
+        # summed in the order of the pairs, like World.resolve_avatar_collisions
+        indices = numpy.stack((idx_a, idx_b), 1).ravel()
+        pushes_x = numpy.zeros(self.count)
+        pushes_y = numpy.zeros(self.count)
+        numpy.add.at(pushes_x, indices, numpy.stack((push_x, -push_x), 1).ravel())
+        numpy.add.at(pushes_y, indices, numpy.stack((push_y, -push_y), 1).ravel())
+        return pushes_x, pushes_y, int(numpy.count_nonzero(overlapping))
+
+    def tick(self):
+        """
+        Moves all the avatars by their steps, like Avatar.try_to_move, and
+        pushes the avatars overlapping each other apart if avatar_collisions
+        is set, like World.resolve_avatar_collisions.
+        """
+        count = self.count
+        if not count:
+            return
+        pos_x, pos_y, z, layer = self.pos_x, self.pos_y, self.z, self.layer
+        self.prev_pos_x[:] = pos_x
+        self.prev_pos_y[:] = pos_y
+        self.prev_z[:] = z
+        self.prev_layer[:] = layer
+
+        step_x, step_y = self._collide(self.step_x, self.step_y)
+
+        # animation and direction
+        distance = self.distance
+        distance += numpy.sqrt(step_x * step_x + step_y * step_y)
+        move_id = (distance / 10.).astype(numpy.int64) % NUM_MOVES
+        abs_x = numpy.abs(step_x)
+        abs_y = numpy.abs(step_y)
+        dir_id = self.dir_id
+        east_west = (dir_id == DIRID_EAST) | (dir_id == DIRID_WEST)
+        diagonal_dir_id = numpy.select(
+            [(step_x > 0) & east_west, (step_x < 0) & east_west, step_y < 0],
+            [DIRID_EAST, DIRID_WEST, DIRID_NORTH], DIRID_SOUTH)
+        standing = (step_x == 0) & (step_y == 0)
+        dir_id[:] = numpy.select(
+            [standing, abs_x == abs_y, abs_x > abs_y],
+            [dir_id, diagonal_dir_id, numpy.where(step_x >= 0, DIRID_EAST, DIRID_WEST)],
+            numpy.where(step_y >= 0, DIRID_SOUTH, DIRID_NORTH))
+        move_id[standing] = MOVEID_STAND
+        self.move_id[:] = move_id
+
+        self._move(step_x, step_y)
+        if self.avatar_collisions:
+            push_x, push_y, num_overlaps = self.get_avatar_pushes()
+            if num_overlaps:
+                self._move(*self._collide(push_x, push_y))
+
+        for grids, on_level in self._get_levels(layer):
+            tile_x, tile_y, idx_x, idx_y = grids.get_tile_indices(pos_x[on_level], pos_y[on_level])
+            self.tile_x[on_level] = tile_x
+            self.tile_y[on_level] = tile_y
+
+        # the spatial hashes of the world, only for the avatars leaving their
+        # cell
+        moved = layer != self.prev_layer
+        for grids, on_level in self._get_levels(layer):
+            spatial_hash = self.world.get_spatial_hash(grids.level)
+            for values, prev_values, cell_size in ((pos_x, self.prev_pos_x, spatial_hash.cell_width),
+                                                   (pos_y, self.prev_pos_y, spatial_hash.cell_height)):
+                moved[on_level] |= numpy.floor_divide(values[on_level], cell_size) != \
+                                   numpy.floor_divide(prev_values[on_level], cell_size)
+        for idx in numpy.nonzero(moved)[0].tolist():
+            self.world.update_avatar_position(self.avatars[idx])
+
+        # the triggers of the world, only for the avatars in or coming from a
+        # cell with triggers
+        candidates = layer != self.prev_layer
+        for grids, on_level in self._get_levels(layer):
+            trigger_grid = self.world.trigger_grids.get(grids.level, None)
+            if not trigger_grid:
+                continue
+            cell_keys = trigger_grid.get_cell_keys()
+            for values_x, values_y in ((pos_x, pos_y), (self.prev_pos_x, self.prev_pos_y)):
+                keys = numpy.floor_divide(values_x[on_level], trigger_grid.cell_width).astype(numpy.int64) * 2**32 + \
+                       numpy.floor_divide(values_y[on_level], trigger_grid.cell_height).astype(numpy.int64)
+                candidates[on_level] |= numpy.isin(keys, cell_keys)
+        for idx in numpy.nonzero(candidates)[0].tolist():
+            self.world.update_avatar_triggers(self.avatars[idx])
+
+    def _collide(self, step_x, step_y):
+        """
+        :Returns: copies of the steps, 0 where the tiles block them.
+        """
+        step_x = step_x.copy()
+        step_y = step_y.copy()
+        pos_x, pos_y, width = self.pos_x, self.pos_y, self.width
+        for grids, on_level in self._get_levels(self.layer):
+            args = (pos_x[on_level], pos_y[on_level], width[on_level], int(Avatar.COLLISION_HEIGHT),
+                    step_x[on_level], step_y[on_level])
+            blocked_x, blocked_y = grids.get_blocked_steps(*args)
+            swept, swept_x, swept_y = grids.get_swept_steps(*args)
+            step_x[on_level[blocked_x]] = 0.0
+            step_y[on_level[blocked_y]] = 0.0
+            step_x[on_level[swept]] = swept_x
+            step_y[on_level[swept]] = swept_y
+        return step_x, step_y
+
+    def _move(self, step_x, step_y):
+        """
+        Adds the steps to the positions, the avatars go up or down a level
+        like in Avatar.execute_move.
+        """
+        pos_x, pos_y, z, layer = self.pos_x, self.pos_y, self.z, self.layer
+        pos_x += step_x
+        pos_y += step_y
+
+        # height, going up or down a level
+        map_pos_offset_y = Avatar.COLLISION_HEIGHT / 2.0
+        for grids, on_level in self._get_levels(layer):
+            z[on_level] = self.world.sample_height(pos_x[on_level], pos_y[on_level] - map_pos_offset_y, grids.level)
+        up = z >= self.world.VPIXELS_PER_LAYER
+        down = z < 0
+        changed = numpy.nonzero(up | down)[0]
+        if len(changed):
+            layer[up] += 1
+            layer[down] -= 1
+            pos_y[up] -= self.world.VPIXELS_PER_LAYER
+            pos_y[down] += self.world.VPIXELS_PER_LAYER
+            for grids, on_level in self._get_levels(layer, changed):
+                z[on_level] = self.world.sample_height(pos_x[on_level], pos_y[on_level] - map_pos_offset_y, grids.level)
+
+    def sync_sprites(self, alpha=1.0):
+        """
+        Updates the images, rects, z and sprite layers of the avatars for
+        rendering, between the previous (alpha 0.0) and the last tick (1.0)
+        like Avatar.interpolate.
+        """
+        count = self.count
+        # no interpolation between layer levels
+        alpha = numpy.where(self.prev_layer == self.layer, alpha, 1.0)
+        pos_x = (self.prev_pos_x + (self.pos_x - self.prev_pos_x) * alpha).tolist()
+        pos_y = (self.prev_pos_y + (self.pos_y - self.prev_pos_y) * alpha).tolist()
+        z = (self.prev_z + (self.z - self.prev_z) * alpha).tolist()
+        layer = self.layer.tolist()
+        image_ids = (self.move_id | self.dir_id).tolist()
+        for idx, avatar in enumerate(self.avatars):
+            avatar.sync_sprite(self.world, pos_x[idx], pos_y[idx], z[idx], layer[idx], image_ids[idx])
+
+def _make_array_property(name):
+    # the used part of an array
+    def get_values(self):
+        return self._arrays[name][:self.count]
+
+    def set_values(self, values):
+        self._arrays[name][:self.count] = values
+
+    return property(get_values, set_values)
+
+for _name, _dtype in Crowd.ARRAYS:
+    setattr(Crowd, _name, _make_array_property(_name))
+
+#  -----------------------------------------------------------------------------
+
+class AvatarView(Avatar):
+    """
+    An avatar whose state is an entry in the arrays of a Crowd, it can be used
+    like any other Avatar.
+    """
+    def __init__(self, crowd, idx, start_pos_x, start_pos_y, spritesheet_filename, id=None, headless=False):
+        self.crowd = crowd
+        self.idx = idx
+        self.sprite_level = None
+        super().__init__(start_pos_x, start_pos_y, spritesheet_filename, id, headless)
+
+    # the crowd keeps the states of the ticks
+    def begin_tick(self):
+        pass
+
+    def end_tick(self):
+        pass
+
+    @property
+    def state(self):
+        return (self.pos_x, self.pos_y, self.z, self.layer)
+
+    @state.setter
+    def state(self, state):
+        self.pos_x, self.pos_y, self.z, self.layer = state
+
+    @property
+    def prev_state(self):
+        arrays = self.crowd._arrays
+        idx = self.idx
+        return (arrays['prev_pos_x'][idx].item(), arrays['prev_pos_y'][idx].item(),
+                arrays['prev_z'][idx].item(), arrays['prev_layer'][idx].item())
+
+    @prev_state.setter
+    def prev_state(self, state):
+        arrays = self.crowd._arrays
+        idx = self.idx
+        arrays['prev_pos_x'][idx], arrays['prev_pos_y'][idx], arrays['prev_z'][idx], arrays['prev_layer'][idx] = state
+
+    def sync_sprite(self, world, pos_x, pos_y, z, layer, image_id):
+        if self.sprite_level != layer:
+            self.move_to_layer_level(world, layer)
+            self.sprite_level = layer
+        if self.images:
+            self.image = self.images[image_id]
+            self.rect = self.image.get_rect()
+        self.rect.midbottom = (pos_x, pos_y)
+        self.z = z
+        for sprite_layer in self.sprite_layers:
+            sprite_layer.update_sprite(self)
+
+def _make_value_property(name):
+    # an entry of an array of the crowd (None is stored as 0)
+    def get_value(self):
+        return self.crowd._arrays[name][self.idx].item()
+
+    def set_value(self, value):
+        self.crowd._arrays[name][self.idx] = 0 if value is None else value
+
+    return property(get_value, set_value)
+
+for _name in ('pos_x', 'pos_y', 'z', 'layer', 'distance', 'dir_id', 'move_id', 'tile_x', 'tile_y'):
+    setattr(AvatarView, _name, _make_value_property(_name))
@@ -5,12 +5,16 @@ import os
 import sys
 import json
 import math
+import time
 import argparse
 import pygame
 import tiledtmxloader
 
 from avatar import Avatar, Hero, create_hero_avatar
 from world import World
+from profiler import FrameProfiler, SamplingProfiler
+from replay import InputRecording, get_pressed_keys, get_directions, get_state_hash
+from scheduler import SimulationScheduler
 from common import *
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -23,6 +27,17 @@ def main():
     """
     parser = argparse.ArgumentParser(description='World Demo')
     parser.add_argument('-v', '--verbose', action="store_true", help="verbose output" )
+    parser.add_argument('--dirty-rects', action="store_true", help="only redraw and update the changed parts of the screen")
+    parser.add_argument('--scroll-reuse', action="store_true", help="keep the static layers rendered and only draw the tiles uncovered by scrolling")
+    parser.add_argument('--max-fps', type=int, default=0, help="limit the frame rate (default: no limit)")
+    parser.add_argument('--tick-rate', type=float, default=60.0, help="simulation ticks per second (default: 60)")
+    parser.add_argument('--max-catch-up', type=int, default=5, help="most simulation ticks per frame, the simulation slows down beyond (default: 5)")
+    parser.add_argument('--hud', action="store_true", help="show the frame times (toggle with h, t writes a Chrome trace)")
+    parser.add_argument('--profile', metavar='FILE', help="sample the loading and the first frames, write the collapsed stacks (flamegraph) to FILE")
+    parser.add_argument('--profile-frames', type=int, default=600, help="number of frames to sample with --profile (default: 600)")
+    parser.add_argument('--record', metavar='FILE', help="record the input of the frames to FILE (see replay.InputRecording)")
+    parser.add_argument('--replay', metavar='FILE', help="play the input recorded in FILE again, checking the state of each frame")
+    parser.add_argument('--headless', action="store_true", help="with --replay: no window, as fast as possible")
     args = parser.parse_args()
 
     if args.verbose:
@@ -30,99 +45,325 @@ def main():
     else:
         print("~ Not so verbose")
 
+    if args.replay and args.headless:
+        recording = InputRecording.load(args.replay)
+        frame_times, first_difference = replay_headless(recording)
+        print("~ Replayed {} frames in {:.1f} ms ({:.3f} ms per frame)".format(
+            len(frame_times), 1e3 * sum(frame_times), 1e3 * sum(frame_times) / max(1, len(frame_times))))
+        if first_difference is not None:
+            print("~ Different state from frame", first_difference)
+            return 1
+        return 0
+
     path_to_map = os.path.join(os.path.dirname(__file__), 'data', 'maps', 'world.tmx')
-    demo_pygame(path_to_map)
+    demo_pygame(path_to_map, dirty_rects=args.dirty_rects, scroll_reuse=args.scroll_reuse, max_fps=args.max_fps,
+                tick_rate=args.tick_rate, max_catch_up=args.max_catch_up, show_hud=args.hud,
+                profile_file=args.profile, profile_frames=args.profile_frames,
+                record_file=args.record, replay_file=args.replay)
+    return 0
 
 #  -----------------------------------------------------------------------------
 
-def demo_pygame(file_name):
-    """
-    Example showing how to use the paralax scrolling feature.
+def create_demo_world(file_name, screen_width_px=1024, screen_height_px=768, headless=False):
     """
+    Loads the world of the demo and places its hero.
 
-    # init pygame and set up a screen
-    pygame.init()
-    pygame.display.set_caption("tiledtmxloader - " + file_name + " - keys: arrows, 0-9")
-    screen_width_px = 1024
-    screen_height_px = 768
-    screen = pygame.display.set_mode((screen_width_px, screen_height_px), pygame.DOUBLEBUF, 32)
-
-    world = World(tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name))
+    :Returns: world, hero
+    """
+    world = World(tiledtmxloader.tmxreader.TileMapParser().parse_decode(file_name), headless=headless)
 
     # create hero sprite
     # use floats for hero position
     hero_pos_x_px = screen_width_px
     hero_pos_y_px = screen_height_px
-    hero = create_hero_avatar(hero_pos_x_px, hero_pos_y_px, 'ch_01_00.png')
+    hero = create_hero_avatar(hero_pos_x_px, hero_pos_y_px, 'ch_01_00.png', headless=headless)
     world.add_avatar(hero)
 
-    # cam_offset is for scrolling
-    cam_world_pos_x_px = hero.rect.centerx
-    cam_world_pos_y_px = hero.rect.centery
+    if world.renderer:
+        # cam_offset is for scrolling
+        cam_world_pos_x_px = hero.rect.centerx
+        cam_world_pos_y_px = hero.rect.centery
 
-    # set initial cam position and size
-    world.renderer.set_camera_position_and_size(cam_world_pos_x_px, cam_world_pos_y_px, screen_width_px, screen_height_px)
+        # set initial cam position and size
+        world.renderer.set_camera_position_and_size(cam_world_pos_x_px, cam_world_pos_y_px, screen_width_px, screen_height_px)
 
     # add the hero the the right layer, it can be changed using 0-9 keys
     hero.add_to_sprite_layer(world.get_avatar_layer(hero.layer).sprite_layer)
+    return world, hero
+
+class DemoSimulation():
+    """
+    The simulation of the demo driven by the input of each frame: the arrow
+    keys move the hero in fixed ticks (tick_rate per second) independent of
+    the frame rate, at most max_catch_up ticks per frame, and the camera
+    follows it. The other avatars are moved by a SimulationScheduler, the
+    ones far from the camera less often (see add_avatar). The same frames
+    give the same states of the world, played live, replayed or headless
+    (see replay.InputRecording).
+    """
+    def __init__(self, world, hero, tick_rate=60.0, max_catch_up=5):
+        self.world = world
+        self.hero = hero
+        self.tick_ms = 1000.0 / tick_rate
+        self.max_catch_up = max_catch_up
+        # time not simulated yet in ms
+        self.accumulator = 0.0
+        self.scheduler = SimulationScheduler(world)
+        for avatar in sorted(world.avatars, key=world.avatar_serials.get):
+            if avatar is not hero:
+                self.add_avatar(avatar)
+
+    def add_avatar(self, avatar, tick=None):
+        """
+        Adds an avatar of the world (not the hero) to the scheduler.
+
+        :Parameters:
+            avatar : Avatar
+                the avatar
+            tick : function
+                Optional, tick(world, delta_time) moving the avatar (see
+                SimulationScheduler.add), defaults to standing still.
+        """
+        if tick is None:
+            tick = lambda world, delta_time: avatar.try_to_move(world, delta_time, 0, 0)
+        self.scheduler.add(avatar, tick)
+
+    def tick(self, dt, keys):
+        """
+        Simulates a frame of dt ms with the keys pressed (see
+        replay.get_pressed_keys), the avatars are drawn between the last two
+        ticks.
+        """
+        world = self.world
+        tick_ms = self.tick_ms
+        direction_x, direction_y = get_directions(keys)
+
+        # make sure the hero moves with same speed in all directions (diagonal!)
+        dir_len = math.hypot(direction_x, direction_y)
+        dir_len = dir_len if dir_len else 1.0
+
+        # update position in fixed ticks, after a long frame (or at a slow
+        # simulation) the missing ticks are done up to max_catch_up
+        speed_x = 0.075 * 2.
+        step_x_px = speed_x * tick_ms * direction_x / dir_len
+        speed_y = 0.053 * 2.
+        step_y_px = speed_y * tick_ms * direction_y / dir_len
+        self.accumulator = min(self.accumulator + dt, self.max_catch_up * tick_ms)
+        while self.accumulator >= tick_ms:
+            world.begin_tick()
+            self.hero.try_to_move(world, tick_ms, step_x_px, step_y_px)
+            self.scheduler.tick(tick_ms)
+            world.resolve_avatar_collisions()
+            world.end_tick()
+            self.accumulator -= tick_ms
+        world.interpolate_avatars(self.accumulator / tick_ms)
+
+    def update_camera(self):
+        """
+        Adjusts the camera according to the hero's position.
+        """
+        hero = self.hero
+        self.world.set_camera_layer_level(hero.layer)
+        self.world.set_camera_position(hero.rect.centerx, hero.rect.centery, hero.z)
+
+def replay_headless(recording, file_name=None):
+    """
+    Plays the input of a recording again in a headless world, as fast as
+    possible, checking the state hash of each frame.
+
+    :Parameters:
+        recording : replay.InputRecording
+            the recording
+        file_name : str
+            Optional, the map, defaults to the map of the recording.
+
+    :Returns: list of the times of the frames in seconds, the index of the
+              first frame whose state is not the recorded one (None if all
+              are).
+    """
+    world, hero = create_demo_world(file_name or recording.map_file_name, headless=True)
+    simulation = DemoSimulation(world, hero, recording.tick_rate, recording.max_catch_up)
+    frame_times = []
+    first_difference = None
+    for idx, (dt, keys, state_hash) in enumerate(recording.frames):
+        start = time.perf_counter()
+        simulation.tick(dt, keys)
+        simulation.update_camera()
+        frame_times.append(time.perf_counter() - start)
+        if first_difference is None and get_state_hash(world) != state_hash:
+            first_difference = idx
+    return frame_times, first_difference
+
+#  -----------------------------------------------------------------------------
+
+def demo_pygame(file_name, dirty_rects=False, scroll_reuse=False, max_fps=0,
+                tick_rate=60.0, max_catch_up=5, show_hud=False,
+                profile_file=None, profile_frames=600,
+                record_file=None, replay_file=None):
+    """
+    Example showing how to use the paralax scrolling feature.
+
+    The world is simulated in fixed ticks (tick_rate per second) independent
+    of the frame rate, at most max_catch_up ticks per frame. The avatars are
+    drawn interpolated between the last two ticks.
+
+    With dirty_rects only the parts of the screen that changed are redrawn
+    and sent to the display (see RendererPygame.render_layers_dirty). With
+    scroll_reuse the static layers are kept rendered between frames (see
+    RendererPygame.render_layers_scroll_reuse). With show_hud the frame times
+    are shown (see profiler.FrameProfiler), the keys toggle it (h) and write
+    the last frames as a Chrome trace (t). With profile_file the loading and
+    the first profile_frames frames are sampled (see
+    profiler.SamplingProfiler).
+
+    With record_file the input of the frames is written to the file when the
+    demo ends (see replay.InputRecording), with replay_file the recorded
+    input is played again instead of the keys and the frame times, the run
+    ends after the last frame.
+    """
+
+    # init pygame and set up a screen
+    pygame.init()
+    pygame.display.set_caption("tiledtmxloader - " + file_name + " - keys: arrows, 0-9, h: hud, t: trace")
+    screen_width_px = 1024
+    screen_height_px = 768
+    screen = pygame.display.set_mode((screen_width_px, screen_height_px), pygame.DOUBLEBUF, 32)
+
+    sampler = None
+    if profile_file:
+        sampler = SamplingProfiler()
+        sampler.start()
+
+    replay = None
+    if replay_file:
+        replay = InputRecording.load(replay_file)
+        tick_rate, max_catch_up = replay.tick_rate, replay.max_catch_up
+    recording = None
+    if record_file:
+        recording = InputRecording(file_name, tick_rate, max_catch_up)
+
+    world, hero = create_demo_world(file_name, screen_width_px, screen_height_px)
+    simulation = DemoSimulation(world, hero, tick_rate, max_catch_up)
 
     # variables for the main loop
     clock = pygame.time.Clock()
     running = True
     # set up timer for fps printing
     pygame.time.set_timer(pygame.USEREVENT, 1000)
+    # cpu usage of this process since the last fps printing
+    cpu_time = time.process_time()
+    wall_time = time.perf_counter()
+    # debug boxes drawn in the last frame, they have to be erased
+    overlay_rects = []
+
+    # time spent in the parts of each frame, the limiter sleep is left out
+    profiler = FrameProfiler()
+    world.renderer.profile_scope = profiler.scope
 
     # mainloop
+    num_frames = 0
+    first_difference = None
     while running:
-        dt = clock.tick()
-
-        # event handling
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            elif event.type == pygame.USEREVENT:
-                print("fps: ", clock.get_fps())
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    running = False
+        dt = clock.tick(max_fps)
+        profiler.begin_frame()
 
-        # find directions
-        direction_x = pygame.key.get_pressed()[pygame.K_RIGHT] - pygame.key.get_pressed()[pygame.K_LEFT]
-        direction_y = pygame.key.get_pressed()[pygame.K_DOWN] - pygame.key.get_pressed()[pygame.K_UP]
+        with profiler.scope('input'):
+            # event handling
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+                elif event.type == pygame.USEREVENT:
+                    new_cpu_time = time.process_time()
+                    new_wall_time = time.perf_counter()
+                    print("fps: ", clock.get_fps(), "cpu: {:.1f}%".format(
+                        100.0 * (new_cpu_time - cpu_time) / (new_wall_time - wall_time)))
+                    cpu_time = new_cpu_time
+                    wall_time = new_wall_time
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        running = False
+                    elif event.key == pygame.K_h:
+                        show_hud = not show_hud
+                        world.renderer.invalidate()
+                    elif event.key == pygame.K_t:
+                        trace_file_name = 'frame_trace_{}.json'.format(time.strftime('%Y%m%d_%H%M%S'))
+                        profiler.dump_chrome_trace(trace_file_name)
+                        print("~ Written", trace_file_name)
 
-        # make sure the hero moves with same speed in all directions (diagonal!)
-        dir_len = math.hypot(direction_x, direction_y)
-        dir_len = dir_len if dir_len else 1.0
+            # find directions, or replay them with the frame time
+            if replay is not None:
+                dt, keys, state_hash = replay.frames[num_frames]
+            else:
+                keys = get_pressed_keys()
 
-        # update position
-        speed_x = 0.075 * 2.
-        step_x_px = speed_x * dt * direction_x / dir_len
-        speed_y = 0.053 * 2.
-        step_y_px = speed_y * dt * direction_y / dir_len
-        hero.try_to_move(world, dt, step_x_px, step_y_px)
+        with profiler.scope('try_to_move'):
+            simulation.tick(dt, keys)
 
         # adjust camera according to the hero's position
-        world.set_camera_layer_level(hero.layer)
-        world.set_camera_position(hero.rect.centerx, hero.rect.centery, hero.z)
-
-        # clear screen, might be left out if every pixel is redrawn anyway
-        screen.fill((0, 0, 0))
-
-        # render the map
-        for sprite_layer in world.all_sprite_layers:
-            if sprite_layer.is_object_group:
-                # we dont draw the object group layers
-                # you should filter them out if not needed
-                continue
-            else:
-                world.renderer.render_layer(screen, sprite_layer)
+        with profiler.scope('camera'):
+            simulation.update_camera()
+
+        if recording is not None:
+            recording.add_frame(dt, keys, get_state_hash(world))
+        elif replay is not None and first_difference is None and get_state_hash(world) != state_hash:
+            first_difference = num_frames
+            print("~ Different state from frame", first_difference)
+
+        if dirty_rects:
+            # erase the boxes of the last frame and redraw what changed
+            for rect in overlay_rects:
+                world.renderer.invalidate(rect)
+            with profiler.scope('render'):
+                changed_rects = world.renderer.render_layers_dirty(screen, world.all_sprite_layers)
+            with profiler.scope('draw_avatar_boxes'):
+                overlay_rects = world.draw_avatar_boxes(screen)
+            if show_hud:
+                overlay_rects.append(profiler.draw_hud(screen))
+            with profiler.scope('flip'):
+                pygame.display.update(changed_rects + overlay_rects)
+        elif scroll_reuse:
+            with profiler.scope('render'):
+                world.renderer.render_layers_scroll_reuse(screen, world.all_sprite_layers)
+            with profiler.scope('draw_avatar_boxes'):
+                world.draw_avatar_boxes(screen)
+            if show_hud:
+                profiler.draw_hud(screen)
+            with profiler.scope('flip'):
+                pygame.display.flip()
+        else:
+            with profiler.scope('render'):
+                # clear screen, might be left out if every pixel is redrawn anyway
+                screen.fill((0, 0, 0))
+
+                # render the map, the object group layers are skipped
+                world.renderer.render_layers(screen, world.all_sprite_layers)
+
+            with profiler.scope('draw_avatar_boxes'):
+                world.draw_avatar_boxes(screen)
+
+            if show_hud:
+                profiler.draw_hud(screen)
+
+            with profiler.scope('flip'):
+                pygame.display.flip()
 
+        profiler.end_frame()
 
-        world.draw_avatar_boxes(screen)
+        num_frames += 1
+        if replay is not None and num_frames >= len(replay):
+            running = False
+        if sampler and (num_frames >= profile_frames or not running):
+            sampler.stop()
+            sampler.write_collapsed(profile_file)
+            sampler.print_summary()
+            print("~ Written", profile_file)
+            sampler = None
 
-        pygame.display.flip()
+    if recording is not None:
+        recording.save(record_file)
+        print("~ Written", record_file, "({} frames)".format(len(recording)))
 
 #  -----------------------------------------------------------------------------
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
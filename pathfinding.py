@@ -0,0 +1,1104 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import math
+import zlib
+import heapq
+import threading
+import collections
+import concurrent.futures
+import numpy
+
+from avatar import Avatar
+from world import CollisionGrid
+
+INFINITY = float('inf')
+
+#  -----------------------------------------------------------------------------
+
+class NavGrid():
+    """
+    The walkable tiles of all levels of a world in flat arrays, a tile is a
+    node with the index level_base + tile_y * num_tiles_x + tile_x. Like for
+    the avatars, a tile is walkable if its metadata has no BlockIn edges (see
+    CollisionGrid.is_walkable), tiles without metadata are flat and walkable.
+    The feet of an avatar walking diagonally may cross the corners of the
+    tiles beside, which block it with all their edges then (the (0, 0)
+    neighbour of CollisionGrid.NEIGHBOURS).
+
+    The avatars change the level where the height leaves 0 to
+    VPIXELS_PER_LAYER (see Avatar.execute_move): the straight edges from or
+    to tiles whose planes reach these heights are followed like an avatar
+    walking from one tile center to the other, see follow_edge.
+    """
+    # (dir_x, dir_y) of the 8 neighbours
+    DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1)]
+    # points an edge with level changes is checked at
+    EDGE_SAMPLES = 8
+
+    def __init__(self, world, avatar_width=None):
+        self.world = world
+        self.levels = sorted(level for level, world_level in world.world_layers.items() if world_level.collision_grid)
+        collision_grid = world.get_collision_grid(self.levels[0])
+        self.num_tiles_x = collision_grid.num_tiles_x
+        self.num_tiles_y = collision_grid.num_tiles_y
+        self.tilewidth = collision_grid.tilewidth
+        self.tileheight = collision_grid.tileheight
+        # width of the collision box of the avatars
+        self.avatar_width = avatar_width or self.tilewidth
+        self.tiles_per_level = self.num_tiles_x * self.num_tiles_y
+        self.level_bases = dict((level, idx * self.tiles_per_level) for idx, level in enumerate(self.levels))
+        self.walkable = bytearray(len(self.levels) * self.tiles_per_level)
+        # tiles where the height can leave the range of their level
+        self.level_changing = bytearray(len(self.walkable))
+        self.edge_costs = [math.hypot(dir_x * self.tilewidth, dir_y * self.tileheight) for dir_x, dir_y in self.DIRECTIONS]
+        self._edges = {}  # {(node, direction index): node or -1} of the followed edges
+        self._neighbour_bits = dict(((dir_x, dir_y), bits) for dir_x, dir_y, bits in CollisionGrid.NEIGHBOURS)
+        self._components = None
+        # position of the nodes on the ground in tiles (see get_heuristic)
+        self.ground_x = list(range(self.num_tiles_x)) * (self.num_tiles_y * len(self.levels))
+        self.ground_y = []
+        for level in self.levels:
+            level_y = level * world.VPIXELS_PER_LAYER / float(self.tileheight)
+            for tile_y in range(self.num_tiles_y):
+                self.ground_y.extend([tile_y + level_y] * self.num_tiles_x)
+        for level in self.levels:
+            self.update_level(level)
+
+    def update_level(self, level):
+        """
+        Reads the walkable and level changing tiles of a level again.
+        """
+        base = self.level_bases[level]
+        size = self.tiles_per_level
+        self.walkable[base:base + size] = self.world.get_collision_grid(level).get_walkable()
+
+        heightfield = self.world.get_heightfield(level)
+        spread = (numpy.abs(heightfield.x_slope) + numpy.abs(heightfield.y_slope)) / 2.0
+        level_changing = heightfield.has_height & \
+            ((heightfield.height - spread < 0) | (heightfield.height + spread >= self.world.VPIXELS_PER_LAYER))
+        self.level_changing[base:base + size] = level_changing.astype(numpy.uint8).tobytes()
+        self._edges.clear()
+        self._components = None
+
+    def update_tile(self, level, tile_x, tile_y):
+        """
+        Reads a tile again after it changed (see World.update_metadata_tile).
+        """
+        node = self.get_node(level, tile_x, tile_y)
+        world_level = self.world.world_layers[level]
+        was_walkable = self.walkable[node]
+        was_level_changing = self.level_changing[node]
+        self.walkable[node] = world_level.collision_grid.is_walkable(tile_x, tile_y)
+        heightfield = world_level.heightfield
+        height = heightfield.height[tile_y, tile_x].item()
+        spread = (abs(heightfield.x_slope[tile_y, tile_x].item()) + abs(heightfield.y_slope[tile_y, tile_x].item())) / 2.0
+        self.level_changing[node] = bool(heightfield.has_height[tile_y, tile_x]) and \
+            (height - spread < 0 or height + spread >= self.world.VPIXELS_PER_LAYER)
+        self._edges.clear()
+        if not (was_walkable and not self.walkable[node] and was_level_changing == self.level_changing[node]):
+            # a blocked tile only removes edges, the groups of nodes it may
+            # split stay a valid test (see get_components)
+            self._components = None
+
+    def get_node(self, level, tile_x, tile_y):
+        return self.level_bases[level] + tile_y * self.num_tiles_x + tile_x
+
+    def get_tile(self, node):
+        """
+        :Returns: tuple (level, tile_x, tile_y) of a node.
+        """
+        level_idx, idx = divmod(node, self.tiles_per_level)
+        tile_y, tile_x = divmod(idx, self.num_tiles_x)
+        return self.levels[level_idx], tile_x, tile_y
+
+    def get_tile_center(self, tile_x, tile_y):
+        return (tile_x + 0.5) * self.tilewidth, (tile_y + 0.5) * self.tileheight
+
+    def get_neighbours(self, node):
+        """
+        Yields (neighbour node, cost) of the neighbours an avatar can walk to
+        from a node.
+        """
+        walkable = self.walkable
+        level_changing = self.level_changing
+        num_tiles_x = self.num_tiles_x
+        tile_y, tile_x = divmod(node % self.tiles_per_level, num_tiles_x)
+        for direction, (dir_x, dir_y) in enumerate(self.DIRECTIONS):
+            next_x = tile_x + dir_x
+            next_y = tile_y + dir_y
+            if not (0 <= next_x < num_tiles_x and 0 <= next_y < self.num_tiles_y):
+                continue
+            next_node = node + dir_y * num_tiles_x + dir_x
+            if dir_x and dir_y:
+                # diagonal moves only between walkable tiles staying on their
+                # level, cutting the corners of the others depends on the
+                # exact way of the avatar
+                side_x = node + dir_x
+                side_y = node + dir_y * num_tiles_x
+                if not (walkable[next_node] and walkable[side_x] and walkable[side_y]) or \
+                   level_changing[node] or level_changing[next_node] or \
+                   level_changing[side_x] or level_changing[side_y]:
+                    continue
+            elif level_changing[node] or level_changing[next_node]:
+                next_node = self.follow_edge(node, direction)
+                if next_node < 0:
+                    continue
+            elif not walkable[next_node]:
+                continue
+            yield next_node, self.edge_costs[direction]
+
+    def _is_box_blocked(self, level, tile_x, tile_y, pos_x, pos_y):
+        """
+        Like Avatar.check_collision: if the collision box of an avatar on a
+        tile moved to a position overlaps a tile around it blocking it with
+        the edges facing the tile of the avatar (see CollisionGrid).
+        """
+        masks = self.world.get_collision_grid(level).masks
+        half_width = self.avatar_width / 2.0
+        first_x = int((pos_x - half_width) // self.tilewidth)
+        last_x = int(math.ceil((pos_x + half_width) / self.tilewidth)) - 1
+        first_y = int((pos_y - Avatar.COLLISION_HEIGHT) // self.tileheight)
+        last_y = int(math.ceil(pos_y / self.tileheight)) - 1
+        for box_tile_y in range(first_y, last_y + 1):
+            for box_tile_x in range(first_x, last_x + 1):
+                if not (0 <= box_tile_x < self.num_tiles_x and 0 <= box_tile_y < self.num_tiles_y):
+                    return True
+                bits = self._neighbour_bits.get((box_tile_x - tile_x, box_tile_y - tile_y), 0)
+                if masks[box_tile_y * self.num_tiles_x + box_tile_x] & bits:
+                    return True
+        return False
+
+    def follow_edge(self, node, direction):
+        """
+        Follows an avatar walking from the center of the tile of a node to the
+        center of its neighbour, colliding and changing the level like
+        Avatar.try_to_move. A tile with BlockIn edges can be crossed through
+        its open edges if the avatar changes the level on it.
+
+        :Returns: the node it ends on or -1 if it is blocked.
+        """
+        key = (node, direction)
+        next_node = self._edges.get(key, None)
+        if next_node is not None:
+            return next_node
+        next_node = -1
+        level, tile_x, tile_y = self.get_tile(node)
+        dir_x, dir_y = self.DIRECTIONS[direction]
+        start_x, start_y = self.get_tile_center(tile_x, tile_y)
+        end_x, end_y = self.get_tile_center(tile_x + dir_x, tile_y + dir_y)
+        map_pos_offset_y = Avatar.COLLISION_HEIGHT / 2.0
+        vpixels_per_layer = self.world.VPIXELS_PER_LAYER
+        for sample in range(1, self.EDGE_SAMPLES + 1):
+            fraction = float(sample) / self.EDGE_SAMPLES
+            pos_x = start_x + (end_x - start_x) * fraction
+            pos_y = start_y + (end_y - start_y) * fraction
+            if self._is_box_blocked(level, tile_x, tile_y, pos_x, pos_y):
+                break
+            sample_tile_x = int(pos_x // self.tilewidth)
+            sample_tile_y = int(pos_y // self.tileheight)
+            z = self.world.sample_height(pos_x, pos_y - map_pos_offset_y, level)
+            if z >= vpixels_per_layer or z < 0:
+                shift = -vpixels_per_layer if z >= 0 else vpixels_per_layer
+                level += 1 if z >= 0 else -1
+                if level not in self.level_bases:
+                    break
+                start_y += shift
+                end_y += shift
+                pos_y += shift
+                sample_tile_y = int(pos_y // self.tileheight)
+                # it has to stand on the tile of the new level
+                if not (0 <= sample_tile_y < self.num_tiles_y) or \
+                   not self.walkable[self.get_node(level, sample_tile_x, sample_tile_y)]:
+                    break
+            tile_x, tile_y = sample_tile_x, sample_tile_y
+        else:
+            # the end has to be a walkable center of a tile staying on its level
+            z = self.world.sample_height(end_x, end_y - map_pos_offset_y, level)
+            if end_y % self.tileheight == self.tileheight / 2.0 and 0 <= z < vpixels_per_layer:
+                end_node = self.get_node(level, int(end_x // self.tilewidth), int(end_y // self.tileheight))
+                if self.walkable[end_node]:
+                    next_node = end_node
+        self._edges[key] = next_node
+        return next_node
+
+    def get_components(self):
+        """
+        Groups the walkable nodes connected by edges in either direction, a
+        node can not reach the nodes of another group. Computed again after
+        changes adding edges, the other changes may leave unreachable nodes
+        in a group.
+
+        :Returns: list of the group of each node.
+        """
+        if self._components is None:
+            parents = list(range(len(self.walkable)))
+            for node in range(len(parents)):
+                if not self.walkable[node]:
+                    continue
+                for next_node, cost in self.get_neighbours(node):
+                    # union find with path halving
+                    root = node
+                    while parents[root] != root:
+                        parents[root] = root = parents[parents[root]]
+                    while parents[next_node] != next_node:
+                        parents[next_node] = next_node = parents[parents[next_node]]
+                    if root != next_node:
+                        parents[next_node] = root
+            for node in range(len(parents)):
+                root = node
+                while parents[root] != root:
+                    root = parents[root]
+                parents[node] = root
+            self._components = parents
+        return self._components
+
+    def get_heuristic(self, node, goal):
+        """
+        Lower bound of the cost between two nodes: the octile distance on the
+        ground. Going up a level moves VPIXELS_PER_LAYER up the map, so the
+        ground row of a tile on level L is tile_y + L * VPIXELS_PER_LAYER /
+        tileheight.
+        """
+        dist_x = abs(self.ground_x[node] - self.ground_x[goal])
+        dist_y = abs(self.ground_y[node] - self.ground_y[goal])
+        if dist_x < dist_y:
+            return dist_x * self.edge_costs[4] + (dist_y - dist_x) * self.tileheight
+        return dist_y * self.edge_costs[4] + (dist_x - dist_y) * self.tilewidth
+
+#  -----------------------------------------------------------------------------
+
+class ClusterGraph():
+    """
+    Hierarchical index of a NavGrid for HPA*. Each level is cut into square
+    clusters of tiles:
+
+    - the edges between clusters are reduced to entrances: the middle (the
+      ends if it is long) of each run of straight edges through a border
+      and every edge changing the level,
+    - the costs between the entrances of a cluster are precomputed.
+
+    A query searches the graph of the entrances and refines it to tiles only
+    inside the clusters it passes, segment by segment (see iter_path). The
+    paths are close to the shortest ones, not always the shortest.
+
+    Building it searches all the clusters, it can be saved next to the map
+    (see save and load). A changed tile repairs the clusters around it.
+    """
+    VERSION = 2
+    # runs of edges through a border longer than this get two entrances
+    LONG_ENTRANCE = 6
+    # clusters whose edges are kept for the queries
+    MAX_CACHED_CLUSTERS = 256
+
+    def __init__(self, nav_grid, cluster_size=16):
+        self.nav_grid = nav_grid
+        self.cluster_size = cluster_size
+        self.num_clusters_x = -(-nav_grid.num_tiles_x // cluster_size)
+        self.num_clusters_y = -(-nav_grid.num_tiles_y // cluster_size)
+        self.clusters_per_level = self.num_clusters_x * self.num_clusters_y
+        tile_x = numpy.arange(nav_grid.num_tiles_x) // cluster_size
+        tile_y = numpy.arange(nav_grid.num_tiles_y) // cluster_size
+        level_clusters = (tile_y[:, numpy.newaxis] * self.num_clusters_x + tile_x).ravel()
+        # cluster of each node
+        self.node_clusters = numpy.concatenate([level_clusters + idx * self.clusters_per_level
+                                                for idx in range(len(nav_grid.levels))]).tolist()
+        self.outgoing = {}  # {cluster: [(node, next node, cost)]} edges to other clusters
+        self.incoming = collections.defaultdict(set)  # {cluster: {(node, next node, cost)}}
+        self.entrances = {}  # {cluster: set of nodes}
+        self.intra_costs = {}  # {entrance node: [(entrance node, cost)]} in the cluster
+        self.edges = {}  # {entrance node: [(entrance node, cost)]} to search
+        self._cluster_neighbours = collections.OrderedDict()  # {cluster: (neighbours, reversed)}
+        self._lock = threading.Lock()
+
+    def build(self):
+        """
+        Finds the entrances of all clusters and the costs between them.
+        """
+        num_clusters = self.clusters_per_level * len(self.nav_grid.levels)
+        for cluster in range(num_clusters):
+            self._set_outgoing(cluster, self._find_outgoing(cluster))
+        for cluster in range(num_clusters):
+            self._update_cluster(cluster)
+
+    def get_cluster_nodes(self, cluster):
+        nav_grid = self.nav_grid
+        level_idx, idx = divmod(cluster, self.clusters_per_level)
+        cluster_y, cluster_x = divmod(idx, self.num_clusters_x)
+        first_x = cluster_x * self.cluster_size
+        first_y = cluster_y * self.cluster_size
+        last_x = min(first_x + self.cluster_size, nav_grid.num_tiles_x)
+        last_y = min(first_y + self.cluster_size, nav_grid.num_tiles_y)
+        base = level_idx * nav_grid.tiles_per_level
+        nodes = []
+        for tile_y in range(first_y, last_y):
+            row = base + tile_y * nav_grid.num_tiles_x
+            nodes.extend(range(row + first_x, row + last_x))
+        return nodes
+
+    def _find_outgoing(self, cluster):
+        """
+        :Returns: list of (node, next node, cost) of the entrance edges from
+                  a cluster to the others.
+        """
+        nav_grid = self.nav_grid
+        num_tiles_x = nav_grid.num_tiles_x
+        node_clusters = self.node_clusters
+        runs = collections.defaultdict(list)  # {(next cluster, step): [(node, next node, cost)]}
+        outgoing = []
+        for node in self.get_cluster_nodes(cluster):
+            if not nav_grid.walkable[node]:
+                continue
+            for next_node, cost in nav_grid.get_neighbours(node):
+                next_cluster = node_clusters[next_node]
+                if next_cluster == cluster:
+                    continue
+                step = next_node - node
+                if next_cluster // self.clusters_per_level != cluster // self.clusters_per_level:
+                    outgoing.append((node, next_node, cost))
+                elif step in (1, -1, num_tiles_x, -num_tiles_x):
+                    runs[(next_cluster, step)].append((node, next_node, cost))
+                # the diagonal edges have straight ones next to them
+        for (next_cluster, step), edges in runs.items():
+            # the nodes of a border follow each other by this
+            stride = num_tiles_x if step in (1, -1) else 1
+            run = [edges[0]]
+            for edge in edges[1:] + [None]:
+                if edge is not None and edge[0] == run[-1][0] + stride:
+                    run.append(edge)
+                    continue
+                if len(run) > self.LONG_ENTRANCE:
+                    outgoing.extend((run[0], run[-1]))
+                else:
+                    outgoing.append(run[len(run) // 2])
+                run = [edge]
+        return outgoing
+
+    def _set_outgoing(self, cluster, outgoing):
+        """
+        :Returns: set of the clusters reached by the old or new edges.
+        """
+        node_clusters = self.node_clusters
+        next_clusters = set()
+        for edge in self.outgoing.get(cluster, ()):
+            next_clusters.add(node_clusters[edge[1]])
+            self.incoming[node_clusters[edge[1]]].discard(edge)
+        self.outgoing[cluster] = outgoing
+        for edge in outgoing:
+            next_clusters.add(node_clusters[edge[1]])
+            self.incoming[node_clusters[edge[1]]].add(edge)
+        return next_clusters
+
+    def _get_cluster_neighbours(self, cluster, reverse=False):
+        """
+        :Returns: dict {node: [(next node, cost)]} of the edges inside a
+                  cluster, or {node: [(previous node, cost)]} if reverse.
+        """
+        with self._lock:
+            cached = self._cluster_neighbours.get(cluster, None)
+            if cached is not None:
+                self._cluster_neighbours.move_to_end(cluster)
+                return cached[reverse]
+        nav_grid = self.nav_grid
+        node_clusters = self.node_clusters
+        neighbours = {}
+        reversed_neighbours = {}
+        for node in self.get_cluster_nodes(cluster):
+            if nav_grid.walkable[node]:
+                neighbours[node] = [(next_node, cost) for next_node, cost in nav_grid.get_neighbours(node)
+                                    if node_clusters[next_node] == cluster]
+                reversed_neighbours[node] = []
+        for node, edges in neighbours.items():
+            for next_node, cost in edges:
+                reversed_neighbours[next_node].append((node, cost))
+        with self._lock:
+            self._cluster_neighbours[cluster] = (neighbours, reversed_neighbours)
+            if len(self._cluster_neighbours) > self.MAX_CACHED_CLUSTERS:
+                self._cluster_neighbours.popitem(last=False)
+        return reversed_neighbours if reverse else neighbours
+
+    @staticmethod
+    def _get_costs(neighbours, start_node):
+        """
+        Dijkstra inside a cluster.
+
+        :Returns: dict {node: cost} of the nodes reached from the start.
+        """
+        costs = {start_node: 0.0}
+        open_heap = [(0.0, start_node)]
+        while open_heap:
+            cost, node = heapq.heappop(open_heap)
+            if cost > costs[node]:
+                continue
+            for next_node, edge_cost in neighbours[node]:
+                next_cost = cost + edge_cost
+                if next_cost < costs.get(next_node, INFINITY):
+                    costs[next_node] = next_cost
+                    heapq.heappush(open_heap, (next_cost, next_node))
+        return costs
+
+    def _update_cluster(self, cluster, neighbours=None):
+        """
+        Finds the entrances of a cluster and the costs between them again.
+        """
+        for node in self.entrances.get(cluster, ()):
+            self.intra_costs.pop(node, None)
+            self.edges.pop(node, None)
+        entrances = set(edge[0] for edge in self.outgoing.get(cluster, ()))
+        entrances.update(edge[1] for edge in self.incoming.get(cluster, ()))
+        self.entrances[cluster] = entrances
+        if not entrances:
+            return
+        if neighbours is None:
+            neighbours = self._get_cluster_neighbours(cluster)
+        for node in entrances:
+            costs = self._get_costs(neighbours, node)
+            self.intra_costs[node] = [(other, costs[other]) for other in entrances
+                                      if other != node and other in costs]
+        self._update_edges(cluster)
+
+    def _update_edges(self, cluster):
+        edges = dict((node, list(self.intra_costs[node])) for node in self.entrances[cluster])
+        for node, next_node, cost in self.outgoing.get(cluster, ()):
+            edges[node].append((next_node, cost))
+        self.edges.update(edges)
+
+    def update_tile(self, level, tile_x, tile_y):
+        """
+        Repairs the clusters whose edges may pass a changed tile (see
+        NavGrid.update_tile): the tiles around it and where the levels
+        above and below come down on it.
+        """
+        nav_grid = self.nav_grid
+        level_idx = nav_grid.levels.index(level)
+        layer_tiles_y = int(math.ceil(nav_grid.world.VPIXELS_PER_LAYER / float(nav_grid.tileheight)))
+        clusters = set()
+        for other_idx in range(max(0, level_idx - 1), min(len(nav_grid.levels), level_idx + 2)):
+            for near_y in range(tile_y - 1 - layer_tiles_y, tile_y + 2 + layer_tiles_y):
+                for near_x in range(tile_x - 1, tile_x + 2):
+                    if 0 <= near_x < nav_grid.num_tiles_x and 0 <= near_y < nav_grid.num_tiles_y:
+                        node = other_idx * nav_grid.tiles_per_level + near_y * nav_grid.num_tiles_x + near_x
+                        clusters.add(self.node_clusters[node])
+        changed = set(clusters)
+        with self._lock:
+            for cluster in clusters:
+                self._cluster_neighbours.pop(cluster, None)
+        for cluster in clusters:
+            changed.update(self._set_outgoing(cluster, self._find_outgoing(cluster)))
+        for cluster in changed:
+            self._update_cluster(cluster)
+
+    def find_abstract_path(self, start_node, goal_node):
+        """
+        :Returns: list of the start, the entrances passed and the goal or None
+                  if the goal can not be reached.
+        """
+        nav_grid = self.nav_grid
+        if not (nav_grid.walkable[start_node] and nav_grid.walkable[goal_node]):
+            return None
+        components = nav_grid.get_components()
+        if components[start_node] != components[goal_node]:
+            return None
+        start_cluster = self.node_clusters[start_node]
+        goal_cluster = self.node_clusters[goal_node]
+        start_neighbours = self._get_cluster_neighbours(start_cluster)
+        start_costs = self._get_costs(start_neighbours, start_node)
+        if start_cluster == goal_cluster and goal_node in start_costs:
+            return [start_node, goal_node]
+        # the costs from the entrances of the goal cluster to the goal
+        costs = self._get_costs(self._get_cluster_neighbours(goal_cluster, reverse=True), goal_node)
+        goal_costs = dict((node, costs[node]) for node in self.entrances[goal_cluster] if node in costs)
+
+        start_edges = [(node, start_costs[node]) for node in self.entrances[start_cluster] if node in start_costs]
+        get_heuristic = nav_grid.get_heuristic
+        edges = self.edges
+        costs = {start_node: 0.0}
+        previous = {start_node: None}
+        closed = set()
+        counter = 0
+        open_heap = [(get_heuristic(start_node, goal_node), counter, start_node)]
+        while open_heap:
+            estimate, order, node = heapq.heappop(open_heap)
+            if node == goal_node:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                path.reverse()
+                return path
+            if node in closed:
+                continue
+            closed.add(node)
+            cost = costs[node]
+            next_edges = edges.get(node, [])
+            if node == start_node:
+                next_edges = next_edges + start_edges
+            if node in goal_costs:
+                next_edges = next_edges + [(goal_node, goal_costs[node])]
+            for next_node, edge_cost in next_edges:
+                next_cost = cost + edge_cost
+                if next_cost < costs.get(next_node, INFINITY):
+                    costs[next_node] = next_cost
+                    previous[next_node] = node
+                    counter += 1
+                    heapq.heappush(open_heap, (next_cost + get_heuristic(next_node, goal_node), counter, next_node))
+        return None
+
+    def refine(self, node, next_node):
+        """
+        :Returns: list of the nodes after a node up to the next node of an
+                  abstract path.
+        """
+        cluster = self.node_clusters[node]
+        if self.node_clusters[next_node] != cluster:
+            return [next_node]  # an edge between clusters
+        neighbours = self._get_cluster_neighbours(cluster)
+        get_heuristic = self.nav_grid.get_heuristic
+        costs = {node: 0.0}
+        previous = {node: None}
+        counter = 0
+        open_heap = [(get_heuristic(node, next_node), counter, node)]
+        while open_heap:
+            estimate, order, current = heapq.heappop(open_heap)
+            if current == next_node:
+                break
+            for neighbour, edge_cost in neighbours[current]:
+                cost = costs[current] + edge_cost
+                if cost < costs.get(neighbour, INFINITY):
+                    costs[neighbour] = cost
+                    previous[neighbour] = current
+                    counter += 1
+                    heapq.heappush(open_heap, (cost + get_heuristic(neighbour, next_node), counter, neighbour))
+        path = []
+        current = next_node
+        while current != node:
+            path.append(current)
+            current = previous[current]
+        path.reverse()
+        return path
+
+    def iter_path(self, abstract_path):
+        """
+        Yields the nodes of an abstract path (see find_abstract_path), a
+        segment is refined when it is reached.
+        """
+        yield abstract_path[0]
+        for node, next_node in zip(abstract_path, abstract_path[1:]):
+            for path_node in self.refine(node, next_node):
+                yield path_node
+
+    def find_path(self, start_node, goal_node):
+        """
+        :Returns: tuple of the nodes of a path or None if the goal can not be
+                  reached.
+        """
+        abstract_path = self.find_abstract_path(start_node, goal_node)
+        if abstract_path is None:
+            return None
+        return tuple(self.iter_path(abstract_path))
+
+    def get_fingerprint(self):
+        """
+        :Returns: checksum of the metadata of the world the clusters are made
+                  of, a saved graph of another one is not loaded.
+        """
+        nav_grid = self.nav_grid
+        checksum = zlib.crc32(json.dumps([self.VERSION, self.cluster_size, nav_grid.avatar_width,
+                                          nav_grid.num_tiles_x, nav_grid.num_tiles_y, nav_grid.levels]).encode())
+        for level in nav_grid.levels:
+            world_level = nav_grid.world.world_layers[level]
+            heightfield = world_level.heightfield
+            for data in (world_level.collision_grid.masks, heightfield.has_height, heightfield.height,
+                         heightfield.x_slope, heightfield.y_slope):
+                checksum = zlib.crc32(bytes(data), checksum)
+        return checksum
+
+    def save(self, file_name):
+        """
+        Writes the entrances and the costs between them to a JSON file.
+        """
+        data = {
+            'version': self.VERSION,
+            'fingerprint': self.get_fingerprint(),
+            'cluster_size': self.cluster_size,
+            'outgoing': [list(edge) for cluster in sorted(self.outgoing) for edge in self.outgoing[cluster]],
+            'intra_costs': [[node, other, cost] for node in sorted(self.intra_costs)
+                            for other, cost in self.intra_costs[node]],
+        }
+        with open(file_name, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    def load(self, file_name):
+        """
+        Reads a graph written by save.
+
+        :Returns: True if it was read, False if the file is missing or made
+                  of another world (see get_fingerprint).
+        """
+        try:
+            with open(file_name) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if data.get('version') != self.VERSION or data.get('cluster_size') != self.cluster_size or \
+           data.get('fingerprint') != self.get_fingerprint():
+            return False
+        node_clusters = self.node_clusters
+        outgoing = collections.defaultdict(list)
+        for node, next_node, cost in data['outgoing']:
+            outgoing[node_clusters[node]].append((node, next_node, cost))
+        num_clusters = self.clusters_per_level * len(self.nav_grid.levels)
+        for cluster in range(num_clusters):
+            self._set_outgoing(cluster, outgoing[cluster])
+        for cluster in range(num_clusters):
+            self.entrances[cluster] = set(edge[0] for edge in self.outgoing[cluster])
+            self.entrances[cluster].update(edge[1] for edge in self.incoming[cluster])
+        self.intra_costs = dict((node, []) for entrances in self.entrances.values() for node in entrances)
+        for node, other, cost in data['intra_costs']:
+            self.intra_costs[node].append((other, cost))
+        for cluster in self.entrances:
+            self._update_edges(cluster)
+        return True
+
+    @staticmethod
+    def get_file_name(world, cluster_size):
+        """
+        :Returns: the file name of the graph saved next to the map of a world.
+        """
+        return "{}.hpa{}.json".format(os.path.splitext(world.map.map_file_name)[0], cluster_size)
+
+#  -----------------------------------------------------------------------------
+
+class Pathfinder():
+    """
+    Finds paths between tiles of a world with A* on a NavGrid, or with HPA*
+    on a ClusterGraph for large maps if a cluster size is given. The last
+    paths found are cached (LRU), changed metadata tiles (see
+    World.update_metadata_tile) invalidate them. Batches of queries can be
+    run in a thread pool (see find_paths_async). The workers share the
+    lazily filled caches of the NavGrid and the ClusterGraph, the map must
+    not be edited while a batch runs.
+
+    The tiles of a path are (level, tile_x, tile_y), from the start to the
+    goal. Example::
+
+        pathfinder = Pathfinder(world)
+        path = pathfinder.find_path((1, 12, 22), (2, 15, 5))
+        waypoints = pathfinder.get_waypoints(path)
+
+    With a cluster graph kept next to the map::
+
+        file_name = ClusterGraph.get_file_name(world, 16)
+        pathfinder = Pathfinder(world, cluster_size=16, cluster_file_name=file_name)
+    """
+
+    def __init__(self, world, max_cached_paths=1024, max_workers=4, avatar_width=None,
+                 cluster_size=None, cluster_file_name=None):
+        self.world = world
+        self.nav_grid = NavGrid(world, avatar_width)
+        self.cluster_graph = None
+        if cluster_size:
+            # loaded if it was saved for the same metadata, else built (and
+            # saved)
+            self.cluster_graph = ClusterGraph(self.nav_grid, cluster_size)
+            if not (cluster_file_name and self.cluster_graph.load(cluster_file_name)):
+                self.cluster_graph.build()
+                if cluster_file_name:
+                    self.cluster_graph.save(cluster_file_name)
+        self.max_cached_paths = max_cached_paths
+        self.max_workers = max_workers
+        self._paths = collections.OrderedDict()  # {(start node, goal node): nodes or None}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.num_searches = 0
+        self.num_cache_hits = 0
+        world.metadata_listeners.append(self.update_tile)
+
+    def close(self):
+        self.world.metadata_listeners.remove(self.update_tile)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def update_tile(self, level, tile_x, tile_y):
+        nav_grid = self.nav_grid
+        node = nav_grid.get_node(level, tile_x, tile_y)
+        was_walkable = nav_grid.walkable[node]
+        nav_grid.update_tile(level, tile_x, tile_y)
+        if self.cluster_graph is not None:
+            self.cluster_graph.update_tile(level, tile_x, tile_y)
+        with self._lock:
+            if was_walkable and not nav_grid.walkable[node]:
+                # only the paths near the tile get longer, the others stay
+                # shortest
+                nodes = set()
+                for dir_y in (-1, 0, 1):
+                    for dir_x in (-1, 0, 1):
+                        if 0 <= tile_x + dir_x < nav_grid.num_tiles_x and 0 <= tile_y + dir_y < nav_grid.num_tiles_y:
+                            nodes.add(nav_grid.get_node(level, tile_x + dir_x, tile_y + dir_y))
+                for key, path in list(self._paths.items()):
+                    if path is not None and not nodes.isdisjoint(path):
+                        del self._paths[key]
+            else:
+                self._paths.clear()
+
+    def get_tile_at(self, level, pos_x, pos_y):
+        """
+        :Returns: tuple (level, tile_x, tile_y) of a world position.
+        """
+        return level, int(pos_x // self.nav_grid.tilewidth), int(pos_y // self.nav_grid.tileheight)
+
+    def get_waypoints(self, path):
+        """
+        :Returns: list of (level, pos_x, pos_y) of the tile centers of a path.
+        """
+        return [(level,) + self.nav_grid.get_tile_center(tile_x, tile_y) for level, tile_x, tile_y in path]
+
+    def find_path(self, start, goal):
+        """
+        :Parameters:
+            start : tuple
+                (level, tile_x, tile_y) to start at
+            goal : tuple
+                (level, tile_x, tile_y) to go to
+
+        :Returns: list of the tiles of the shortest path or None if the goal
+                  can not be reached.
+        """
+        nav_grid = self.nav_grid
+        start_node = nav_grid.get_node(*start)
+        goal_node = nav_grid.get_node(*goal)
+        key = (start_node, goal_node)
+        with self._lock:
+            if key in self._paths:
+                self._paths.move_to_end(key)
+                self.num_cache_hits += 1
+                path = self._paths[key]
+                return None if path is None else [nav_grid.get_tile(node) for node in path]
+        path = self._search(start_node, goal_node)
+        with self._lock:
+            self.num_searches += 1
+            self._paths[key] = path
+            if len(self._paths) > self.max_cached_paths:
+                self._paths.popitem(last=False)
+        return None if path is None else [nav_grid.get_tile(node) for node in path]
+
+    def iter_path(self, start, goal):
+        """
+        Like find_path, but the tiles are found while they are consumed: with
+        a cluster graph only the clusters reached are searched in detail.
+
+        :Returns: iterator of the tiles of the path or None if the goal can
+                  not be reached.
+        """
+        nav_grid = self.nav_grid
+        if self.cluster_graph is None:
+            path = self.find_path(start, goal)
+            return None if path is None else iter(path)
+        abstract_path = self.cluster_graph.find_abstract_path(nav_grid.get_node(*start), nav_grid.get_node(*goal))
+        if abstract_path is None:
+            return None
+        return (nav_grid.get_tile(node) for node in self.cluster_graph.iter_path(abstract_path))
+
+    def _search(self, start_node, goal_node):
+        if self.cluster_graph is not None:
+            return self.cluster_graph.find_path(start_node, goal_node)
+        nav_grid = self.nav_grid
+        if not (nav_grid.walkable[start_node] and nav_grid.walkable[goal_node]):
+            return None
+        components = nav_grid.get_components()
+        if components[start_node] != components[goal_node]:
+            # would search all the nodes reachable from the start
+            return None
+        get_neighbours = nav_grid.get_neighbours
+        # get_heuristic inlined
+        ground_x = nav_grid.ground_x
+        ground_y = nav_grid.ground_y
+        goal_x = ground_x[goal_node]
+        goal_y = ground_y[goal_node]
+        diagonal_cost = nav_grid.edge_costs[4]
+        tilewidth = nav_grid.tilewidth
+        tileheight = nav_grid.tileheight
+        costs = {start_node: 0.0}
+        previous = {start_node: None}
+        closed = set()
+        counter = 0  # keeps the order of equal estimates stable
+        # of equal estimates the nearest to the goal first, on open ground
+        # there are many
+        heuristic = nav_grid.get_heuristic(start_node, goal_node)
+        open_heap = [(heuristic, heuristic, counter, start_node)]
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        while open_heap:
+            estimate, heuristic, order, node = heappop(open_heap)
+            if node == goal_node:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                path.reverse()
+                return tuple(path)
+            if node in closed:
+                continue
+            closed.add(node)
+            cost = costs[node]
+            for next_node, edge_cost in get_neighbours(node):
+                next_cost = cost + edge_cost
+                if next_cost < costs.get(next_node, INFINITY):
+                    costs[next_node] = next_cost
+                    previous[next_node] = node
+                    counter += 1
+                    dist_x = abs(ground_x[next_node] - goal_x)
+                    dist_y = abs(ground_y[next_node] - goal_y)
+                    if dist_x < dist_y:
+                        heuristic = dist_x * diagonal_cost + (dist_y - dist_x) * tileheight
+                    else:
+                        heuristic = dist_y * diagonal_cost + (dist_x - dist_y) * tilewidth
+                    heappush(open_heap, (next_cost + heuristic, heuristic, counter, next_node))
+        return None
+
+    def find_paths(self, queries):
+        """
+        Finds the paths of a batch of (start, goal) queries in the thread pool.
+
+        :Returns: list of the paths, in the order of the queries.
+        """
+        return [future.result() for future in self.find_paths_async(queries)]
+
+    def find_paths_async(self, queries):
+        """
+        :Returns: list of concurrent.futures.Future of the paths of a batch of
+                  (start, goal) queries. Wait for them before editing the map
+                  (see World.update_metadata_tile), update_tile clears the
+                  caches of the NavGrid without a lock.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='Pathfinder')
+        return [self._executor.submit(self.find_path, start, goal) for start, goal in queries]
+
+#  -----------------------------------------------------------------------------
+
+class FlowField():
+    """
+    The way to a target tile from every tile of a level: costs is the cost
+    of the shortest path of each tile to the target (inf if it can not reach
+    it) and directions the index in NavGrid.DIRECTIONS of its next tile (-1
+    at the target and where it can not be reached). The avatars steer to the
+    center of the next tile, see get_step.
+    """
+
+    def __init__(self, level, target_x, target_y, costs, directions, tilewidth, tileheight):
+        self.level = level
+        self.target_x = target_x
+        self.target_y = target_y
+        self.costs = costs
+        self.directions = directions
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        num_tiles_y, num_tiles_x = directions.shape
+        # the point to steer to from each tile, nan where there is none (the
+        # direction -1 picks the 0 at the end)
+        dir_x = numpy.array([dir_x for dir_x, dir_y in NavGrid.DIRECTIONS] + [0])[directions]
+        dir_y = numpy.array([dir_y for dir_x, dir_y in NavGrid.DIRECTIONS] + [0])[directions]
+        reachable = costs < INFINITY
+        self.goal_x = numpy.where(reachable, (numpy.arange(num_tiles_x) + dir_x + 0.5) * tilewidth, numpy.nan)
+        self.goal_y = numpy.where(reachable, (numpy.arange(num_tiles_y)[:, numpy.newaxis] + dir_y + 0.5) * tileheight, numpy.nan)
+
+    def get_step(self, pos_x, pos_y, speed):
+        """
+        :Returns: (step_x, step_y) of at most speed pixels from a position of
+                  an avatar (its feet) towards the target, (0, 0) at the target
+                  and where it can not be reached.
+        """
+        tile_x = int(pos_x // self.tilewidth)
+        tile_y = int(pos_y // self.tileheight)
+        num_tiles_y, num_tiles_x = self.directions.shape
+        if not (0 <= tile_x < num_tiles_x and 0 <= tile_y < num_tiles_y):
+            return 0.0, 0.0
+        goal_x = self.goal_x[tile_y, tile_x]
+        if goal_x != goal_x:  # nan
+            return 0.0, 0.0
+        step_x = goal_x - pos_x
+        step_y = self.goal_y[tile_y, tile_x] - pos_y
+        distance = math.hypot(step_x, step_y)
+        if distance > speed:
+            step_x *= speed / distance
+            step_y *= speed / distance
+        return float(step_x), float(step_y)
+
+    def get_steps(self, xs, ys, speed):
+        """
+        Like get_step for arrays of positions, e.g. of the avatars of a Crowd
+        on the level of the field.
+
+        :Returns: arrays step_x, step_y.
+        """
+        num_tiles_y, num_tiles_x = self.directions.shape
+        tile_x = numpy.floor_divide(xs, self.tilewidth).astype(numpy.int64)
+        tile_y = numpy.floor_divide(ys, self.tileheight).astype(numpy.int64)
+        inside = (tile_x >= 0) & (tile_x < num_tiles_x) & (tile_y >= 0) & (tile_y < num_tiles_y)
+        tile_x = numpy.clip(tile_x, 0, num_tiles_x - 1)
+        tile_y = numpy.clip(tile_y, 0, num_tiles_y - 1)
+        step_x = self.goal_x[tile_y, tile_x] - xs
+        step_y = self.goal_y[tile_y, tile_x] - ys
+        distance = numpy.hypot(step_x, step_y)
+        scale = numpy.where(distance > speed, speed / numpy.maximum(distance, 1e-9), 1.0)
+        moving = inside & (step_x == step_x)
+        return numpy.where(moving, step_x * scale, 0.0), numpy.where(moving, step_y * scale, 0.0)
+
+class FlowFieldCache():
+    """
+    Makes the FlowFields of the targets of a world on its NavGrid, for
+    crowds heading to the same tile (e.g. of the hero). A field stays on its
+    level, the integration runs over whole arrays. The last fields made are
+    cached (LRU), changed metadata tiles (see World.update_metadata_tile)
+    drop the fields of their level and the levels next to it.
+
+    Example::
+
+        flow_fields = FlowFieldCache(world)
+        flow_field = flow_fields.get_field(hero.layer, hero.tile_x, hero.tile_y)
+        for avatar in avatars:
+            avatar.move_along(world, tick_ms, flow_field, 2.0)
+    """
+
+    def __init__(self, world, max_fields=64, avatar_width=None):
+        self.world = world
+        self.nav_grid = NavGrid(world, avatar_width)
+        self.max_fields = max_fields
+        self._fields = collections.OrderedDict()  # {(level, tile_x, tile_y): FlowField}
+        self._edges = {}  # {level: list of the edge arrays of the directions}
+        self.num_fields_made = 0
+        world.metadata_listeners.append(self.update_tile)
+
+    def close(self):
+        self.world.metadata_listeners.remove(self.update_tile)
+
+    def update_tile(self, level, tile_x, tile_y):
+        self.nav_grid.update_tile(level, tile_x, tile_y)
+        levels = (level - 1, level, level + 1)
+        for other_level in levels:
+            self._edges.pop(other_level, None)
+        for key in [key for key in self._fields if key[0] in levels]:
+            del self._fields[key]
+
+    def _get_shifted(self, values, dir_x, dir_y, fill):
+        """
+        :Returns: array of the values of the neighbours in a direction, fill
+                  outside the map.
+        """
+        num_tiles_y, num_tiles_x = values.shape
+        padded = numpy.full((num_tiles_y + 2, num_tiles_x + 2), fill, values.dtype)
+        padded[1:-1, 1:-1] = values
+        return padded[1 + dir_y:1 + dir_y + num_tiles_y, 1 + dir_x:1 + dir_x + num_tiles_x]
+
+    def get_edges(self, level):
+        """
+        :Returns: list of bool arrays, for each of NavGrid.DIRECTIONS the
+                  tiles of a level an avatar can go to the neighbour in the
+                  direction from, like NavGrid.get_neighbours without the
+                  edges leaving the level.
+        """
+        edges = self._edges.get(level, None)
+        if edges is not None:
+            return edges
+        nav_grid = self.nav_grid
+        shape = (nav_grid.num_tiles_y, nav_grid.num_tiles_x)
+        base = nav_grid.level_bases[level]
+        walkable = numpy.frombuffer(nav_grid.walkable, numpy.uint8, nav_grid.tiles_per_level, base).reshape(shape) != 0
+        level_changing = numpy.frombuffer(nav_grid.level_changing, numpy.uint8, nav_grid.tiles_per_level, base).reshape(shape) != 0
+        flat = walkable & ~level_changing
+        edges = []
+        for direction, (dir_x, dir_y) in enumerate(nav_grid.DIRECTIONS):
+            if dir_x and dir_y:
+                edges.append(flat & self._get_shifted(flat, dir_x, dir_y, False) &
+                             self._get_shifted(flat, dir_x, 0, False) & self._get_shifted(flat, 0, dir_y, False))
+                continue
+            next_level_changing = self._get_shifted(level_changing, dir_x, dir_y, False)
+            valid = flat & self._get_shifted(flat, dir_x, dir_y, False)
+            # the few edges on the stairs are followed
+            inside = self._get_shifted(numpy.ones(shape, bool), dir_x, dir_y, False)
+            for tile_y, tile_x in zip(*numpy.nonzero(walkable & inside & (level_changing | next_level_changing))):
+                node = nav_grid.get_node(level, int(tile_x), int(tile_y))
+                valid[tile_y, tile_x] = nav_grid.follow_edge(node, direction) == node + dir_y * nav_grid.num_tiles_x + dir_x
+            edges.append(valid)
+        self._edges[level] = edges
+        return edges
+
+    def get_field(self, level, tile_x, tile_y):
+        """
+        :Returns: the FlowField to a tile of a level.
+        """
+        key = (level, tile_x, tile_y)
+        field = self._fields.get(key, None)
+        if field is not None:
+            self._fields.move_to_end(key)
+            return field
+        field = self._make_field(level, tile_x, tile_y)
+        self._fields[key] = field
+        if len(self._fields) > self.max_fields:
+            self._fields.popitem(last=False)
+        return field
+
+    @staticmethod
+    def _sweep(costs, step, neighbours):
+        """
+        Lowers the costs of each row by the costs of the row before it (after
+        it if step is -1) plus the costs of the edges to them.
+
+        :Parameters:
+            costs : numpy.ndarray
+                2D costs changed in place, a transposed view sweeps the columns
+            step : int
+                1 to sweep from the first row to the last, -1 the other way
+            neighbours : list
+                (shift in the row, bool array of the valid edges, cost) of
+                the directions to the row before
+        """
+        num_rows, num_columns = costs.shape
+        padded = numpy.full(num_columns + 2, INFINITY)
+        for row in (range(1, num_rows) if step == 1 else range(num_rows - 2, -1, -1)):
+            padded[1:-1] = costs[row - step]
+            current = costs[row]
+            for shift, valid, cost in neighbours:
+                numpy.minimum(current, padded[1 + shift:1 + shift + num_columns] + cost, out=current, where=valid[row])
+
+    def _make_field(self, level, target_x, target_y):
+        nav_grid = self.nav_grid
+        edges = self.get_edges(level)
+        edge_costs = nav_grid.edge_costs
+        costs = numpy.full((nav_grid.num_tiles_y, nav_grid.num_tiles_x), INFINITY)
+        if nav_grid.walkable[nav_grid.get_node(level, target_x, target_y)]:
+            costs[target_y, target_x] = 0.0
+            # sweep the costs from the neighbours over the rows and columns
+            # in both directions until they do not change, a sweep takes the
+            # costs over the whole map (fast sweeping)
+            sweeps = []
+            for step in (1, -1):
+                for transposed in (False, True):
+                    neighbours = []
+                    for direction, (dir_x, dir_y) in enumerate(nav_grid.DIRECTIONS):
+                        if transposed:
+                            dir_x, dir_y = dir_y, dir_x
+                        if dir_y == -step:
+                            valid = edges[direction].T if transposed else edges[direction]
+                            neighbours.append((dir_x, valid, edge_costs[direction]))
+                    sweeps.append((transposed, step, neighbours))
+            while True:
+                old_costs = costs.copy()
+                for transposed, step, neighbours in sweeps:
+                    self._sweep(costs.T if transposed else costs, step, neighbours)
+                if numpy.array_equal(old_costs, costs):
+                    break
+        next_costs = numpy.full((len(nav_grid.DIRECTIONS) + 1,) + costs.shape, INFINITY)
+        for direction, (dir_x, dir_y) in enumerate(nav_grid.DIRECTIONS):
+            numpy.add(self._get_shifted(costs, dir_x, dir_y, INFINITY), edge_costs[direction],
+                      out=next_costs[direction], where=edges[direction])
+        # the last one stays, at the target
+        next_costs[-1] = numpy.where(costs == 0.0, 0.0, INFINITY)
+        directions = numpy.argmin(next_costs, axis=0).astype(numpy.int8)
+        directions[(directions == len(nav_grid.DIRECTIONS)) | (costs == INFINITY)] = -1
+        self.num_fields_made += 1
+        return FlowField(level, target_x, target_y, costs, directions, nav_grid.tilewidth, nav_grid.tileheight)
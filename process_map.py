@@ -12,6 +12,7 @@ import tiledtmxloader
 from PIL import Image
 
 from common import *
+from profiler import SamplingProfiler
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -180,6 +181,7 @@ def main():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='World Demo')
     parser.add_argument('-v', '--verbose', action="store_true", help="verbose output" )
+    parser.add_argument('--profile', metavar='FILE', help="sample the processing, write the collapsed stacks (flamegraph) to FILE")
     args = parser.parse_args()
 
     if args.verbose:
@@ -187,4 +189,16 @@ if __name__ == '__main__':
     else:
         print("~ Not so verbose")
 
+    if args.profile:
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            result = main()
+        finally:
+            sampler.stop()
+            sampler.write_collapsed(args.profile)
+            sampler.print_summary()
+            print("~ Written", args.profile)
+        sys.exit(result)
+
     sys.exit(main())
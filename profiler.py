@@ -0,0 +1,345 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+import collections
+import pygame
+
+#  -----------------------------------------------------------------------------
+
+class _NullScope():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_scope = _NullScope()
+
+class _Scope():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        # one per entered scope, the scope of a name is reused for nested
+        # and recursive calls
+        self.starts = []
+
+    def __enter__(self):
+        self.starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.events.append((self.name, self.starts.pop(), time.perf_counter()))
+        return False
+
+class FrameProfiler():
+    """
+    Measures the time spent in named scopes of each frame of the main loop.
+
+    Example::
+
+        profiler = FrameProfiler()
+        while running:
+            profiler.begin_frame()
+            with profiler.scope('input'):
+                handle_events()
+            ...
+            profiler.end_frame()
+
+    The last frames are kept (rolling window) for the frame time statistics,
+    the histogram, the HUD and the Chrome trace (see dump_chrome_trace). A
+    scope costs about a microsecond, so it can be left on.
+    """
+    # upper limits of the histogram buckets in milliseconds
+    HISTOGRAM_LIMITS_MS = (2.0, 4.0, 8.0, 16.7, 33.3, 50.0, 100.0, float('inf'))
+
+    def __init__(self, num_frames=300, enabled=True):
+        self.enabled = enabled
+        self.frames = collections.deque(maxlen=num_frames)  # (start, end, events)
+        self.events = []  # (name, start, end) of the current frame
+        self.frame_start = None
+        self.origin = time.perf_counter()
+        self._scopes = {}
+        self._font = None
+
+    def scope(self, name):
+        """
+        Returns a context manager measuring the time spent in it.
+        """
+        if not self.enabled:
+            return _null_scope
+        scope = self._scopes.get(name, None)
+        if scope is None:
+            scope = self._scopes[name] = _Scope(self, name)
+        return scope
+
+    def instrument(self, obj, method_name, get_scope_name=None):
+        """
+        Replaces a method of an object (not of its class) by one measuring each
+        call in a scope.
+
+        :Parameters:
+            obj : object
+                the object to instrument
+            method_name : str
+                name of the method
+            get_scope_name : function
+                Optional, called with the arguments of each call and returns the
+                scope name. Defaults to the method name.
+        """
+        method = getattr(obj, method_name)
+
+        def instrumented(*args, **kwargs):
+            if not self.enabled:
+                return method(*args, **kwargs)
+            name = get_scope_name(*args, **kwargs) if get_scope_name else method_name
+            with self.scope(name):
+                return method(*args, **kwargs)
+
+        setattr(obj, method_name, instrumented)
+
+    def begin_frame(self):
+        self.events = []
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.frame_start is not None and self.enabled:
+            self.frames.append((self.frame_start, time.perf_counter(), self.events))
+        self.frame_start = None
+
+    def get_frame_times(self):
+        """
+        :Returns: list of the frame times of the kept frames in seconds.
+        """
+        return [end - start for start, end, events in self.frames]
+
+    def get_stats(self):
+        """
+        :Returns: dict with 'mean', 'p95' and 'max' frame time and 'scopes', the
+                  mean time per frame of each scope, all in seconds.
+        """
+        frame_times = sorted(self.get_frame_times())
+        if not frame_times:
+            return {'mean': 0.0, 'p95': 0.0, 'max': 0.0, 'scopes': {}}
+        scopes = collections.defaultdict(float)
+        for start, end, events in self.frames:
+            for name, event_start, event_end in events:
+                scopes[name] += event_end - event_start
+        num_frames = len(frame_times)
+        return {
+            'mean': sum(frame_times) / num_frames,
+            'p95': frame_times[min(num_frames - 1, int(0.95 * num_frames))],
+            'max': frame_times[-1],
+            'scopes': dict((name, total / num_frames) for name, total in scopes.items()),
+        }
+
+    def get_histogram(self):
+        """
+        :Returns: list of (upper limit in ms, number of frames) of the kept
+                  frames, see HISTOGRAM_LIMITS_MS.
+        """
+        counts = [0] * len(self.HISTOGRAM_LIMITS_MS)
+        for frame_time in self.get_frame_times():
+            frame_time_ms = 1e3 * frame_time
+            for idx, limit in enumerate(self.HISTOGRAM_LIMITS_MS):
+                if frame_time_ms <= limit:
+                    counts[idx] += 1
+                    break
+        return list(zip(self.HISTOGRAM_LIMITS_MS, counts))
+
+    def draw_hud(self, surf, pos=(10, 10)):
+        """
+        Draws the frame time statistics, the slowest scopes and a graph of the
+        last frame times.
+
+        :Returns: the rect drawn on the surface.
+        """
+        if self._font is None:
+            self._font = pygame.font.Font(None, 18)
+        stats = self.get_stats()
+        lines = ["frame: {:.2f} ms  p95 {:.2f}  max {:.2f}".format(
+            1e3 * stats['mean'], 1e3 * stats['p95'], 1e3 * stats['max'])]
+        scopes = sorted(stats['scopes'].items(), key=lambda item: -item[1])
+        for name, mean in scopes[:8]:
+            lines.append("{:.2f} ms  {}".format(1e3 * mean, name))
+        lines.append("  ".join("<{:g}: {}".format(limit, count) for limit, count in self.get_histogram() if count))
+
+        images = [self._font.render(line, True, (255, 255, 255)) for line in lines]
+        graph_height = 40
+        width = max(max(image.get_width() for image in images), self.frames.maxlen)
+        height = sum(image.get_height() for image in images) + graph_height + 4
+        rect = pygame.Rect(pos[0], pos[1], width + 8, height + 8)
+        surf.fill((0, 0, 0), rect)
+        y = rect.top + 4
+        for image in images:
+            surf.blit(image, (rect.left + 4, y))
+            y += image.get_height()
+
+        # one bar per frame, the line is at 60 fps
+        bottom = y + graph_height
+        for idx, frame_time in enumerate(self.get_frame_times()):
+            bar_height = min(graph_height, int(graph_height * frame_time / 0.0333))
+            color = (0, 255, 0) if frame_time <= 0.0167 else (255, 0, 0)
+            pygame.draw.line(surf, color, (rect.left + 4 + idx, bottom), (rect.left + 4 + idx, bottom - bar_height))
+        pygame.draw.line(surf, (255, 255, 0), (rect.left + 4, bottom - graph_height // 2), (rect.left + 4 + width, bottom - graph_height // 2))
+        return rect
+
+    def dump_chrome_trace(self, file_name):
+        """
+        Writes the kept frames to a file in the Chrome trace event format, it
+        can be opened in chrome://tracing or https://ui.perfetto.dev.
+        """
+        trace_events = []
+        for frame_idx, (start, end, events) in enumerate(self.frames):
+            trace_events.append(self._get_trace_event("frame", start, end, {'frame': frame_idx}))
+            for name, event_start, event_end in events:
+                trace_events.append(self._get_trace_event(name, event_start, event_end))
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+    def _get_trace_event(self, name, start, end, args=None):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': 1e6 * (start - self.origin),
+            'dur': 1e6 * (end - start),
+            'pid': 0,
+            'tid': 0,
+        }
+        if args:
+            event['args'] = args
+        return event
+
+#  -----------------------------------------------------------------------------
+
+def _is_avatar_physics(file_name, qualname):
+    return file_name == 'avatar.py' and qualname.startswith('Avatar.') and \
+           not qualname.endswith('__init__')
+
+# (subsystem, test of file base name and qualified function name), the
+# outermost function of a stack matching one decides its subsystem
+SUBSYSTEMS = [
+    ('tmxreader parse/decode', lambda file_name, qualname: \
+        file_name == 'tmxreader.py' and qualname.startswith('TileMapParser.')),
+    ('resource loading', lambda file_name, qualname: 'ResourceLoader' in qualname),
+    ('SpriteLayer build', lambda file_name, qualname: \
+        file_name == 'helperspygame.py' and (qualname.startswith('SpriteLayer.') or \
+        qualname in ('get_layer_at_index', 'get_layers_from_map'))),
+    ('render', lambda file_name, qualname: \
+        (file_name == 'helperspygame.py' and qualname.startswith('RendererPygame.')) or \
+        qualname == 'World.draw_avatar_boxes'),
+    ('avatar physics', _is_avatar_physics),
+]
+
+class SamplingProfiler():
+    """
+    Statistical profiler: a thread looks at the stack of the profiled thread
+    at a fixed interval and counts the stacks seen. The profiled code is not
+    slowed down except for the time the sampling thread holds the GIL.
+
+    The samples are attributed to subsystems (see SUBSYSTEMS) and written as
+    collapsed stacks (one 'frame;frame;frame count' line per stack, root
+    first), the input of flamegraph.pl, speedscope or inferno.
+
+    Example::
+
+        sampler = SamplingProfiler()
+        sampler.start()
+        load_and_run()
+        sampler.stop()
+        sampler.write_collapsed('profile.folded')
+    """
+
+    def __init__(self, interval=0.001, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples = collections.Counter()  # {(code, ...) root first: count}
+        self._running = False
+        self._thread = None
+        self._switch_interval = None
+        self._subsystems = {}  # {stack: subsystem}
+
+    def start(self):
+        # without it the sampling thread would only get the GIL when the
+        # profiled thread releases it (e.g. waiting for events), biasing the
+        # samples towards these places
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self.interval / 2))
+        self._running = True
+        self._thread = threading.Thread(target=self._sample, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            sys.setswitchinterval(self._switch_interval)
+
+    def _sample(self):
+        samples = self.samples
+        thread_id = self.thread_id
+        while self._running:
+            frame = sys._current_frames().get(thread_id, None)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                samples[tuple(stack)] += 1
+            del frame
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _get_frame_name(code):
+        qualname = getattr(code, 'co_qualname', code.co_name)
+        return "{} ({}:{})".format(qualname, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def get_subsystem(self, stack):
+        subsystem = self._subsystems.get(stack, None)
+        if subsystem is None:
+            subsystem = 'other'
+            for code in stack:
+                file_name = os.path.basename(code.co_filename)
+                qualname = getattr(code, 'co_qualname', code.co_name)
+                match = [name for name, test in SUBSYSTEMS if test(file_name, qualname)]
+                if match:
+                    subsystem = match[0]
+                    break
+            self._subsystems[stack] = subsystem
+        return subsystem
+
+    def get_subsystem_totals(self):
+        """
+        :Returns: list of (subsystem, number of samples), most samples first.
+        """
+        totals = collections.Counter()
+        for stack, count in self.samples.items():
+            totals[self.get_subsystem(stack)] += count
+        return totals.most_common()
+
+    def write_collapsed(self, file_name):
+        """
+        Writes the samples as collapsed stacks, the subsystem is the root frame.
+        """
+        lines = collections.Counter()
+        for stack, count in self.samples.items():
+            names = [self.get_subsystem(stack)] + [self._get_frame_name(code).replace(';', ':') for code in stack]
+            lines[';'.join(names)] += count
+        with open(file_name, 'w') as f:
+            for line, count in sorted(lines.items()):
+                f.write("{} {}\n".format(line, count))
+
+    def print_summary(self):
+        total = sum(self.samples.values())
+        print("~ {} samples every {:g} ms".format(total, 1e3 * self.interval))
+        if total == 0:
+            # stopped before the first sample
+            return
+        for subsystem, count in self.get_subsystem_totals():
+            print("{:>6.1f}% {}".format(100.0 * count / total, subsystem))
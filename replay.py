@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+import pygame
+
+#  -----------------------------------------------------------------------------
+
+# bits of the keys of a frame
+KEY_LEFT = 1 << 0
+KEY_RIGHT = 1 << 1
+KEY_UP = 1 << 2
+KEY_DOWN = 1 << 3
+
+def get_pressed_keys():
+    """
+    :Returns: the bits of the arrow keys pressed now.
+    """
+    pressed = pygame.key.get_pressed()
+    keys = 0
+    for key, bit in ((pygame.K_LEFT, KEY_LEFT), (pygame.K_RIGHT, KEY_RIGHT),
+                     (pygame.K_UP, KEY_UP), (pygame.K_DOWN, KEY_DOWN)):
+        if pressed[key]:
+            keys |= bit
+    return keys
+
+def get_directions(keys):
+    """
+    :Returns: direction_x, direction_y (-1, 0 or 1) of the keys of a frame.
+    """
+    return bool(keys & KEY_RIGHT) - bool(keys & KEY_LEFT), bool(keys & KEY_DOWN) - bool(keys & KEY_UP)
+
+def get_state_hash(world):
+    """
+    :Returns: a hash of the dynamic state of the world (see World.snapshot),
+              the same in every process.
+    """
+    return zlib.crc32(world.snapshot())
+
+class InputRecording():
+    """
+    The input of the frames of a run of the demo: for each frame the time
+    since the last one in ms (dt), the keys pressed (see get_pressed_keys)
+    and the state hash of the world after it (see get_state_hash). Played
+    again (see main.DemoSimulation) the world goes through the same states,
+    the hashes find the first frame where it does not.
+
+    Example::
+
+        recording = InputRecording(file_name, tick_rate, max_catch_up)
+        while running:
+            keys = get_pressed_keys()
+            simulation.tick(dt, keys)
+            recording.add_frame(dt, keys, get_state_hash(world))
+        recording.save('run.json')
+    """
+    VERSION = 1
+
+    def __init__(self, map_file_name, tick_rate=60.0, max_catch_up=5, frames=None):
+        self.map_file_name = map_file_name
+        self.tick_rate = tick_rate
+        self.max_catch_up = max_catch_up
+        self.frames = frames or []  # [(dt, keys, state_hash)]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add_frame(self, dt, keys, state_hash):
+        self.frames.append((dt, keys, state_hash))
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump({'version': self.VERSION, 'map': self.map_file_name, 'tick_rate': self.tick_rate,
+                       'max_catch_up': self.max_catch_up, 'frames': self.frames}, f, separators=(',', ':'))
+
+    @staticmethod
+    def load(file_name):
+        """
+        :Returns: the InputRecording saved in a file.
+        """
+        with open(file_name) as f:
+            data = json.load(f)
+        if data.get('version', None) != InputRecording.VERSION:
+            raise ValueError("not an input recording of version {}: {}".format(InputRecording.VERSION, file_name))
+        return InputRecording(data['map'], data['tick_rate'], data['max_catch_up'],
+                              [tuple(frame) for frame in data['frames']])
+
+#  -----------------------------------------------------------------------------
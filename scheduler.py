@@ -0,0 +1,167 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  -----------------------------------------------------------------------------
+
+class ScheduledAvatar():
+    """
+    An avatar of a SimulationScheduler and the function moving it.
+    """
+    def __init__(self, avatar, tick, serial, time):
+        self.avatar = avatar
+        self.tick = tick
+        self.serial = serial
+        # simulation time of the last update in ms
+        self.time = time
+
+class SimulationScheduler():
+    """
+    Updates the avatars of a world by their interest to the player (a level
+    of detail of the simulation): the avatars near the camera every tick,
+    the ones at a medium distance every medium_interval ticks, and all the
+    other ones, also those on other levels than the camera, every
+    far_interval ticks with coarse moves (see Avatar.coarse). An update
+    gets all the time since the last one, so an avatar coming back into
+    view catches up with it, after coarse moves it is refined first (see
+    Avatar.refine).
+
+    The near and medium avatars are found in the spatial hash of the camera
+    level (see World.get_avatars_in_radius), the far ones are updated round
+    robin, a slice of them each tick. A tick costs about the avatars around
+    the camera plus 1/far_interval of the other ones. Without a camera
+    position all avatars are near.
+
+    Example::
+
+        scheduler = SimulationScheduler(world)
+        for walker in walkers:
+            scheduler.add(walker.avatar, walker.tick)
+        while running:
+            while accumulator >= tick_ms:
+                scheduler.tick(tick_ms)
+                accumulator -= tick_ms
+            scheduler.interpolate(accumulator / tick_ms)
+    """
+    NEAR, MEDIUM, FAR = 0, 1, 2
+
+    def __init__(self, world, near_radius=768.0, medium_radius=1536.0, medium_interval=4, far_interval=30):
+        self.world = world
+        self.near_radius = near_radius
+        self.medium_radius = medium_radius
+        self.medium_interval = medium_interval
+        self.far_interval = far_interval
+        self.entries = {}  # {avatar: ScheduledAvatar}
+        self.entry_list = []  # the entries in the order they were added, see tick
+        self.num_added = 0
+        self.time = 0.0
+        self.ticks = 0
+        # the near avatars of the last tick, only these are interpolated
+        self.near = []
+        # number of updates of the last tick, indexed NEAR, MEDIUM and FAR
+        self.num_updates = [0, 0, 0]
+
+    def __len__(self):
+        return len(self.entry_list)
+
+    def add(self, avatar, tick):
+        """
+        Adds an avatar of the world to the scheduler.
+
+        :Parameters:
+            avatar : Avatar
+                the avatar, it is in the world
+            tick : function
+                tick(world, delta_time) moving the avatar for delta_time ms,
+                e.g. with Avatar.try_to_move
+        """
+        entry = ScheduledAvatar(avatar, tick, self.num_added, self.time)
+        self.num_added += 1
+        self.entries[avatar] = entry
+        self.entry_list.append(entry)
+
+    def remove(self, avatar):
+        entry = self.entries.pop(avatar)
+        self.entry_list.remove(entry)
+        if avatar.unrefined:
+            avatar.refine(self.world)
+
+    def get_interest(self):
+        """
+        :Returns: lists of the entries of the near and of the medium avatars,
+                  in the order they were added.
+        """
+        world = self.world
+        if world.camera_position is None or world.camera_layer_level is None:
+            return list(self.entry_list), []
+        pos_x, pos_y = world.camera_position
+        near_radius_squared = self.near_radius * self.near_radius
+        near = []
+        medium = []
+        entries = self.entries
+        for avatar in world.get_avatars_in_radius(world.camera_layer_level, pos_x, pos_y, self.medium_radius):
+            entry = entries.get(avatar, None)
+            if entry is None:
+                continue
+            if (avatar.pos_x - pos_x) ** 2 + (avatar.pos_y - pos_y) ** 2 <= near_radius_squared:
+                near.append(entry)
+            else:
+                medium.append(entry)
+        near.sort(key=lambda entry: entry.serial)
+        medium.sort(key=lambda entry: entry.serial)
+        return near, medium
+
+    def tick(self, tick_ms):
+        """
+        A fixed simulation tick of tick_ms, used instead of World.begin_tick
+        and World.end_tick for the avatars of the scheduler.
+        """
+        self.time += tick_ms
+        self.ticks += 1
+        near, medium = self.get_interest()
+        num_updates = [0, 0, 0]
+        for entry in near:
+            num_updates[self.NEAR] += self._update(entry, False)
+        ticks = self.ticks
+        medium_interval = self.medium_interval
+        for entry in medium:
+            # spread over the ticks
+            if (entry.serial + ticks) % medium_interval == 0:
+                num_updates[self.MEDIUM] += self._update(entry, False)
+        interesting = set(entry.avatar for entry in near)
+        interesting.update(entry.avatar for entry in medium)
+        for entry in self.entry_list[ticks % self.far_interval::self.far_interval]:
+            if entry.avatar not in interesting:
+                num_updates[self.FAR] += self._update(entry, True)
+        self.near = near
+        self.num_updates = num_updates
+
+    def _update(self, entry, coarse):
+        """
+        Moves an avatar for the time since its last update.
+
+        :Returns: 1 if it was updated, 0 if it is up to date.
+        """
+        delta_time = self.time - entry.time
+        if delta_time <= 0:
+            return 0
+        avatar = entry.avatar
+        if coarse:
+            avatar.coarse = True
+        elif avatar.unrefined:
+            avatar.refine(self.world)
+        avatar.begin_tick()
+        try:
+            entry.tick(self.world, delta_time)
+        finally:
+            avatar.coarse = False
+        avatar.end_tick()
+        entry.time = self.time
+        return 1
+
+    def interpolate(self, alpha):
+        """
+        Places the near avatars between their last two ticks for rendering,
+        like World.interpolate_avatars.
+        """
+        for entry in self.near:
+            entry.avatar.interpolate(alpha)
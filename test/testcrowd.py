@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+
+THIS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+
+p = os.path.join(THIS_DIR, os.pardir)
+sys.path.insert(0, p)
+
+import io
+import random
+import unittest
+import contextlib
+
+from common import *
+init_headless_display()
+
+import tiledtmxloader
+import benchmark
+from world import World
+from avatar import Avatar
+from crowd import Crowd
+
+
+class CrowdTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        self.world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(self.world_map, headless=True)
+            self.crowd_world = World(self.world_map, headless=True)
+
+    def _add_avatars(self, crowd, num_avatars, rnd):
+        metadata_layer = self.world.get_metadata_layer(1).sprite_layer
+        file_name = os.path.join('data', 'avatars', 'ch_01_00.png')
+        avatars = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tile_x, tile_y in rnd.sample(benchmark.get_walkable_tiles(self.world, 1), num_avatars):
+                pos_x = (tile_x + rnd.random()) * metadata_layer.tilewidth
+                pos_y = (tile_y + rnd.random()) * metadata_layer.tileheight
+                avatar = Avatar(pos_x, pos_y, file_name, headless=True)
+                self.world.add_avatar(avatar)
+                avatar.add_to_sprite_layer(self.world.get_avatar_layer(1).sprite_layer)
+                avatars.append(avatar)
+                crowd.add(pos_x, pos_y, file_name)
+        return avatars
+
+    def test_tick_like_try_to_move(self):
+        rnd = random.Random(0)
+        crowd = Crowd(self.crowd_world, avatar_collisions=False)
+        avatars = self._add_avatars(crowd, 100, rnd)
+        margin = 40
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tick in range(200):
+                # steps of every tick and long ones (see CollisionGrid.sweep)
+                steps_x = [rnd.choice([0, 1, -1, 2.5, -2.5, rnd.uniform(-3, 3), rnd.uniform(-90, 90)]) for avatar in avatars]
+                steps_y = [rnd.choice([0, 1, -1, 1.77, -1.77, rnd.uniform(-3, 3), rnd.uniform(-70, 70)]) for avatar in avatars]
+                for idx, avatar in enumerate(avatars):
+                    if not (margin < avatar.pos_x < self.world_map.pixel_width - margin and
+                            margin < avatar.pos_y < self.world_map.pixel_height - margin):
+                        steps_x[idx] = steps_y[idx] = 0
+                    avatar.try_to_move(self.world, 16, steps_x[idx], steps_y[idx])
+                crowd.step_x[:] = steps_x
+                crowd.step_y[:] = steps_y
+                crowd.tick()
+                for avatar, view in zip(avatars, crowd.avatars):
+                    self.assertEqual(
+                        (avatar.pos_x, avatar.pos_y, avatar.z, avatar.layer, avatar.dir_id, avatar.move_id,
+                         avatar.tile_x, avatar.tile_y, avatar.distance),
+                        (view.pos_x, view.pos_y, view.z, view.layer, view.dir_id, view.move_id,
+                         view.tile_x, view.tile_y, view.distance))
+        self.assertTrue(len(set(avatar.layer for avatar in avatars)) > 1, "no avatar changed the level")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,317 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+
+THIS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+
+p = os.path.join(THIS_DIR, os.pardir)
+sys.path.insert(0, p)
+
+import io
+import json
+import heapq
+import random
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from common import *
+init_headless_display()
+
+import tiledtmxloader
+from world import World
+from pathfinding import Pathfinder, ClusterGraph, FlowFieldCache
+from avatar import create_hero_avatar
+
+
+def get_costs(nav_grid, start_node):
+    """
+    :Returns: dict of the costs of the shortest paths to the nodes reached
+              from a node (Dijkstra).
+    """
+    costs = {start_node: 0.0}
+    open_heap = [(0.0, start_node)]
+    while open_heap:
+        cost, node = heapq.heappop(open_heap)
+        if cost > costs[node]:
+            continue
+        for next_node, edge_cost in nav_grid.get_neighbours(node):
+            if cost + edge_cost < costs.get(next_node, float('inf')):
+                costs[next_node] = cost + edge_cost
+                heapq.heappush(open_heap, (cost + edge_cost, next_node))
+    return costs
+
+def get_path_cost(nav_grid, path):
+    """
+    :Returns: the cost of a path of tiles, a KeyError if it is not one.
+    """
+    cost = 0.0
+    for tile, next_tile in zip(path, path[1:]):
+        edge_costs = dict(nav_grid.get_neighbours(nav_grid.get_node(*tile)))
+        cost += edge_costs[nav_grid.get_node(*next_tile)]
+    return cost
+
+
+class PathfinderTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(world_map, headless=True)
+        self.pathfinder = Pathfinder(self.world)
+        self.nav_grid = self.pathfinder.nav_grid
+
+    def tearDown(self):
+        self.pathfinder.close()
+
+    def test_find_path_costs_like_dijkstra(self):
+        nav_grid = self.nav_grid
+        rnd = random.Random(0)
+        walkable = [node for node in range(len(nav_grid.walkable)) if nav_grid.walkable[node]]
+        for query in range(30):
+            start_node = rnd.choice(walkable)
+            costs = get_costs(self.nav_grid, start_node)
+            reachable = sorted(costs)
+            for goal in range(40):
+                goal_node = rnd.choice(reachable)
+                start, goal = nav_grid.get_tile(start_node), nav_grid.get_tile(goal_node)
+                path = self.pathfinder.find_path(start, goal)
+                self.assertIsNotNone(path, "no path from {} to {}".format(start, goal))
+                self.assertAlmostEqual(get_path_cost(self.nav_grid, path), costs[goal_node], 6,
+                                       "path from {} to {} is not the shortest".format(start, goal))
+
+    def test_find_path_across_levels(self):
+        start, goal = (3, 4, 0), (1, 24, 48)
+        costs = get_costs(self.nav_grid, self.nav_grid.get_node(*start))
+        path = self.pathfinder.find_path(start, goal)
+        self.assertAlmostEqual(get_path_cost(self.nav_grid, path), costs[self.nav_grid.get_node(*goal)], 6)
+
+    def _get_walked_neighbours(self, avatar, node):
+        """
+        :Returns: set of the nodes an avatar walking from the center of the
+                  tile of a node to the centers of its neighbours ends on.
+        """
+        nav_grid = self.nav_grid
+        level, tile_x, tile_y = nav_grid.get_tile(node)
+        start_x, start_y = nav_grid.get_tile_center(tile_x, tile_y)
+        walked = set()
+        for dir_x, dir_y in nav_grid.DIRECTIONS:
+            avatar.pos_x, avatar.pos_y, avatar.layer = start_x, start_y, level
+            for step in range(16):
+                avatar.try_to_move(self.world, 16.0, dir_x * nav_grid.tilewidth / 16.0, dir_y * nav_grid.tileheight / 16.0)
+            end_x = int(avatar.pos_x // nav_grid.tilewidth)
+            end_y = int(avatar.pos_y // nav_grid.tileheight)
+            if (avatar.pos_x, avatar.pos_y) == nav_grid.get_tile_center(end_x, end_y) and (end_x, end_y) != (tile_x, tile_y):
+                walked.add(nav_grid.get_node(avatar.layer, end_x, end_y))
+        return walked
+
+    def test_edges_like_walking_avatars(self):
+        nav_grid = self.nav_grid
+        level = min(nav_grid.levels)
+        flow_fields = FlowFieldCache(self.world)
+        # flat tiles blocking with some edges only, beside the open floor
+        fences = dict((int(tile.properties['BlockIn']), gid) for gid, tile in self.world.map.tiles.items()
+                      if tile.properties.get('Height', None) == '0' and int(tile.properties.get('BlockIn', 0)) % 15)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tile_x, tile_y, mask in ((6, 6, 10), (8, 6, 5), (7, 8, 14), (4, 9, 11), (9, 9, 6)):
+                self.world.set_metadata_gid(level, tile_x, tile_y, fences[mask])
+            avatar = create_hero_avatar(0, 0, 'ch_01_00.png', headless=True)
+        metadata_layer = self.world.get_metadata_layer(level).sprite_layer
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tile_y in range(3, 12):
+                for tile_x in range(2, 12):
+                    node = nav_grid.get_node(level, tile_x, tile_y)
+                    center_x, center_y = nav_grid.get_tile_center(tile_x, tile_y)
+                    self.assertEqual(nav_grid.walkable[node], self.world.is_walkable(center_x, center_y, metadata_layer))
+                    if not nav_grid.walkable[node]:
+                        continue
+                    neighbours = set(next_node for next_node, cost in nav_grid.get_neighbours(node))
+                    walked = self._get_walked_neighbours(avatar, node)
+                    self.assertTrue(neighbours <= walked)
+                    # only left out: diagonals past the corners of fences,
+                    # walkable with some steps but not with others
+                    for next_node in walked - neighbours:
+                        next_level, next_x, next_y = nav_grid.get_tile(next_node)
+                        self.assertTrue(next_x != tile_x and next_y != tile_y)
+                        self.assertFalse(nav_grid.walkable[nav_grid.get_node(level, next_x, tile_y)] and
+                                         nav_grid.walkable[nav_grid.get_node(level, tile_x, next_y)])
+                    edges = flow_fields.get_edges(level)
+                    for direction, (dir_x, dir_y) in enumerate(nav_grid.DIRECTIONS):
+                        next_node = nav_grid.get_node(level, tile_x + dir_x, tile_y + dir_y)
+                        self.assertEqual(edges[direction][tile_y, tile_x], next_node in neighbours)
+
+
+class HierarchicalPathfinderTests(unittest.TestCase):
+
+    CLUSTER_SIZE = 8
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(world_map, headless=True)
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'test.clusters.json')
+        self.pathfinder = Pathfinder(self.world, cluster_size=self.CLUSTER_SIZE, cluster_file_name=self.file_name)
+        self.nav_grid = self.pathfinder.nav_grid
+
+    def tearDown(self):
+        self.pathfinder.close()
+        shutil.rmtree(self.directory)
+
+    def _get_graph(self, cluster_graph):
+        return (sorted((cluster, sorted(edges)) for cluster, edges in cluster_graph.outgoing.items() if edges),
+                sorted((node, sorted(costs)) for node, costs in cluster_graph.intra_costs.items()))
+
+    def test_path_costs_near_shortest(self):
+        nav_grid = self.nav_grid
+        rnd = random.Random(0)
+        walkable = [node for node in range(len(nav_grid.walkable)) if nav_grid.walkable[node]]
+        cost = shortest_cost = 0.0
+        for query in range(20):
+            start_node = rnd.choice(walkable)
+            costs = get_costs(nav_grid, start_node)
+            for goal in range(20):
+                goal_node = rnd.choice(walkable)
+                start, goal = nav_grid.get_tile(start_node), nav_grid.get_tile(goal_node)
+                path = self.pathfinder.find_path(start, goal)
+                if goal_node not in costs:
+                    self.assertIsNone(path, "path from {} to {} not found by Dijkstra".format(start, goal))
+                    continue
+                self.assertIsNotNone(path, "no path from {} to {}".format(start, goal))
+                self.assertEqual((path[0], path[-1]), (start, goal))
+                path_cost = get_path_cost(nav_grid, path)
+                self.assertTrue(path_cost >= costs[goal_node] - 1e-6)
+                self.assertEqual(list(self.pathfinder.iter_path(start, goal)), path)
+                cost += path_cost
+                shortest_cost += costs[goal_node]
+        # about 6% longer (see benchmark.py hpa)
+        self.assertTrue(shortest_cost > 0.0)
+        self.assertTrue(cost <= 1.1 * shortest_cost, "paths {:.1%} of the shortest".format(cost / shortest_cost))
+
+    def test_load_saved_graph(self):
+        cluster_graph = ClusterGraph(self.nav_grid, self.CLUSTER_SIZE)
+        self.assertTrue(cluster_graph.load(self.file_name))
+        self.assertEqual(self._get_graph(cluster_graph), self._get_graph(self.pathfinder.cluster_graph))
+
+        # a graph of an older version or another map is built again
+        with open(self.file_name) as f:
+            data = json.load(f)
+        for key, value in (('version', ClusterGraph.VERSION - 1), ('fingerprint', data['fingerprint'] + 1)):
+            with open(self.file_name, 'w') as f:
+                json.dump(dict(data, **{key: value}), f)
+            self.assertFalse(ClusterGraph(self.nav_grid, self.CLUSTER_SIZE).load(self.file_name))
+
+    def test_repair_like_build(self):
+        level = min(self.nav_grid.levels)
+        wall = self.world.get_metadata_gid(level, 12, 25)
+        floor = self.world.get_metadata_gid(level, 5, 5)
+        rnd = random.Random(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for edit in range(10):
+                tile_x = rnd.randrange(1, self.nav_grid.num_tiles_x - 1)
+                tile_y = rnd.randrange(1, self.nav_grid.num_tiles_y - 1)
+                self.world.set_metadata_gid(level, tile_x, tile_y, rnd.choice((wall, floor)))
+        cluster_graph = ClusterGraph(self.nav_grid, self.CLUSTER_SIZE)
+        cluster_graph.build()
+        self.assertEqual(self._get_graph(self.pathfinder.cluster_graph), self._get_graph(cluster_graph))
+
+
+class FlowFieldTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(world_map, headless=True)
+        self.flow_fields = FlowFieldCache(self.world)
+        self.pathfinder = Pathfinder(self.world)
+        self.nav_grid = self.pathfinder.nav_grid
+        self.level = min(self.nav_grid.levels)
+        base = self.nav_grid.level_bases[self.level]
+        self.walkable = [self.nav_grid.get_tile(node)[1:] for node in range(base, base + self.nav_grid.tiles_per_level)
+                         if self.nav_grid.walkable[node]]
+
+    def tearDown(self):
+        self.flow_fields.close()
+        self.pathfinder.close()
+
+    def test_directions_reach_target(self):
+        nav_grid = self.nav_grid
+        rnd = random.Random(0)
+        for target in range(5):
+            target_x, target_y = rnd.choice(self.walkable)
+            field = self.flow_fields.get_field(self.level, target_x, target_y)
+            num_reached = 0
+            for tile_x, tile_y in self.walkable:
+                if field.costs[tile_y, tile_x] == float('inf'):
+                    self.assertEqual(field.directions[tile_y, tile_x], -1)
+                    continue
+                # the edge costs along the directions add up to the cost
+                start_cost = field.costs[tile_y, tile_x]
+                cost = 0.0
+                for step in range(nav_grid.tiles_per_level):
+                    if (tile_x, tile_y) == (target_x, target_y):
+                        break
+                    direction = field.directions[tile_y, tile_x]
+                    self.assertTrue(direction >= 0)
+                    node = nav_grid.get_node(self.level, tile_x, tile_y)
+                    dir_x, dir_y = nav_grid.DIRECTIONS[direction]
+                    tile_x, tile_y = tile_x + dir_x, tile_y + dir_y
+                    cost += dict(nav_grid.get_neighbours(node))[nav_grid.get_node(self.level, tile_x, tile_y)]
+                self.assertEqual((tile_x, tile_y), (target_x, target_y))
+                self.assertAlmostEqual(cost, start_cost, 6)
+                num_reached += 1
+            self.assertTrue(num_reached > 1)
+
+    def test_costs_like_find_path(self):
+        nav_grid = self.nav_grid
+        rnd = random.Random(0)
+        num_on_level = 0
+        for target in range(5):
+            target_x, target_y = rnd.choice(self.walkable)
+            field = self.flow_fields.get_field(self.level, target_x, target_y)
+            for start in range(20):
+                start_x, start_y = rnd.choice(self.walkable)
+                path = self.pathfinder.find_path((self.level, start_x, start_y), (self.level, target_x, target_y))
+                cost = field.costs[start_y, start_x]
+                if path is None:
+                    self.assertEqual(cost, float('inf'))
+                    continue
+                path_cost = get_path_cost(nav_grid, path)
+                # the field stays on its level, shortest paths on the level
+                # cost the same
+                if all(level == self.level for level, tile_x, tile_y in path):
+                    self.assertAlmostEqual(cost, path_cost, 6)
+                    num_on_level += 1
+                else:
+                    self.assertTrue(cost >= path_cost - 1e-6)
+        self.assertTrue(num_on_level > 0)
+
+    def test_avatars_walk_to_target(self):
+        rnd = random.Random(0)
+        target_x, target_y = rnd.choice(self.walkable)
+        field = self.flow_fields.get_field(self.level, target_x, target_y)
+        tilewidth, tileheight = self.nav_grid.tilewidth, self.nav_grid.tileheight
+        starts = [tile for tile in self.walkable if field.costs[tile[1], tile[0]] < float('inf')]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for start_x, start_y in rnd.sample(starts, 10):
+                avatar = create_hero_avatar((start_x + 0.5) * tilewidth, (start_y + 0.5) * tileheight,
+                                            'ch_01_00.png', headless=True)
+                avatar.layer = self.level
+                for tick in range(3000):
+                    if avatar.layer != self.level or \
+                       (int(avatar.pos_x // tilewidth), int(avatar.pos_y // tileheight)) == (target_x, target_y):
+                        break
+                    avatar.move_along(self.world, 16.0, field, 2.0)
+                self.assertEqual((avatar.layer, int(avatar.pos_x // tilewidth), int(avatar.pos_y // tileheight)),
+                                 (self.level, target_x, target_y),
+                                 "avatar from ({}, {}) did not reach the target".format(start_x, start_y))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+
+THIS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+
+p = os.path.join(THIS_DIR, os.pardir)
+sys.path.insert(0, p)
+
+import io
+import time
+import unittest
+import contextlib
+
+from common import *
+init_headless_display()
+
+from profiler import FrameProfiler, SamplingProfiler
+
+
+class FrameProfilerTests(unittest.TestCase):
+
+    def test_nested_scopes_of_a_name(self):
+        profiler = FrameProfiler()
+        profiler.begin_frame()
+        with profiler.scope('render'):
+            time.sleep(0.002)
+            with profiler.scope('render'):
+                time.sleep(0.001)
+            time.sleep(0.002)
+        profiler.end_frame()
+        (inner_name, inner_start, inner_end), (outer_name, outer_start, outer_end) = profiler.frames[-1][2]
+        self.assertEqual((inner_name, outer_name), ('render', 'render'))
+        self.assertTrue(outer_start < inner_start < inner_end < outer_end)
+        self.assertTrue(outer_end - outer_start >= 0.005)
+
+    def test_recursive_scopes(self):
+        profiler = FrameProfiler()
+
+        def recurse(depth):
+            with profiler.scope('recurse'):
+                if depth:
+                    recurse(depth - 1)
+
+        profiler.begin_frame()
+        recurse(5)
+        profiler.end_frame()
+        events = profiler.frames[-1][2]
+        self.assertEqual(len(events), 6)
+        # innermost first, each inside the next one
+        for (name, start, end), (next_name, next_start, next_end) in zip(events, events[1:]):
+            self.assertTrue(next_start <= start <= end <= next_end)
+
+
+class SamplingProfilerTests(unittest.TestCase):
+
+    def test_summary_without_samples(self):
+        sampler = SamplingProfiler()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            sampler.print_summary()
+        self.assertEqual(output.getvalue(), "~ 0 samples every 1 ms\n")
+
+    def test_summary(self):
+        sampler = SamplingProfiler()
+        sampler.start()
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            pass
+        sampler.stop()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            sampler.print_summary()
+        lines = output.getvalue().splitlines()
+        self.assertTrue(len(lines) > 1)
+        self.assertAlmostEqual(sum(float(line.split('%')[0]) for line in lines[1:]), 100.0, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
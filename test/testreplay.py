@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+
+THIS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+
+p = os.path.join(THIS_DIR, os.pardir)
+sys.path.insert(0, p)
+
+import io
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from common import *
+init_headless_display()
+
+import benchmark
+from main import replay_headless, create_demo_world, DemoSimulation
+from replay import InputRecording, get_directions, KEY_LEFT, KEY_RIGHT
+
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        self.directory = tempfile.mkdtemp()
+        self.recording = benchmark.make_scripted_recording(os.path.join('data', 'maps', 'test.tmx'), 120)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _replay(self, recording):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return replay_headless(recording)
+
+    def test_replay_saved_recording(self):
+        file_name = os.path.join(self.directory, 'run.json')
+        self.recording.save(file_name)
+        recording = InputRecording.load(file_name)
+        self.assertEqual(recording.frames, self.recording.frames)
+        frame_times, first_difference = self._replay(recording)
+        self.assertEqual(len(frame_times), 120)
+        self.assertIsNone(first_difference)
+
+    def test_replay_other_keys(self):
+        frames = list(self.recording.frames)
+        # the hero walks the other way from this frame on
+        direction_x, direction_y = get_directions(frames[40][1])
+        frames[40:] = [(dt, KEY_LEFT if direction_x >= 0 else KEY_RIGHT, state_hash)
+                       for dt, keys, state_hash in frames[40:]]
+        recording = InputRecording(self.recording.map_file_name, self.recording.tick_rate,
+                                   self.recording.max_catch_up, frames)
+        frame_times, first_difference = self._replay(recording)
+        self.assertIsNotNone(first_difference)
+        self.assertTrue(40 <= first_difference <= 42)
+
+    def test_other_avatars_scheduled(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            world, hero = create_demo_world(self.recording.map_file_name, headless=True)
+        simulation = DemoSimulation(world, hero, self.recording.tick_rate, self.recording.max_catch_up)
+        avatars = [entry.avatar for entry in simulation.scheduler.entry_list]
+        self.assertTrue(avatars)
+        self.assertEqual(set(avatars), world.avatars - set([hero]))
+        # one of them walks to the right
+        walker = avatars[0]
+        simulation.scheduler.remove(walker)
+        simulation.add_avatar(walker, lambda world, delta_time: walker.try_to_move(world, delta_time, 0.5, 0))
+        start_x = walker.pos_x
+        with contextlib.redirect_stdout(io.StringIO()):
+            for frame in range(10):
+                simulation.tick(simulation.tick_ms, 0)
+                simulation.update_camera()
+        self.assertEqual(simulation.scheduler.ticks, 10)
+        self.assertTrue(walker.pos_x > start_x)
+
+    def test_load_other_file(self):
+        file_name = os.path.join(self.directory, 'other.json')
+        with open(file_name, 'w') as f:
+            f.write('{"version": 0}')
+        self.assertRaises(ValueError, InputRecording.load, file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
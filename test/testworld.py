@@ -0,0 +1,408 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+
+THIS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+
+p = os.path.join(THIS_DIR, os.pardir)
+sys.path.insert(0, p)
+
+import io
+import math
+import random
+import unittest
+import contextlib
+
+from common import *
+init_headless_display()
+
+import pygame
+import tiledtmxloader
+from world import World, Trigger
+from avatar import Avatar, create_hero_avatar
+from replay import get_state_hash
+import benchmark
+
+
+class CollisionGridTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(world_map, headless=True)
+            self.avatar = create_hero_avatar(0, 0, 'ch_01_00.png', headless=True)
+
+    def _check_collision(self, pos_x, pos_y, step_x, step_y, metadata_layer):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.avatar.check_collision(self.world, pos_x, pos_y, step_x, step_y, metadata_layer)
+
+    def _check_blocked_steps(self, level, rnd, num_checks, tiles=None):
+        grid = self.world.get_collision_grid(level)
+        metadata_layer = self.world.get_metadata_layer(level).sprite_layer
+        tilewidth, tileheight = grid.tilewidth, grid.tileheight
+        for check in range(num_checks):
+            if tiles:
+                tile_x, tile_y = rnd.choice(tiles)
+                pos_x = (tile_x + rnd.random()) * tilewidth
+                pos_y = (tile_y + rnd.random()) * tileheight
+            else:
+                pos_x = rnd.uniform(tilewidth, (grid.num_tiles_x - 1) * tilewidth - 1)
+                pos_y = rnd.uniform(tileheight, (grid.num_tiles_y - 1) * tileheight - 1)
+            rect = pygame.Rect(0, 0, 32, 5)
+            rect.midbottom = (pos_x, pos_y)
+            args = (rect, int(pos_x // tilewidth), int(pos_y // tileheight),
+                    special_round(rnd.uniform(-3, 3)), special_round(rnd.uniform(-3, 3)))
+            self.assertEqual(grid.get_blocked_steps(*args),
+                             benchmark.check_collision_tiles(self.world, *args, metadata_layer),
+                             "level {} check {}".format(level, args))
+
+    def test_blocked_steps_like_tile_check(self):
+        rnd = random.Random(0)
+        for level in sorted(self.world.world_layers):
+            if self.world.get_collision_grid(level):
+                self._check_blocked_steps(level, rnd, 2000)
+
+    def test_blocked_steps_after_tile_update(self):
+        rnd = random.Random(0)
+        level = min(self.world.world_layers)
+        wall = self.world.get_metadata_gid(level, 12, 25)
+        floor = self.world.get_metadata_gid(level, 5, 5)
+        # a wall on a walkable tile, a walkable tile in a wall, back again
+        for tile_x, tile_y, gid in ((5, 5, wall), (12, 25, floor), (5, 5, floor), (12, 25, wall)):
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.world.set_metadata_gid(level, tile_x, tile_y, gid)
+            tiles = [(tile_x + dir_x, tile_y + dir_y) for dir_x in (-1, 0, 1) for dir_y in (-1, 0, 1)]
+            self._check_blocked_steps(level, rnd, 500, tiles)
+
+    def test_long_steps_blocked_like_short_steps(self):
+        # (bit, dir_x, dir_y) of the edges, see CollisionGrid.NEIGHBOURS
+        edges = ((1<<0, 0, -1), (1<<1, 0, 1), (1<<2, -1, 0), (1<<3, 1, 0))
+        num_edges = 0
+        for level in sorted(self.world.world_layers):
+            grid = self.world.get_collision_grid(level)
+            if not grid:
+                continue
+            self.avatar.layer = level
+            metadata_layer = self.world.get_metadata_layer(level).sprite_layer
+            tilewidth, tileheight = grid.tilewidth, grid.tileheight
+            half_width = self.avatar.rect.width / 2.0
+            for tile_y in range(1, grid.num_tiles_y - 1):
+                for tile_x in range(1, grid.num_tiles_x - 1):
+                    idx = tile_y * grid.num_tiles_x + tile_x
+                    mask = grid.masks[idx]
+                    for bit, dir_x, dir_y in edges:
+                        if not mask & bit:
+                            continue
+                        # the feet 2 pixels before the edge, on a free tile
+                        left, top, right, bottom = grid.rects[idx]
+                        if dir_x > 0:
+                            pos_x, pos_y = left - 2 - half_width, tile_y * tileheight + tileheight // 2 + 3
+                        elif dir_x < 0:
+                            pos_x, pos_y = right + 2 + half_width, tile_y * tileheight + tileheight // 2 + 3
+                        elif dir_y > 0:
+                            pos_x, pos_y = (tile_x + 0.5) * tilewidth, top - 2
+                        else:
+                            pos_x, pos_y = (tile_x + 0.5) * tilewidth, bottom + 2 + self.avatar.COLLISION_HEIGHT
+                        if grid.masks[int(pos_y // tileheight) * grid.num_tiles_x + int(pos_x // tilewidth)]:
+                            continue
+                        num_edges += 1
+                        short_step = self._check_collision(pos_x, pos_y, 3 * dir_x, 3 * dir_y, metadata_layer)
+                        long_step = self._check_collision(pos_x, pos_y, 64 * dir_x, 64 * dir_y, metadata_layer)
+                        short_blocked = short_step == (0, 0)
+                        long_blocked = abs(long_step[0] + long_step[1]) < 3
+                        self.assertEqual(short_blocked, long_blocked,
+                            "level {} tile ({}, {}) mask {} edge {}: 3 px step {}, 64 px step {}".format(
+                                level, tile_x, tile_y, mask, bit, short_step, long_step))
+        self.assertTrue(num_edges > 0, "no blocking edges in test.tmx")
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        self.world, walkers = benchmark.create_headless_worlds(world_map, 1, 20)[0]
+        self.avatars = [walker.avatar for walker in walkers]
+        self.level = min(self.world.world_layers)
+
+    def _walk(self, num_ticks):
+        world = self.world
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tick in range(num_ticks):
+                world.begin_tick()
+                for idx, avatar in enumerate(self.avatars):
+                    angle = idx + tick * 0.05
+                    avatar.try_to_move(world, 16.0, 2.4 * math.cos(angle), 1.7 * math.sin(angle))
+                world.resolve_avatar_collisions()
+                world.end_tick()
+
+    def _edit_tile(self):
+        # a walkable tile gets the gid of a wall
+        gid = self.world.get_metadata_gid(self.level, 12, 25)
+        self.assertNotEqual(self.world.get_metadata_gid(self.level, 5, 5), gid)
+        self.world.set_metadata_gid(self.level, 5, 5, gid)
+
+    def test_restore_full(self):
+        base = self.world.snapshot()
+        state_hash = get_state_hash(self.world)
+        gid = self.world.get_metadata_gid(self.level, 5, 5)
+        self._walk(60)
+        self._edit_tile()
+        self.assertNotEqual(get_state_hash(self.world), state_hash)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world.restore(base)
+        self.assertEqual(get_state_hash(self.world), state_hash)
+        self.assertEqual(self.world.get_metadata_gid(self.level, 5, 5), gid)
+        self.assertEqual(self.world.edited_tiles, set())
+
+    def test_simulation_continues_after_restore(self):
+        base = self.world.snapshot()
+        self._walk(60)
+        state_hash = get_state_hash(self.world)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world.restore(base)
+        self._walk(60)
+        self.assertEqual(get_state_hash(self.world), state_hash)
+
+    def test_restore_delta(self):
+        base = self.world.snapshot()
+        self._walk(30)
+        self._edit_tile()
+        full = self.world.snapshot()
+        delta = self.world.snapshot(base)
+        self.assertTrue(len(delta) < len(full))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world.restore(base)
+            self.world.restore(delta, base)
+        self.assertEqual(self.world.snapshot(), full)
+
+    def test_wrong_base(self):
+        base = self.world.snapshot()
+        self._walk(10)
+        delta = self.world.snapshot(base)
+        self.assertRaises(ValueError, self.world.snapshot, delta)
+        self.assertRaises(ValueError, self.world.restore, delta, delta)
+
+    def test_avatars_added_since_base(self):
+        base = self.world.snapshot()
+        with contextlib.redirect_stdout(io.StringIO()):
+            avatar = create_hero_avatar(self.avatars[0].pos_x, self.avatars[0].pos_y, 'ch_01_00.png', headless=True)
+            self.world.add_avatar(avatar)
+        self.assertRaises(ValueError, self.world.snapshot, base)
+        self.assertRaises(ValueError, self.world.restore, base)
+
+    def test_delta_without_base(self):
+        base = self.world.snapshot()
+        self._walk(10)
+        delta = self.world.snapshot(base)
+        self.assertRaises(ValueError, self.world.restore, delta)
+
+
+class SpatialHashTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        self.world, walkers = benchmark.create_headless_worlds(world_map, 1, 200)[0]
+        self.avatars = [walker.avatar for walker in walkers]
+        self.rnd = random.Random(0)
+
+    def _walk(self, num_ticks):
+        rnd = self.rnd
+        with contextlib.redirect_stdout(io.StringIO()):
+            for tick in range(num_ticks):
+                for avatar in self.avatars:
+                    avatar.try_to_move(self.world, 16.0, rnd.uniform(-20, 20), rnd.uniform(-20, 20))
+
+    def _check_queries(self, num_queries):
+        world = self.world
+        rnd = self.rnd
+        width = world.map.pixel_width
+        height = world.map.pixel_height
+        for query in range(num_queries):
+            level = rnd.choice(sorted(world.world_layers))
+            avatars = [avatar for avatar in world.avatars if avatar.layer == level]
+            pos_x = rnd.uniform(-100, width + 100)
+            pos_y = rnd.uniform(-100, height + 100)
+            radius = rnd.choice([0, 5, 32, rnd.uniform(0, 300), rnd.uniform(0, 3000)])
+            self.assertEqual(
+                set(world.get_avatars_in_radius(level, pos_x, pos_y, radius)),
+                set(avatar for avatar in avatars
+                    if (avatar.pos_x - pos_x) ** 2 + (avatar.pos_y - pos_y) ** 2 <= radius * radius))
+            rect = pygame.Rect(int(pos_x), int(pos_y), int(rnd.uniform(0, 2 * radius)), int(rnd.uniform(0, 2 * radius)))
+            self.assertEqual(
+                set(world.get_avatars_in_rect(level, rect)),
+                set(avatar for avatar in avatars if rect.collidepoint(avatar.pos_x, avatar.pos_y)))
+
+    def test_queries_like_brute_force(self):
+        self._check_queries(500)
+        self._walk(50)
+        self._check_queries(500)
+        self.assertTrue(len(set(avatar.layer for avatar in self.avatars)) > 1, "no avatar changed the level")
+
+    def test_each_avatar_in_one_hash(self):
+        self._walk(50)
+        for avatar in self.avatars:
+            levels = [level for level, spatial_hash in self.world.spatial_hashes.items() if avatar in spatial_hash]
+            self.assertEqual(levels, [avatar.layer])
+
+    def test_remove(self):
+        spatial_hash = self.world.get_spatial_hash(1)
+        removed = [avatar for avatar in self.avatars[::2] if avatar in spatial_hash]
+        for avatar in removed:
+            spatial_hash.remove(avatar)
+            spatial_hash.remove(avatar)
+        self.assertTrue(removed)
+        found = spatial_hash.query_rect(-1, -1, self.world.map.pixel_width + 1, self.world.map.pixel_height + 1)
+        self.assertEqual(len(found), len(spatial_hash))
+        self.assertFalse(set(found) & set(removed))
+        self.assertEqual(set(found), set(avatar for avatar in self.world.avatars if avatar.layer == 1) - set(removed))
+        self.assertTrue(all(spatial_hash.cells.values()))
+
+
+class AvatarCollisionTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(world_map, headless=True)
+        # the open floor around tile (5, 5) of level 1
+        self.pos_x = 5.5 * world_map.tilewidth
+        self.pos_y = 5.5 * world_map.tileheight
+
+    def _add_avatar(self, pos_x, pos_y):
+        with contextlib.redirect_stdout(io.StringIO()):
+            avatar = create_hero_avatar(pos_x, pos_y, 'ch_01_00.png', headless=True)
+            self.world.add_avatar(avatar)
+        return avatar
+
+    def _resolve(self, avatar, other):
+        self.assertEqual(self.world.get_avatar_pairs(1), [(avatar, other)])
+        self.assertIsNotNone(avatar.get_push(other))
+        mid_x = (avatar.pos_x + other.pos_x) / 2.0
+        mid_y = (avatar.pos_y + other.pos_y) / 2.0
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.world.resolve_avatar_collisions(), 1)
+        self.assertIsNone(avatar.get_push(other))
+        # pushed apart half each
+        self.assertAlmostEqual((avatar.pos_x + other.pos_x) / 2.0, mid_x)
+        self.assertAlmostEqual((avatar.pos_y + other.pos_y) / 2.0, mid_y)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.world.resolve_avatar_collisions(), 0)
+
+    def test_push_apart_vertically(self):
+        avatar = self._add_avatar(self.pos_x, self.pos_y)
+        other = self._add_avatar(self.pos_x + 4, self.pos_y + 1)
+        self._resolve(avatar, other)
+        self.assertEqual((avatar.pos_x, other.pos_x), (self.pos_x, self.pos_x + 4))
+        self.assertTrue(avatar.pos_y < self.pos_y)
+        self.assertTrue(other.pos_y > self.pos_y + 1)
+
+    def test_push_apart_horizontally(self):
+        avatar = self._add_avatar(self.pos_x, self.pos_y)
+        other = self._add_avatar(self.pos_x - avatar.rect.width + 2, self.pos_y)
+        self._resolve(avatar, other)
+        self.assertEqual((avatar.pos_y, other.pos_y), (self.pos_y, self.pos_y))
+        self.assertTrue(avatar.pos_x > self.pos_x)
+
+    def test_apart_avatars_stay(self):
+        avatar = self._add_avatar(self.pos_x, self.pos_y)
+        other = self._add_avatar(self.pos_x, self.pos_y + Avatar.COLLISION_HEIGHT)
+        far = self._add_avatar(self.pos_x + avatar.rect.width, self.pos_y)
+        # touching feet boxes do not overlap
+        self.assertEqual(self.world.get_avatar_pairs(1), [])
+        self.assertIsNone(avatar.get_push(other))
+        self.assertIsNone(avatar.get_push(far))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.world.resolve_avatar_collisions(), 0)
+        self.assertEqual([(a.pos_x, a.pos_y) for a in (avatar, other, far)],
+                         [(self.pos_x, self.pos_y), (self.pos_x, self.pos_y + Avatar.COLLISION_HEIGHT),
+                          (self.pos_x + avatar.rect.width, self.pos_y)])
+
+
+class TriggerTests(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(p)
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(os.path.join('data', 'maps', 'test.tmx'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.world = World(world_map, headless=True)
+        objects_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode(
+            os.path.join('tiledtmxloader', 'test', 'objects.tmx'))
+        self.objects = dict((obj.name, obj) for layer in objects_map.layers if layer.is_object_group
+                            for obj in layer.objects)
+        # the objects on the open floor from tile (5, 5) of level 1 on
+        self.offset_x = 5 * world_map.tilewidth
+        self.offset_y = 5 * world_map.tileheight
+        self.events = []
+        self.world.trigger_listeners.append(
+            lambda avatar, trigger, entered: self.events.append((avatar, trigger.id, entered)))
+
+    def _add_trigger(self, name):
+        trigger = Trigger.from_map_object(1, self.objects[name], self.offset_x, self.offset_y)
+        self.world.add_trigger(trigger)
+        return trigger
+
+    def _add_avatar(self, pos_x, pos_y):
+        with contextlib.redirect_stdout(io.StringIO()):
+            avatar = create_hero_avatar(pos_x, pos_y, 'ch_01_00.png', headless=True)
+            self.world.add_avatar(avatar)
+        return avatar
+
+    def _walk(self, avatar, step_x, step_y, num_steps, trigger):
+        inside = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for step in range(num_steps):
+                avatar.try_to_move(self.world, 16.0, step_x, step_y)
+                self.assertEqual(self.world.avatar_triggers.get(avatar, ()),
+                                 (trigger,) if trigger.contains(avatar.pos_x, avatar.pos_y) else ())
+                inside.append(trigger.contains(avatar.pos_x, avatar.pos_y))
+        return inside
+
+    def test_map_objects(self):
+        pond = Trigger.from_map_object(1, self.objects['pond'], self.offset_x, self.offset_y)
+        self.assertEqual((pond.left, pond.top, pond.right, pond.bottom),
+                         (self.offset_x + 10, self.offset_y + 20, self.offset_x + 40, self.offset_y + 44.5))
+        self.assertEqual(len(pond.polygon), 3)
+        door = Trigger.from_map_object(1, self.objects['door'], self.offset_x, self.offset_y)
+        self.assertEqual((door.polygon, door.id, door.type), (None, 'door', 'trigger'))
+        self.assertIsNone(Trigger.from_map_object(1, self.objects['path']))
+
+    def test_polygon_enter_exit(self):
+        pond = self._add_trigger('pond')
+        # through the triangle from its top edge to below its tip
+        avatar = self._add_avatar(self.offset_x + 25, self.offset_y + 10)
+        self.assertEqual(self.events, [])
+        inside = self._walk(avatar, 0, 1, 45, pond)
+        self.assertEqual(self.events, [(avatar, 'pond', True), (avatar, 'pond', False)])
+        self.assertEqual(inside.count(True), 25)
+
+    def test_polygon_bounds_outside(self):
+        pond = self._add_trigger('pond')
+        # in the bounds of the triangle beside its slanted edges
+        avatar = self._add_avatar(self.offset_x + 11, self.offset_y + 42)
+        self.assertFalse(pond.contains(avatar.pos_x, avatar.pos_y))
+        self.assertEqual(self.world.get_triggers_at(1, avatar.pos_x, avatar.pos_y), [])
+        self.assertEqual(self._walk(avatar, 1, 0, 9, pond), [False] * 9)
+        self.assertEqual(self.events, [])
+
+    def test_add_remove_trigger(self):
+        avatar = self._add_avatar(self.offset_x + 25, self.offset_y + 25)
+        pond = self._add_trigger('pond')
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.world.get_triggers_at(1, avatar.pos_x, avatar.pos_y), [pond])
+        # the avatars already in it enter it with their next move
+        with contextlib.redirect_stdout(io.StringIO()):
+            avatar.try_to_move(self.world, 16.0, 0, 0)
+        self.assertEqual(self.events, [(avatar, 'pond', True)])
+        self.world.remove_trigger(pond)
+        self.assertEqual(self.events, [(avatar, 'pond', True), (avatar, 'pond', False)])
+        self.assertEqual(self.world.avatar_triggers.get(avatar, ()), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -53,7 +53,7 @@ def demo_pygame(file_name):
     # init pygame and set up a screen
     pygame.init()
     pygame.display.set_caption("tiledtmxloader - " + file_name + \
-                                                    " - keys: arrows, 0-9, r")
+                                                    " - keys: arrows, 0-9, r, a")
     screen_width = min(1024, world_map.pixel_width)
     screen_height = min(768, world_map.pixel_height)
     screen = pygame.display.set_mode((screen_width, screen_height))
@@ -113,6 +113,12 @@ def demo_pygame(file_name):
                 elif event.key == pygame.K_r:
                     print("resetting layers!")
                     sprite_layers = tiledtmxloader.helperspygame.get_layers_from_map(resources)
+                elif event.key == pygame.K_a:
+                    # let the renderer measure which collapse level is faster
+                    for idx, sprite_layer in enumerate(sprite_layers):
+                        sprite_layers[idx] = renderer.get_fastest_collapsed_layer(screen, sprite_layer)
+                        print("layer %s has collapse level: %s" % \
+                                 (idx, sprite_layers[idx].get_collapse_level()))
                 elif event.key in num_keys:
                     # find out which layer to manipulate
                     idx = num_keys.index(event.key)
@@ -40,6 +40,12 @@ module there is a pygame specific loader and renderer.
 #  -----------------------------------------------------------------------------
 
 from math import ceil
+from collections import OrderedDict
+import bisect
+import copy
+import os
+import time
+import weakref
 
 import pygame
 
@@ -66,11 +72,21 @@ class ResourceLoaderPygame(tmxreader.AbstractResourceLoader):
 
     def __init__(self):
         tmxreader.AbstractResourceLoader.__init__(self)
+        # {gid: key}, keys identify a tile image independently of the map
+        # (source file, area in the source file and flip flags), so images
+        # built out of tiles can be shared between maps using the same tilesets
+        self.indexed_tile_keys = {}
+        # {image: key}, only while loading, weak so a dropped image part can
+        # not pass its key on to another one
+        self._image_part_keys = weakref.WeakKeyDictionary()
 
     def load(self, tile_map):
         tmxreader.AbstractResourceLoader.load(self, tile_map)
         # delete the original images from memory, they are all saved as tiles
         self._img_cache.clear()
+        for gid, (offx, offy, img) in self.indexed_tiles.items():
+            self.indexed_tile_keys[gid] = self._image_part_keys.get(img, None)
+        self._image_part_keys.clear()
         # ISSUE 17: flipped tiles
         for layer in self.world_map.layers:
             if not layer.is_object_group:
@@ -88,6 +104,10 @@ class ResourceLoaderPygame(tmxreader.AbstractResourceLoader):
                             else:
                                 img = pygame.transform.flip(img, bool(gid & self.FLIP_X), bool(gid & self.FLIP_Y))
                             self.indexed_tiles[gid] = (offx, offy, img)
+                            image_key = self.indexed_tile_keys.get(image_gid, None)
+                            if image_key is not None:
+                                image_key = (image_key, gid & (self.FLIP_X | self.FLIP_Y | self.FLIP_DIAGONAL))
+                            self.indexed_tile_keys[gid] = image_key
                         elif gid == 0:  # 0 means no tile!
                             continue
                         else:
@@ -138,6 +158,10 @@ class ResourceLoaderPygame(tmxreader.AbstractResourceLoader):
 
         img_part.blit(source_img, (0, 0), source_rect)
 
+        if isinstance(filename, str):
+            self._image_part_keys[img_part] = \
+                (os.path.abspath(filename), xpos, ypos, width, height, colorkey)
+
         return img_part
 
     def _load_image_file_like(self, file_like_obj, colorkey=None):  # -> image
@@ -163,6 +187,327 @@ class ResourceLoaderPygame(tmxreader.AbstractResourceLoader):
 class SpriteLayerNotCompatibleError(Exception): pass
 
 
+class SpriteImageCache(object):
+    """
+    Keyed cache for the images created by uniting sprites (see
+    SpriteLayer.collapse). The keys are built from the keys of the tile images
+    (see ResourceLoaderPygame.indexed_tile_keys), so one cache can be shared by
+    many layers and maps: a given arrangement of tiles is only rendered once.
+
+    """
+
+    def __init__(self, max_size=None):
+        """
+        Constructor.
+
+        :Parameters:
+            max_size : int
+                Optional, maximum number of images kept, the least recently
+                used ones are dropped first. Defaults to None (no limit).
+        """
+        self._images = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached image for the given key or None.
+        """
+        image = self._images.get(key, None)
+        if image is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if self.max_size is not None:
+                self._images.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        """
+        Stores an image in the cache.
+        """
+        self._images[key] = image
+        if self.max_size is not None:
+            self._images.move_to_end(key)
+            while len(self._images) > self.max_size:
+                self._images.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all the images from the cache and resets the statistics.
+        """
+        self._images.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        return key in self._images
+
+
+# the sprites keep their images, an image dropped from the cache is only
+# rendered again when a layer needs it again
+_shared_image_cache = SpriteImageCache(max_size=8192)
+# the scaled images depend on the zoom, so only the recent ones are kept
+_shared_scaled_image_cache = SpriteImageCache(max_size=8192)
+
+
+def get_shared_image_cache():
+    """
+    Returns the SpriteImageCache used by default by all the SpriteLayers.
+    """
+    return _shared_image_cache
+
+
+def get_shared_scaled_image_cache():
+    """
+    Returns the SpriteImageCache used by default for scaled tile images.
+    """
+    return _shared_scaled_image_cache
+
+
+def _get_draw_cond(sprite):
+    """
+    Default sort key for the dynamic sprites.
+    """
+    return sprite.get_draw_cond()
+
+
+class SpriteGrid(object):
+    """
+    Uniform grid (spatial hash) of the dynamic sprites of a SpriteLayer. Each
+    sprite is registered in the cells its rect touches, so finding the sprites
+    in a rect only looks at the sprites near it. Removing a sprite does not
+    depend on the number of sprites either.
+
+    The grid also keeps the sprites ordered by their draw condition (see
+    get_draw_order). The order is repaired after the sprites moved instead of
+    sorting all of them again.
+
+    :Note: Sprites moved after adding them must be updated (see update),
+           the grid does not notice changes of the rects by itself.
+
+    """
+
+    # above this fraction of moved sprites the draw order is sorted again
+    # instead of moving the sprites one by one
+    resort_fraction = 0.02
+
+    def __init__(self, cell_width, cell_height):
+        """
+        Constructor.
+
+        :Parameters:
+            cell_width : int
+                Width of the cells in pixels.
+            cell_height : int
+                Height of the cells in pixels.
+        """
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.sprites = []
+        self._positions = {}  # {sprite: index in sprites}
+        self._cells = {}  # {(cell_x, cell_y): set of sprites}
+        self._sprite_cells = {}  # {sprite: (left, top, right, bottom) cells}
+        self._heights = {}  # {rect height: number of sprites}
+        # sprites sorted by draw condition, keys is the parallel list of the
+        # draw conditions they are sorted by, moved keeps the old draw
+        # condition of the sprites that changed since the order was repaired
+        self._draw_order = []
+        self._draw_order_keys = []
+        self._draw_keys = {}  # {sprite: draw condition}
+        self._moved = {}  # {sprite: draw condition in draw order}
+
+    def _get_cells(self, rect):
+        cell_w = self.cell_width
+        cell_h = self.cell_height
+        return (int(rect.left // cell_w), int(rect.top // cell_h), \
+                int((rect.right - 1) // cell_w), int((rect.bottom - 1) // cell_h))
+
+    def _link(self, sprite, cells):
+        grid_cells = self._cells
+        left, top, right, bottom = cells
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                cell = grid_cells.get((cell_x, cell_y), None)
+                if cell is None:
+                    grid_cells[(cell_x, cell_y)] = cell = set()
+                cell.add(sprite)
+
+    def _unlink(self, sprite, cells):
+        grid_cells = self._cells
+        left, top, right, bottom = cells
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                cell = grid_cells[(cell_x, cell_y)]
+                cell.discard(sprite)
+                if not cell:
+                    del grid_cells[(cell_x, cell_y)]
+
+    def _count_height(self, height, count):
+        num = self._heights.get(height, 0) + count
+        if num:
+            self._heights[height] = num
+        else:
+            del self._heights[height]
+
+    def add(self, sprite):
+        """
+        Adds a sprite, nothing happens if it is already in the grid.
+        """
+        if sprite in self._positions:
+            return
+        self._positions[sprite] = len(self.sprites)
+        self.sprites.append(sprite)
+        cells = self._get_cells(sprite.rect)
+        self._sprite_cells[sprite] = (cells, sprite.rect.height)
+        self._link(sprite, cells)
+        self._count_height(sprite.rect.height, 1)
+        key = sprite.get_draw_cond()
+        self._draw_keys[sprite] = key
+        idx = bisect.bisect(self._draw_order_keys, key)
+        self._draw_order_keys.insert(idx, key)
+        self._draw_order.insert(idx, sprite)
+
+    def remove(self, sprite):
+        """
+        Removes a sprite, nothing happens if it is not in the grid. The last
+        sprite of the sprites list takes the place of the removed one.
+        """
+        idx = self._positions.pop(sprite, None)
+        if idx is None:
+            return
+        last = self.sprites.pop()
+        if last is not sprite:
+            self.sprites[idx] = last
+            self._positions[last] = idx
+        cells, height = self._sprite_cells.pop(sprite)
+        self._unlink(sprite, cells)
+        self._count_height(height, -1)
+        key = self._moved.pop(sprite, None)
+        if key is None:
+            key = self._draw_keys[sprite]
+        del self._draw_keys[sprite]
+        idx = self._find_in_draw_order(sprite, key)
+        del self._draw_order_keys[idx]
+        del self._draw_order[idx]
+
+    def update(self, sprite):
+        """
+        Updates the cells of a sprite after it moved or changed its size.
+        """
+        cells, height = self._sprite_cells[sprite]
+        new_cells = self._get_cells(sprite.rect)
+        if new_cells != cells:
+            self._unlink(sprite, cells)
+            self._link(sprite, new_cells)
+        if sprite.rect.height != height:
+            self._count_height(height, -1)
+            self._count_height(sprite.rect.height, 1)
+        self._sprite_cells[sprite] = (new_cells, sprite.rect.height)
+        key = sprite.get_draw_cond()
+        old_key = self._draw_keys[sprite]
+        if key != old_key:
+            if sprite not in self._moved:
+                self._moved[sprite] = old_key
+            self._draw_keys[sprite] = key
+
+    def _find_in_draw_order(self, sprite, key):
+        # sprites with the same draw condition are next to each other
+        idx = bisect.bisect_left(self._draw_order_keys, key)
+        return self._draw_order.index(sprite, idx)
+
+    def get_draw_order(self):
+        """
+        Returns the list of the sprites sorted by their draw condition (see
+        SpriteLayer.Sprite.get_draw_cond) as of their last update. Do not
+        modify the returned list.
+        """
+        moved = self._moved
+        if moved:
+            order = self._draw_order
+            keys = self._draw_order_keys
+            if len(moved) > self.resort_fraction * len(order):
+                # the list is nearly sorted, that is fast for list.sort
+                order.sort(key=self._draw_keys.__getitem__)
+                self._draw_order_keys = list(map(self._draw_keys.__getitem__, order))
+            else:
+                # insertion of the moved sprites at their new place
+                draw_keys = self._draw_keys
+                bisect_left = bisect.bisect_left
+                for sprite, old_key in moved.items():
+                    idx = order.index(sprite, bisect_left(keys, old_key))
+                    del keys[idx]
+                    del order[idx]
+                    key = draw_keys[sprite]
+                    idx = bisect.bisect(keys, key)
+                    keys.insert(idx, key)
+                    order.insert(idx, sprite)
+            moved.clear()
+        return self._draw_order
+
+    def update_all(self):
+        """
+        Updates the cells of all the sprites.
+        """
+        for sprite in self.sprites:
+            self.update(sprite)
+
+    def query(self, rect, draw_order=False):
+        """
+        Returns the sprites colliding with the rect, in the same order as in
+        the sprites list or sorted by their draw condition.
+
+        :Parameters:
+            rect : pygame.Rect
+                the rect to check
+            draw_order : bool
+                Optional, defaults to False. Sort the sprites by their draw
+                condition (see get_draw_order).
+        """
+        grid_cells = self._cells
+        left, top, right, bottom = self._get_cells(rect)
+        if (right - left + 1) * (bottom - top + 1) > len(grid_cells):
+            # faster to look at the occupied cells than at the empty ones
+            candidates = set()
+            for (cell_x, cell_y), cell in grid_cells.items():
+                if left <= cell_x <= right and top <= cell_y <= bottom:
+                    candidates.update(cell)
+        else:
+            candidates = set()
+            for cell_y in range(top, bottom + 1):
+                for cell_x in range(left, right + 1):
+                    cell = grid_cells.get((cell_x, cell_y), None)
+                    if cell:
+                        candidates.update(cell)
+        colliderect = rect.colliderect
+        if draw_order and 4 * len(candidates) > len(self.sprites):
+            # most of the sprites, cheaper to filter the ordered list
+            return [sprite for sprite in self.get_draw_order() \
+                    if sprite in candidates and colliderect(sprite.rect)]
+        sprites = [sprite for sprite in candidates if colliderect(sprite.rect)]
+        if draw_order:
+            sprites.sort(key=self._draw_keys.__getitem__)
+        else:
+            sprites.sort(key=self._positions.__getitem__)
+        return sprites
+
+    def get_max_height(self):
+        """
+        Returns the height of the tallest sprite or 0.
+        """
+        return max(self._heights) if self._heights else 0
+
+    def __contains__(self, sprite):
+        return sprite in self._positions
+
+    def __len__(self):
+        return len(self.sprites)
+
+
 class SpriteLayer(object):
     """
     The SpriteLayer class. This class is used by the RendererPygame.
@@ -170,13 +515,23 @@ class SpriteLayer(object):
 
     """
 
+    # draw the borders of the collapsed sprites into their images (debugging)
+    draw_collapse_borders = False
+
+    # number of scaled versions kept by each layer (see get_scaled)
+    max_scaled_layers = 4
+
+    # size of the cells of the grid of dynamic sprites, in tiles
+    sprite_grid_cell_tiles = 4
+
     class Sprite(object):
         """
         The Sprite class used by the SpriteLayer class and the RendererPygame.
 
         """
 
-        def __init__(self, image, rect, source_rect=None, flags=0, key=None):
+        def __init__(self, image, rect, source_rect=None, flags=0, key=None, \
+                     image_key=None):
             """
             Constructor.
             :Parameters:
@@ -190,6 +545,10 @@ class SpriteLayer(object):
                     flags for the blit method, defaults to 0
                 key : any
                     used internally for collapsing sprites
+                image_key : any
+                    identifies the image independently of the map, used
+                    internally to share collapsed images, defaults to None
+                    (the image is not shared)
 
             """
             self.image = image
@@ -200,6 +559,7 @@ class SpriteLayer(object):
             self.is_flat = False
             self.z = 0
             self.key = key
+            self.image_key = image_key
 
         def get_draw_cond(self):
             """
@@ -214,7 +574,7 @@ class SpriteLayer(object):
             else:
                 return self.rect.bottom
 
-    def __init__(self, tile_layer_idx, resource_loader):
+    def __init__(self, tile_layer_idx, resource_loader, image_cache=None):
         """
 
         :Parameters:
@@ -223,8 +583,19 @@ class SpriteLayer(object):
             resource_loader : ResourceLoaderPygame
                 Instance of the ResourceLoaderPygame class which has loaded
                 the resouces
+            image_cache : SpriteImageCache
+                Cache for the images of the collapsed layers, defaults to the
+                shared one (see get_shared_image_cache)
         """
         self._resource_loader = resource_loader
+        self._image_cache = image_cache if image_cache is not None else \
+                                                    _shared_image_cache
+        # collapsed versions of this layer, shared by all of them
+        self._collapsed_layers = {1: self}  # {level: SpriteLayer}
+        self._collapse_choices = {}  # {(cam_size, max_level): level}
+        # scaled versions of this layer, least recently used first
+        self._scaled_layers = OrderedDict()  # {(scale_x, scale_y): SpriteLayer}
+        self._scale_source = self
         _world_map = self._resource_loader.world_map
         self.layer_idx = tile_layer_idx
         _layer = _world_map.layers[tile_layer_idx]
@@ -248,7 +619,14 @@ class SpriteLayer(object):
         self.paralax_factor_x = 1.0
         self.paralax_factor_y = 1.0
 
-        self.sprites = []
+        # dynamic sprites, sprites is the list kept by the grid
+        self._sprite_grid = SpriteGrid( \
+            self.tilewidth * SpriteLayer.sprite_grid_cell_tiles, \
+            self.tileheight * SpriteLayer.sprite_grid_cell_tiles)
+        self.sprites = self._sprite_grid.sprites
+        # use the sprite grid to find the visible sprites, then the moved
+        # sprites must be updated (see update_sprite)
+        self.use_sprite_index = False
         self.is_object_group = _layer.is_object_group
         self.visible = _layer.visible
         self.bottom_margin = 0
@@ -266,29 +644,25 @@ class SpriteLayer(object):
             self.content2D[ypos] = [None] * self.num_tiles_x
 
         # fill them
-        _img_cache = {}
-        _img_cache["hits"] = 0
+        tile_keys = getattr(self._resource_loader, 'indexed_tile_keys', None)
         for ypos_new in range(0, self.num_tiles_y):
             for xpos_new in range(0, self.num_tiles_x):
                 coords = self._get_list_of_neighbour_coord(xpos_new, ypos_new, \
                                                            1, self.num_tiles_x, self.num_tiles_y)
                 if coords:
                     key, sprites = SpriteLayer._get_sprites_fromt_tiled_layer( \
-                        coords, _layer, self._resource_loader.indexed_tiles)
+                        coords, _layer, self._resource_loader.indexed_tiles, \
+                        tile_keys)
 
                     sprite = None
                     if sprites:
                         sprite = SpriteLayer._union_sprites(sprites, key, \
-                                                            _img_cache)
+                                                            self._image_cache)
                         if sprite.rect.height > self._bottom_margin:
                             self._bottom_margin = sprite.rect.height
 
                     self.content2D[ypos_new][xpos_new] = sprite
         self.bottom_margin = self._bottom_margin
-        if __debug__:
-            print('%s: Sprite Cache hits: %d' % \
-                  (self.__class__.__name__, _img_cache["hits"]))
-        del _img_cache
 
     def get_collapse_level(self):
         """
@@ -299,40 +673,43 @@ class SpriteLayer(object):
         """
         return self._level
 
-    # TODO: test scale
     @staticmethod
-    def scale(layer_orig, scale_w, scale_h):  # -> sprite_layer
+    def scale(layer_orig, scale_w, scale_h, image_cache=None):  # -> sprite_layer
         """
         Scales a layer and returns a new, scaled SpriteLayer.
 
-        :Note: This method is slow and inefficient
+        Each different tile image is scaled only once, identical tiles share
+        the scaled image. The scaled images are kept in a cache, so scaling
+        again to a recent zoom is cheap (see also get_scaled).
+
+        :Note: The dynamic sprites of the layer are not scaled.
 
         :Parameters:
             scale_w : float
                 Width scale factor in range (0, ...]
             scale_h : float
                 Height scale factor in range (0, ...]
+            image_cache : SpriteImageCache
+                Cache for the scaled images, defaults to the shared one (see
+                get_shared_scaled_image_cache)
         """
         if layer_orig.is_object_group:
             return layer_orig
 
-        layer = SpriteLayer(layer_orig.layer_idx, layer_orig._resource_loader)
+        if image_cache is None:
+            image_cache = _shared_scaled_image_cache
 
+        # the tiles are not parsed again, only the content2D is replaced
+        layer = SpriteLayer._copy_layer(layer_orig, share_sprites=True)
         layer.tilewidth = layer_orig.tilewidth * scale_w
         layer.tileheight = layer_orig.tileheight * scale_h
-        layer.position_x = layer_orig.position_x
-        layer.position_y = layer_orig.position_y
-
-        layer._level = layer_orig._level
-
-        layer.paralax_factor_x = layer_orig.paralax_factor_x
-        layer.paralax_factor_y = layer_orig.paralax_factor_y
-        layer.sprites = layer_orig.sprites
-        layer.is_object_group = layer_orig.is_object_group
-        layer.visible = layer_orig.visible
         layer.scale_x = scale_w
         layer.scale_y = scale_h
 
+        # images without a key can not be cached, they are only shared
+        # during this call
+        _images = {}  # {id(image): (image, image_key)}
+
         layer.content2D = [0] * len(layer_orig.content2D)
         for yidx, row in enumerate(layer_orig.content2D):
             layer.content2D[yidx] = [0] * len(row)
@@ -343,21 +720,111 @@ class SpriteLayer(object):
                     new_h = h * scale_h
                     rect = sprite.rect
                     image = sprite.image
+                    image_key = sprite.image_key
                     # prevent fractional numbers and scaling glitches
                     if w != ceil(new_w) or h != ceil(new_h):
                         new_w = ceil(new_w)
                         new_h = ceil(new_h)
-                        image = pygame.transform.smoothscale(sprite.image, (new_w, new_h))
+                        image, image_key = SpriteLayer._get_scaled_image( \
+                            sprite, (new_w, new_h), image_cache, _images)
                         x, y = sprite.rect.topleft
                         rect = pygame.Rect(x * scale_w, y * scale_h, new_w, new_h)
 
                     layer.content2D[yidx][xidx] = \
-                        SpriteLayer.Sprite(image, rect)
+                        SpriteLayer.Sprite(image, rect, key=sprite.key, \
+                                           image_key=image_key)
                 else:
                     layer.content2D[yidx][xidx] = None
 
         return layer
 
+    def get_scaled(self, scale_w, scale_h=None):
+        """
+        Returns this layer scaled. The last used scales are kept (see
+        max_scaled_layers), so zooming in and out is fast. The visibility and
+        parallax factors of the returned layer are updated from this layer.
+
+        :Parameters:
+            scale_w : float
+                Width scale factor in range (0, ...]
+            scale_h : float
+                Height scale factor in range (0, ...]. If this is None then it
+                will have the same value as scale_w.
+
+        :returns: the scaled SpriteLayer (this layer if the scale is 1.0)
+        """
+        if scale_h is None:
+            scale_h = scale_w
+        source = self._scale_source
+        if source.is_object_group:
+            return source
+        scale_key = (scale_w, scale_h)
+        if scale_key == (1.0, 1.0):
+            layer = source
+        else:
+            scaled_layers = source._scaled_layers
+            layer = scaled_layers.get(scale_key, None)
+            if layer is None:
+                layer = SpriteLayer.scale(source, scale_w, scale_h)
+                layer._scale_source = source
+                scaled_layers[scale_key] = layer
+                while len(scaled_layers) > SpriteLayer.max_scaled_layers:
+                    scaled_layers.popitem(last=False)
+            else:
+                scaled_layers.move_to_end(scale_key)
+        layer.visible = self.visible
+        layer.paralax_factor_x = self.paralax_factor_x
+        layer.paralax_factor_y = self.paralax_factor_y
+        return layer
+
+    @staticmethod
+    def _get_scaled_image(sprite, size, image_cache, _images):
+        """
+        Scales the image of the sprite, reusing already scaled images.
+
+        :Returns:
+            (image, image_key) the scaled image and its key
+        """
+        image_key = None
+        if sprite.image_key is not None:
+            image_key = ('scaled', sprite.image_key, size)
+            image = image_cache.get(image_key)
+            if image is not None:
+                return image, image_key
+        local_key = (id(sprite.image), size)
+        if local_key in _images:
+            return _images[local_key], image_key
+
+        if sprite.image.get_bitsize() >= 24:
+            image = pygame.transform.smoothscale(sprite.image, size)
+        else:
+            # smoothscale only works with 24 and 32 bit images
+            image = pygame.transform.scale(sprite.image, size)
+        _images[local_key] = image
+        if image_key is not None:
+            image_cache.put(image_key, image)
+        return image, image_key
+
+    @staticmethod
+    def _copy_layer(layer, share_sprites=False):
+        """
+        Returns a shallow copy of the layer with its own sprites list (the
+        sprites of the original layer if share_sprites is True) and without
+        the collapsed and scaled versions of the original layer.
+        """
+        new_layer = copy.copy(layer)
+        if not share_sprites:
+            grid = layer._sprite_grid
+            new_layer._sprite_grid = SpriteGrid(grid.cell_width, grid.cell_height)
+            new_layer.sprites = new_layer._sprite_grid.sprites
+            for sprite in layer.sprites:
+                new_layer._sprite_grid.add(sprite)
+        new_layer._collapsed_layers = {new_layer._level: new_layer}
+        new_layer._collapse_choices = {}
+        new_layer._scaled_layers = OrderedDict()
+        new_layer._scale_source = new_layer
+        return new_layer
+
     # TODO: implement merge
     @staticmethod
     def merge(layers):  # -> sprite_layer
@@ -438,6 +905,11 @@ class SpriteLayer(object):
         Grouping them together into one bigger sprite is one way to get fewer
         sprites.
 
+        The new layer is built from the given one (so collapsing an already
+        collapsed layer only unites 4 sprites per new sprite) and the united
+        images are taken from the image cache of the layer if an equal group
+        of tiles has been collapsed before, in this or in any other layer.
+
         :not: This only works for static layers without any dynamic sprites.
 
         :note: use with caution
@@ -466,6 +938,11 @@ class SpriteLayer(object):
             return layer
         level = 2
 
+        new_level = layer._level * level
+        collapsed = layer._collapsed_layers.get(new_level, None)
+        if collapsed is not None:
+            return collapsed
+
         new_tilewidth = layer.tilewidth * level
         new_tileheight = layer.tileheight * level
         new_num_tiles_x = int(layer.num_tiles_x / level)
@@ -485,8 +962,8 @@ class SpriteLayer(object):
             _content2D[ypos] = [None] * new_num_tiles_x
 
         # fill them
-        _img_cache = {}
-        _img_cache["hits"] = 0
+        _img_cache = layer._image_cache
+        hits = _img_cache.hits
         for ypos_new in range(0, new_num_tiles_y):
             for xpos_new in range(0, new_num_tiles_x):
                 coords = SpriteLayer._get_list_of_neighbour_coord( \
@@ -497,10 +974,14 @@ class SpriteLayer(object):
                                                           _img_cache)
                     _content2D[ypos_new][xpos_new] = sprite
 
-        # print "len content2D:", len(self.content2D)
-        # TODO: separate constructor from init code (here the layer is parsed
-        #       for nothing, content2D will be replaced)
-        new_layer = SpriteLayer(layer.layer_idx, layer._resource_loader)
+        # the layer is not parsed again, only the content2D is replaced
+        new_layer = copy.copy(layer)
+        grid = layer._sprite_grid
+        new_layer._sprite_grid = SpriteGrid(grid.cell_width * level, \
+                                            grid.cell_height * level)
+        new_layer.sprites = new_layer._sprite_grid.sprites
+        new_layer._scaled_layers = OrderedDict()
+        new_layer._scale_source = new_layer
 
         new_layer.tilewidth = new_tilewidth
         new_layer.tileheight = new_tileheight
@@ -508,13 +989,40 @@ class SpriteLayer(object):
         new_layer.num_tiles_y = new_num_tiles_y
         new_layer.content2D = _content2D
 
-        # HACK:
-        new_layer._level = layer._level * 2
+        new_layer._level = new_level
+        layer._collapsed_layers[new_level] = new_layer
 
         if __debug__ and level > 1:
-            print('%s: Sprite Cache hits: %d' % ("collapse", _img_cache["hits"]))
+            print('%s: Sprite Cache hits: %d' % ("collapse", _img_cache.hits - hits))
         return new_layer
 
+    def get_collapsed(self, level):
+        """
+        Returns the version of this layer collapsed to the given level. The
+        collapsed layers are kept, each one is built from the previous level
+        and only once. The visibility and parallax factors of the returned
+        layer are updated from this layer.
+
+        :Parameters:
+            level : int
+                The collapse level, a power of 2 not lower than the collapse
+                level of this layer.
+
+        :returns: the collapsed SpriteLayer (this layer for its own level).
+        """
+        if level < self._level or level & (level - 1):
+            raise ValueError("invalid collapse level %s for a layer of level %s" % \
+                             (level, self._level))
+        if self.is_object_group:
+            return self
+        layer = self._collapsed_layers.get(level, None)
+        if layer is None:
+            layer = SpriteLayer.collapse(self.get_collapsed(level // 2))
+        layer.visible = self.visible
+        layer.paralax_factor_x = self.paralax_factor_x
+        layer.paralax_factor_y = self.paralax_factor_y
+        return layer
+
     @staticmethod
     def _get_list_of_neighbour_coord(xpos_new, ypos_new, level, \
                                      num_tiles_x, num_tiles_y):
@@ -555,8 +1063,8 @@ class SpriteLayer(object):
                 list of sprites to union
             key : iterable
                 key of the sprite, internal use only
-            _img_cache : dict
-                cache dict
+            _img_cache : SpriteImageCache
+                cache for the united images
         :Returns:
             new Sprite that unites all the given sprites.
         """
@@ -567,30 +1075,40 @@ class SpriteLayer(object):
         # NOTE: this messes up the cache hits (only on non-collapsed maps)
         if len(sprites) == 1:
             sprite = sprites[0]
-            sprite.key = key
-            return sprite
+            # the sprite may belong to another layer (collapsing), so it is
+            # not modified, a new sprite sharing the image is returned instead
+            return SpriteLayer.Sprite(sprite.image, sprite.rect, \
+                                      sprite.source_rect, sprite.flags, \
+                                      key=key, image_key=sprite.image_key)
 
         # combine found sprites into one sprite
         rect = sprites[0].rect.unionall(sprites)
+        x, y = rect.topleft
+
+        # the image only can be shared if all the parts can be identified
+        image_key = None
+        if all(spr.image_key is not None for spr in sprites):
+            image_key = (rect.size, tuple((spr.image_key, spr.rect.x - x, \
+                                           spr.rect.y - y) for spr in sprites))
 
         # cache the images to save memory
-        if key in _img_cache:
-            image = _img_cache[key]
-            _img_cache["hits"] = _img_cache["hits"] + 1
-        else:
+        image = None
+        if image_key is not None:
+            image = _img_cache.get(image_key)
+        if image is None:
             # make new image
             image = pygame.Surface(rect.size, pygame.SRCALPHA | pygame.RLEACCEL)
             image.fill((0, 0, 0, 0))
-            x, y = rect.topleft
             for spr in sprites:
                 image.blit(spr.image, spr.rect.move(-x, -y))
+            if image_key is not None:
+                _img_cache.put(image_key, image)
 
-            _img_cache[key] = image
-
-        return SpriteLayer.Sprite(image, rect, key=key)
+        return SpriteLayer.Sprite(image, rect, key=key, image_key=image_key)
 
     @staticmethod
-    def _get_sprites_fromt_tiled_layer(coords, layer, indexed_tiles):
+    def _get_sprites_fromt_tiled_layer(coords, layer, indexed_tiles, \
+                                       tile_keys=None):
         """
         Get the sprites at the given coordinates from a tiled layer.
 
@@ -601,6 +1119,9 @@ class SpriteLayer(object):
                 layer to extract the sprites from
             indexed_tiles : dict
                 indexed tiles list loaded by the resource loader.
+            tile_keys : dict
+                keys of the tile images loaded by the resource loader,
+                optional.
 
         :Returns:
             (keys, sprites) the new keys and sprites
@@ -623,7 +1144,9 @@ class SpriteLayer(object):
                 world_y = ypos * layer.tileheight + offy
                 w, h = img.get_size()
                 rect = pygame.Rect(world_x, world_y, w, h)
-                sprite = SpriteLayer.Sprite(img, rect, key=idx)
+                image_key = tile_keys.get(idx, None) if tile_keys else None
+                sprite = SpriteLayer.Sprite(img, rect, key=idx, \
+                                            image_key=image_key)
                 key.append(idx)
                 sprites.append(sprite)
             else:
@@ -640,8 +1163,8 @@ class SpriteLayer(object):
                 tuples of coordinates (x, y)
             layer : SpriteLayer
                 the layer to get the united sprite from
-            _img_cache : dict
-                dict for caching, internal use only
+            _img_cache : SpriteImageCache
+                cache for the united images, internal use only
 
         :returns:
             a single sprite, uniting all given sprites on the fiven coordinates.
@@ -666,8 +1189,11 @@ class SpriteLayer(object):
         if sprites:
             sprite = SpriteLayer._union_sprites(sprites, key, _img_cache)
 
-            if __debug__:
+            if SpriteLayer.draw_collapse_borders:
+                # draw on a copy, the cached image may be used somewhere else
                 x, y = sprite.rect.topleft
+                sprite.image = sprite.image.copy()
+                sprite.image_key = None
                 pygame.draw.rect(sprite.image, (255, 0, 0), \
                                  sprite.rect.move(-x, -y), \
                                  layer.get_collapse_level())
@@ -685,7 +1211,7 @@ class SpriteLayer(object):
             sprite : SpriteLayer.Sprite
                 sprite to add
         """
-        self.sprites.append(sprite)
+        self._sprite_grid.add(sprite)
         if sprite.rect.height > self.bottom_margin:
             self.bottom_margin = sprite.rect.height
 
@@ -702,19 +1228,16 @@ class SpriteLayer(object):
 
     def remove_sprite(self, sprite):
         """
-        Removes a dynamic sprite from this layer.
+        Removes a dynamic sprite from this layer. The last sprite of the
+        sprites list takes the place of the removed one.
 
         :Parameters:
             sprite : SpriteLayer.Sprite
                 sprite to remove
         """
-        if sprite in self.sprites:
-            self.sprites.remove(sprite)
-
-        self.bottom_margin = self._bottom_margin
-        for spr in self.sprites:
-            if spr.rect.height > self.bottom_margin:
-                self.bottom_margin = spr.rect.height
+        self._sprite_grid.remove(sprite)
+        self.bottom_margin = max(self._bottom_margin, \
+                                 self._sprite_grid.get_max_height())
 
     def remove_sprites(self, sprites):
         """
@@ -728,6 +1251,62 @@ class SpriteLayer(object):
         for sprite in sprites:
             self.remove_sprite(sprite)
 
+    def update_sprite(self, sprite):
+        """
+        Tells the layer that a dynamic sprite moved or changed its size. This
+        is needed when use_sprite_index is set.
+
+        :Parameters:
+            sprite : SpriteLayer.Sprite
+                sprite that changed
+        """
+        self._sprite_grid.update(sprite)
+        if sprite.rect.height > self.bottom_margin:
+            self.bottom_margin = sprite.rect.height
+
+    def update_sprites(self):
+        """
+        Updates all the dynamic sprites (see update_sprite), e.g. before
+        setting use_sprite_index on a layer whose sprites have been moved.
+        """
+        self._sprite_grid.update_all()
+        self.bottom_margin = max(self._bottom_margin, \
+                                 self._sprite_grid.get_max_height())
+
+    def get_sprites_in_rect(self, rect, draw_order=False):
+        """
+        Finds the dynamic sprites colliding with a rect in world coordinates.
+
+        :Parameters:
+            rect : pygame.Rect
+                the rect to check
+            draw_order : bool
+                Optional, defaults to False. Sort the sprites by their draw
+                condition (see SpriteLayer.Sprite.get_draw_cond).
+
+        :Returns:
+            list of sprites in the same order as in the sprites list or in
+            draw order.
+        """
+        if self.use_sprite_index:
+            return self._sprite_grid.query(rect, draw_order)
+        all_sprites = self.sprites
+        sprites = [all_sprites[idx] for idx in rect.collidelistall(all_sprites)]
+        if draw_order:
+            sprites.sort(key=_get_draw_cond)
+        return sprites
+
+    def get_sprites_in_draw_order(self):
+        """
+        Returns all the dynamic sprites sorted by their draw condition (see
+        SpriteLayer.Sprite.get_draw_cond). With use_sprite_index the order is
+        kept between calls and only repaired for the updated sprites. Do not
+        modify the returned list.
+        """
+        if self.use_sprite_index:
+            return self._sprite_grid.get_draw_order()
+        return sorted(self.sprites, key=_get_draw_cond)
+
     def contains_sprite(self, sprite):
         """
         Check if the given sprites is already in this layer.
@@ -739,9 +1318,7 @@ class SpriteLayer(object):
         :Returns:
             bool, true if sprite is in this layer
         """
-        if sprite in self.sprites:
-            return True
-        return False
+        return sprite in self._sprite_grid
 
     def has_sprites(self):
         """
@@ -860,6 +1437,23 @@ class RendererPygame(object):
         """
         self._cam_rect = pygame.Rect(0, 0, 10, 10)
         self._margin = (0, 0, 0, 0)  # left, right, top, bottom
+        self._zoom_methods = {}  # {(zoom, surface size): method}
+        self._zoom_surf = None
+        # dirty rect rendering: (surface size, camera position, sprites state)
+        self._dirty_last = None
+        self._dirty_full = True
+        self._dirty_pending = []  # [screen rect]
+        # scroll reuse: {layer ids of a static group: (backbuffer, camera position)}
+        self._backbuffers = {}
+        # render_layers: {layer: no tile reaches out of its row}
+        self._tiles_in_rows = {}
+        # number of tile positions looked at while rendering, only counted
+        # (e.g. for benchmarks), reset it as needed
+        self.tiles_visited = 0
+        # optional function called with a name and returning a context
+        # manager measuring the rendering of each layer (or batch of layers,
+        # see render_layers), e.g. profiler.FrameProfiler.scope
+        self.profile_scope = None
 
     def set_camera_position(self, world_pos_x, world_pos_y, alignment='center'):
         """
@@ -946,7 +1540,7 @@ class RendererPygame(object):
         self._render_cam_rect.top = self._cam_rect.top - margin_top
 
     def render_layer(self, surf, layer, clip_sprites=True, \
-                     sort_key=lambda spr: spr.get_draw_cond()):
+                     sort_key=_get_draw_cond, area=None):
         """
         Renders a layer onto the given surface.
 
@@ -960,9 +1554,24 @@ class RendererPygame(object):
                 only draw the ones intersecting the visible part of the world.
             sort_key : function
                 Optional: The sort function for the parameter 'key' of the sort
-                method of the list.
+                method of the list. With the default one the layer keeps the
+                sprites sorted if possible (see
+                SpriteLayer.get_sprites_in_draw_order).
+            area : pygame.Rect
+                Optional, defaults to None. Part of the surface (in screen
+                coordinates) to render, only the tiles and sprites touching
+                it are drawn. The caller should set the clip of the surface
+                to this area.
+
+        """
+        if self.profile_scope is not None and layer.visible and not layer.is_object_group:
+            with self.profile_scope('render_layer ' + layer.name):
+                self._render_layer(surf, layer, clip_sprites, sort_key, area)
+        else:
+            self._render_layer(surf, layer, clip_sprites, sort_key, area)
 
-        """
+    def _render_layer(self, surf, layer, clip_sprites, sort_key, area):
+        # see render_layer
         if layer.visible:
 
             if layer.is_object_group:
@@ -985,18 +1594,30 @@ class RendererPygame(object):
             cam_world_pos_y = cam_rect.top * layer.paralax_factor_y + \
                               layer.position_y
 
-            # camera bounds, restricting number of tiles to draw
-            left = int(round(float(cam_world_pos_x) // layer.tilewidth))
-            right = int(round(float(cam_world_pos_x + cam_rect.width) // \
-                              layer.tilewidth)) + 1
-            top = int(round(float(cam_world_pos_y) // tile_h))
-            bottom = int(round(float(cam_world_pos_y + cam_rect.height) // \
-                               tile_h)) + 1
+            if area is None:
+                # camera bounds, restricting number of tiles to draw
+                left = int(round(float(cam_world_pos_x) // layer.tilewidth))
+                right = int(round(float(cam_world_pos_x + cam_rect.width) // \
+                                  layer.tilewidth)) + 1
+                top = int(round(float(cam_world_pos_y) // tile_h))
+                bottom = int(round(float(cam_world_pos_y + cam_rect.height) // \
+                                   tile_h)) + 1
+            else:
+                # area bounds, the tiles below the area can reach into it
+                area_world_x = area.left + cam_world_pos_x
+                area_world_y = area.top + cam_world_pos_y
+                left = int(area_world_x // layer.tilewidth)
+                right = int((area_world_x + area.width) // layer.tilewidth) + 1
+                top = int(area_world_y // tile_h)
+                bottom = int((area_world_y + area.height + layer.bottom_margin) \
+                             // tile_h) + 1
 
             left = left if left > 0 else 0
             right = right if right < layer.num_tiles_x else layer.num_tiles_x
             top = top if top > 0 else 0
             bottom = bottom if bottom < layer.num_tiles_y else layer.num_tiles_y
+            if right > left and bottom > top:
+                self.tiles_visited += (right - left) * (bottom - top)
 
             # sprites
             spr_idx = 0
@@ -1005,15 +1626,23 @@ class RendererPygame(object):
             if all_sprites:
                 # TODO: make filter visible sprites optional (maybe sorting too)
                 # use a marging around it
-                if clip_sprites:
-                    sprites = [all_sprites[idx] \
-                               for idx in cam_rect.collidelistall(all_sprites)]
+                draw_order = sort_key is _get_draw_cond
+                if area is not None:
+                    if draw_order:
+                        all_sprites = layer.get_sprites_in_draw_order()
+                    sprites = [spr for spr in all_sprites if area.colliderect( \
+                        spr.rect.move(-cam_world_pos_x, \
+                                      -cam_world_pos_y - spr.z))]
+                elif clip_sprites:
+                    sprites = layer.get_sprites_in_rect(cam_rect, draw_order)
+                elif draw_order:
+                    sprites = layer.get_sprites_in_draw_order()
                 else:
                     sprites = all_sprites
 
                 # could happend that all sprites are not visible by the camera
                 if sprites:
-                    if sort_key:
+                    if sort_key and not draw_order:
                         sprites.sort(key=sort_key)
                     sprite = sprites[0]
                     len_sprites = len(sprites)
@@ -1045,6 +1674,607 @@ class RendererPygame(object):
                                   tile_sprite.source_rect, \
                                   tile_sprite.flags)
 
+            if area is not None:
+                # sprites lifted (z) into the area from below its last row
+                while spr_idx < len_sprites:
+                    sprite = sprites[spr_idx]
+                    surf_blit(sprite.image, \
+                              sprite.rect.move(-cam_world_pos_x, \
+                                               -cam_world_pos_y - sprite.z), \
+                              sprite.source_rect, \
+                              sprite.flags)
+                    spr_idx += 1
+
+    def render_layers(self, surf, layers):
+        """
+        Renders the layers onto the given surface like calling render_layer
+        for each one, but in a single pass over the rows of tiles: the visible
+        tile window is computed once and each row is drawn for all the layers
+        before the next row.
+
+        Drawing row by row across layers gives the same picture only if
+        nothing of a layer reaches into another row. So consecutive layers are
+        rendered together while they have the same tile size, map size,
+        parallax factors and position, and only the last one of them may have
+        tiles higher than a row or dynamic sprites (not flat ones). The other
+        layers (e.g. parallax layers) are rendered with render_layer. With a
+        profile_scope each batch of layers rendered together is measured as
+        'render_rows <first layer>..<last layer>'.
+
+        :Parameters:
+            surf : Surface
+                Surface to render onto.
+            layers : list
+                The SpriteLayers to render, in draw order. Invisible layers and
+                object groups are skipped.
+
+        """
+        visible_layers = [layer for layer in layers \
+                          if layer.visible and not layer.is_object_group]
+        if not visible_layers:
+            return
+
+        bottom_margin = max(layer.bottom_margin for layer in visible_layers)
+        if bottom_margin > self._margin[3]:
+            left, right, top, bottom = self._margin
+            self.set_camera_margin(left, right, top, bottom_margin)
+
+        idx = 0
+        num_layers = len(visible_layers)
+        while idx < num_layers:
+            layer = visible_layers[idx]
+            geometry = self._get_layer_geometry(layer)
+            end = idx + 1
+            while end < num_layers and \
+                    self._get_layer_geometry(visible_layers[end]) == geometry and \
+                    not visible_layers[end - 1].sprites and \
+                    self._has_tiles_in_rows(visible_layers[end - 1]):
+                end += 1
+            if end - idx == 1:
+                self.render_layer(surf, layer)
+            elif self.profile_scope is None:
+                self._render_rows(surf, visible_layers[idx:end])
+            else:
+                with self.profile_scope('render_rows {}..{}'.format(layer.name, visible_layers[end - 1].name)):
+                    self._render_rows(surf, visible_layers[idx:end])
+            idx = end
+
+    @staticmethod
+    def _get_layer_geometry(layer):
+        return (layer.tilewidth, layer.tileheight, \
+                layer.num_tiles_x, layer.num_tiles_y, \
+                layer.paralax_factor_x, layer.paralax_factor_y, \
+                layer.position_x, layer.position_y)
+
+    def _has_tiles_in_rows(self, layer):
+        # True if no tile of the layer reaches into the rows above or below
+        in_rows = self._tiles_in_rows.get(layer, None)
+        if in_rows is None:
+            tile_h = layer.tileheight
+            in_rows = True
+            for ypos, row in enumerate(layer.content2D):
+                row_top = ypos * tile_h
+                row_bottom = row_top + tile_h
+                for tile_sprite in row:
+                    if tile_sprite and (tile_sprite.rect.top < row_top or \
+                                        tile_sprite.rect.bottom > row_bottom):
+                        in_rows = False
+                        break
+                if not in_rows:
+                    break
+            self._tiles_in_rows[layer] = in_rows
+        return in_rows
+
+    def _render_rows(self, surf, layers):
+        # renders the layers row by row, see render_layers
+        last_layer = layers[-1]
+        cam_rect = self._render_cam_rect
+        sprites = []
+        if last_layer.sprites:
+            sprites = last_layer.get_sprites_in_rect(cam_rect, True)
+            if any(sprite.is_flat for sprite in sprites):
+                # flat sprites can reach into the next rows
+                if len(layers) > 2:
+                    self._render_rows(surf, layers[:-1])
+                else:
+                    self.render_layer(surf, layers[0])
+                self.render_layer(surf, last_layer)
+                return
+
+        # optimizations
+        surf_blit = surf.blit
+        tile_h = last_layer.tileheight
+
+        cam_world_pos_x = cam_rect.left * last_layer.paralax_factor_x + \
+                          last_layer.position_x
+        cam_world_pos_y = cam_rect.top * last_layer.paralax_factor_y + \
+                          last_layer.position_y
+
+        # camera bounds, the same for all the layers
+        left = int(round(float(cam_world_pos_x) // last_layer.tilewidth))
+        right = int(round(float(cam_world_pos_x + cam_rect.width) // \
+                          last_layer.tilewidth)) + 1
+        top = int(round(float(cam_world_pos_y) // tile_h))
+        bottom = int(round(float(cam_world_pos_y + cam_rect.height) // \
+                           tile_h)) + 1
+        left = left if left > 0 else 0
+        right = right if right < last_layer.num_tiles_x else last_layer.num_tiles_x
+        top = top if top > 0 else 0
+        bottom = bottom if bottom < last_layer.num_tiles_y else last_layer.num_tiles_y
+        if right > left and bottom > top:
+            self.tiles_visited += (right - left) * (bottom - top) * len(layers)
+
+        contents = [layer.content2D for layer in layers[:-1]]
+        last_content2D = last_layer.content2D
+        spr_idx = 0
+        len_sprites = len(sprites)
+        if sprites:
+            sprite = sprites[0]
+
+        # render
+        for ypos in range(top, bottom):
+            for layer_content2D in contents:
+                for tile_sprite in layer_content2D[ypos][left:right]:
+                    if tile_sprite:
+                        surf_blit(tile_sprite.image, \
+                                  tile_sprite.rect.move(-cam_world_pos_x, \
+                                                        -cam_world_pos_y), \
+                                  tile_sprite.source_rect, \
+                                  tile_sprite.flags)
+            # sprites of the last layer above this row
+            y = ypos + 1
+            while spr_idx < len_sprites and sprite.get_draw_cond() <= \
+                            y * tile_h:
+                surf_blit(sprite.image, \
+                          sprite.rect.move(-cam_world_pos_x, \
+                                           -cam_world_pos_y - sprite.z), \
+                          sprite.source_rect, \
+                          sprite.flags)
+                spr_idx += 1
+                if spr_idx < len_sprites:
+                    sprite = sprites[spr_idx]
+            for tile_sprite in last_content2D[ypos][left:right]:
+                if tile_sprite:
+                    surf_blit(tile_sprite.image, \
+                              tile_sprite.rect.move(-cam_world_pos_x, \
+                                                    -cam_world_pos_y), \
+                              tile_sprite.source_rect, \
+                              tile_sprite.flags)
+
+    def invalidate(self, screen_rect=None):
+        """
+        Marks a part of the screen to be redrawn by the next call to
+        render_layers_dirty, for example after changing tiles or drawing
+        something over the rendered layers. Invalidating the whole screen
+        also discards the backbuffers of render_layers_scroll_reuse and what
+        render_layers knows about the tiles of the layers.
+
+        :Parameters:
+            screen_rect : pygame.Rect
+                Optional, the area in screen coordinates. Defaults to None,
+                meaning the whole screen (e.g. after changing the visibility of
+                a layer).
+        """
+        if screen_rect is None:
+            self._dirty_full = True
+            self._backbuffers = {}
+            self._tiles_in_rows = {}
+        else:
+            self._dirty_pending.append(pygame.Rect(screen_rect))
+
+    def render_layers_dirty(self, surf, layers, background=(0, 0, 0)):
+        """
+        Renders the layers onto the surface but only redraws the parts that
+        changed since the last call: the old and new positions of the dynamic
+        sprites that moved or changed their image, the areas passed to
+        invalidate and, when the camera moved, the strips uncovered after
+        scrolling the previous frame (Surface.scroll).
+
+        The surface must keep its content between calls (e.g. the display
+        surface without clearing it), pass the returned rects to
+        pygame.display.update.
+
+        The whole surface is redrawn on the first call, after invalidate(),
+        when the surface size changes, on camera jumps bigger than the surface
+        or if a visible layer uses parallax scrolling.
+
+        :Parameters:
+            surf : Surface
+                Surface to render onto.
+            layers : list
+                The SpriteLayers to render, in draw order.
+            background : tuple
+                Optional, defaults to black. Color of the areas without tiles.
+
+        :returns: list of the changed rects in screen coordinates.
+        """
+        surf_rect = surf.get_rect()
+        cam_pos = self._render_cam_rect.topleft
+        visible_layers = [layer for layer in layers \
+                          if layer.visible and not layer.is_object_group]
+        sprites_state = self._get_sprites_screen_state(visible_layers, surf_rect)
+
+        last = self._dirty_last
+        full = self._dirty_full or last is None or \
+               last[0] != surf_rect.size or \
+               any(layer.paralax_factor_x != 1.0 or \
+                   layer.paralax_factor_y != 1.0 for layer in visible_layers)
+        if not full:
+            delta_x = cam_pos[0] - last[1][0]
+            delta_y = cam_pos[1] - last[1][1]
+            if abs(delta_x) >= surf_rect.width or abs(delta_y) >= surf_rect.height:
+                full = True
+
+        if full:
+            surf.fill(background)
+            for layer in visible_layers:
+                self.render_layer(surf, layer)
+            dirty_rects = [surf_rect]
+        else:
+            dirty = self._dirty_pending
+            last_sprites_state = last[2]
+            if delta_x or delta_y:
+                # reuse the last frame, only the uncovered strips are drawn
+                surf.scroll(-delta_x, -delta_y)
+                dirty = [rect.move(-delta_x, -delta_y) for rect in dirty]
+                for key, (rect, image, source_rect, flags) in \
+                                                last_sprites_state.items():
+                    last_sprites_state[key] = (rect.move(-delta_x, -delta_y), \
+                                               image, source_rect, flags)
+                # the column strip leaves out the row strip, merging them
+                # would redraw the whole surface
+                strip_top = -delta_y if delta_y < 0 else 0
+                strip_height = surf_rect.height - abs(delta_y)
+                if delta_x > 0:
+                    dirty.append(pygame.Rect(surf_rect.width - delta_x, \
+                                             strip_top, delta_x, strip_height))
+                elif delta_x < 0:
+                    dirty.append(pygame.Rect(0, strip_top, -delta_x, \
+                                             strip_height))
+                if delta_y > 0:
+                    dirty.append(pygame.Rect(0, surf_rect.height - delta_y, \
+                                             surf_rect.width, delta_y))
+                elif delta_y < 0:
+                    dirty.append(pygame.Rect(0, 0, surf_rect.width, -delta_y))
+
+            for key, state in sprites_state.items():
+                last_state = last_sprites_state.pop(key, None)
+                if last_state != state:
+                    dirty.append(state[0])
+                    if last_state is not None:
+                        dirty.append(last_state[0])
+            # sprites gone (removed, moved to another layer or off screen)
+            dirty.extend(state[0] for state in last_sprites_state.values())
+
+            dirty = self._merge_rects([rect.clip(surf_rect) for rect in dirty \
+                                       if rect.colliderect(surf_rect)])
+            clip = surf.get_clip()
+            for rect in dirty:
+                surf.set_clip(rect)
+                surf.fill(background, rect)
+                for layer in visible_layers:
+                    self.render_layer(surf, layer, area=rect)
+            surf.set_clip(clip)
+
+            if delta_x or delta_y:
+                # the whole surface moved
+                dirty_rects = [surf_rect]
+            else:
+                dirty_rects = dirty
+
+        self._dirty_full = False
+        self._dirty_pending = []
+        self._dirty_last = (surf_rect.size, cam_pos, sprites_state)
+        return dirty_rects
+
+    def render_layers_scroll_reuse(self, surf, layers, background=(0, 0, 0)):
+        """
+        Renders the layers onto the surface like calling render_layer for each
+        one, but consecutive static layers (without dynamic sprites nor
+        parallax scrolling) are rendered together into a backbuffer that is
+        kept between calls. When the camera moves, the backbuffer is shifted
+        (Surface.scroll) and only the uncovered rows and columns of tiles are
+        drawn. Layers with dynamic sprites or parallax scrolling are rendered
+        every call.
+
+        A backbuffer is redrawn completely on camera jumps bigger than the
+        surface, when the layers of its group change (e.g. their visibility)
+        or after invalidate().
+
+        :Parameters:
+            surf : Surface
+                Surface to render onto, all of it is overwritten.
+            layers : list
+                The SpriteLayers to render, in draw order.
+            background : tuple
+                Optional, defaults to black. Color of the areas without tiles.
+        """
+        cam_pos = self._render_cam_rect.topleft
+
+        # group the consecutive static layers
+        groups = []
+        group = []
+        for layer in layers:
+            if not layer.visible or layer.is_object_group:
+                continue
+            if layer.has_sprites() or layer.paralax_factor_x != 1.0 or \
+                                      layer.paralax_factor_y != 1.0:
+                if group:
+                    groups.append(group)
+                    group = []
+                groups.append(layer)
+            else:
+                group.append(layer)
+        if group:
+            groups.append(group)
+
+        if not groups or not isinstance(groups[0], list):
+            surf.fill(background)
+
+        backbuffers = {}
+        for idx, group in enumerate(groups):
+            if isinstance(group, list):
+                key = tuple(id(layer) for layer in group)
+                # the first group covers everything below, no alpha needed
+                backbuffer = self._update_backbuffer(surf, group, \
+                    self._backbuffers.get(key, None), cam_pos, \
+                    background if idx == 0 else None)
+                backbuffers[key] = (backbuffer, cam_pos)
+                surf.blit(backbuffer, (0, 0))
+            else:
+                self.render_layer(surf, group)
+        # the backbuffers of groups not rendered anymore are dropped
+        self._backbuffers = backbuffers
+
+    def _update_backbuffer(self, surf, layers, last, cam_pos, background):
+        """
+        Returns the backbuffer with the layers rendered for the camera
+        position, reusing the last one if possible.
+
+        :Parameters:
+            background : tuple
+                Color for an opaque backbuffer or None for a transparent one.
+        """
+        size = surf.get_size()
+        if last is not None:
+            backbuffer, last_cam_pos = last
+            delta_x = cam_pos[0] - last_cam_pos[0]
+            delta_y = cam_pos[1] - last_cam_pos[1]
+            if backbuffer.get_size() == size and \
+                    bool(backbuffer.get_flags() & pygame.SRCALPHA) == (background is None) and \
+                    abs(delta_x) < size[0] and abs(delta_y) < size[1]:
+                if delta_x or delta_y:
+                    backbuffer.scroll(-delta_x, -delta_y)
+                    strips = []
+                    if delta_x > 0:
+                        strips.append(pygame.Rect(size[0] - delta_x, 0, delta_x, size[1]))
+                    elif delta_x < 0:
+                        strips.append(pygame.Rect(0, 0, -delta_x, size[1]))
+                    if delta_y > 0:
+                        strips.append(pygame.Rect(0, size[1] - delta_y, size[0], delta_y))
+                    elif delta_y < 0:
+                        strips.append(pygame.Rect(0, 0, size[0], -delta_y))
+                    self._render_backbuffer(backbuffer, layers, strips, background)
+                return backbuffer
+
+        if background is None:
+            backbuffer = pygame.Surface(size, pygame.SRCALPHA, 32)
+        else:
+            backbuffer = pygame.Surface(size, 0, surf)
+        self._render_backbuffer(backbuffer, layers, [backbuffer.get_rect()], background)
+        return backbuffer
+
+    def _render_backbuffer(self, backbuffer, layers, areas, background):
+        """
+        Renders the layers into the given areas of the backbuffer.
+        """
+        fill_color = (0, 0, 0, 0) if background is None else background
+        clip = backbuffer.get_clip()
+        for area in areas:
+            backbuffer.set_clip(area)
+            backbuffer.fill(fill_color, area)
+            for layer in layers:
+                self.render_layer(backbuffer, layer, area=area)
+        backbuffer.set_clip(clip)
+
+    def _get_sprites_screen_state(self, layers, surf_rect):
+        """
+        Returns {(layer id, sprite id): (screen rect, image, source_rect,
+        flags)} for the dynamic sprites on the surface.
+        """
+        cam_rect = self._render_cam_rect
+        state = {}
+        for layer in layers:
+            if layer.sprites:
+                cam_world_pos_x = cam_rect.left * layer.paralax_factor_x + \
+                                  layer.position_x
+                cam_world_pos_y = cam_rect.top * layer.paralax_factor_y + \
+                                  layer.position_y
+                for sprite in layer.sprites:
+                    rect = sprite.rect.move(-cam_world_pos_x, \
+                                            -cam_world_pos_y - sprite.z)
+                    if rect.colliderect(surf_rect):
+                        state[(id(layer), id(sprite))] = (rect, sprite.image, \
+                                            sprite.source_rect, sprite.flags)
+        return state
+
+    @staticmethod
+    def _merge_rects(rects):
+        """
+        Merges the overlapping rects, so no area is drawn twice.
+        """
+        merged = []
+        for rect in rects:
+            idx = rect.collidelist(merged)
+            while idx > -1:
+                rect = rect.union(merged.pop(idx))
+                idx = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def get_fastest_collapsed_layer(self, surf, layer, max_level=8, \
+                                    num_frames=5, verbose=False):
+        """
+        Measures the time needed to render the layer at the different collapse
+        levels (1, 2, 4... up to max_level) for the current camera size and
+        returns the fastest version of the layer. The choice is remembered
+        for each camera size, so this can be called every frame.
+
+        :Note: Layers with dynamic sprites are never collapsed.
+
+        :Parameters:
+            surf : Surface
+                Surface like the one the layer will be rendered onto, it is
+                not modified.
+            layer : SpriteLayer
+                The layer to collapse.
+            max_level : int
+                Optional, defaults to 8. Highest collapse level to try.
+            num_frames : int
+                Optional, defaults to 5. Number of renders timed per level.
+            verbose : bool
+                Optional, defaults to False. Prints the measured choice.
+
+        :returns: the fastest SpriteLayer (the given one if not collapsed).
+        """
+        if layer.is_object_group or layer.has_sprites():
+            return layer
+
+        choice_key = (self._cam_rect.size, max_level)
+        level = layer._collapse_choices.get(choice_key, None)
+        if level is None:
+            target = pygame.Surface(surf.get_size(), 0, surf)
+            best_time = None
+            candidate_level = layer.get_collapse_level()
+            while candidate_level <= max_level:
+                candidate = layer.get_collapsed(candidate_level)
+                visible = candidate.visible
+                candidate.visible = True
+                # first render is not timed (cold caches)
+                self.render_layer(target, candidate)
+                start = time.perf_counter()
+                for frame in range(num_frames):
+                    self.render_layer(target, candidate)
+                elapsed = time.perf_counter() - start
+                candidate.visible = visible
+                if best_time is None or elapsed < best_time:
+                    best_time = elapsed
+                    level = candidate_level
+                candidate_level *= 2
+            layer._collapse_choices[choice_key] = level
+            if verbose:
+                print('%s: layer %s collapse level %s (%.3f ms)' % \
+                      (self.__class__.__name__, layer.name, level, \
+                       1000.0 * best_time / num_frames))
+
+        return layer.get_collapsed(level)
+
+    def render_layers_zoomed(self, surf, layers, zoom, method=None, \
+                             verbose=False):
+        """
+        Renders the layers zoomed around the center of the camera. The camera
+        is set in world coordinates as usual, the area of the world rendered
+        is the camera size divided by the zoom.
+
+        There are two methods:
+
+            'layers'
+                renders the scaled layers (see SpriteLayer.get_scaled), each
+                tile image is only scaled once per zoom.
+            'offscreen'
+                renders the layers at native scale into an offscreen surface
+                and scales it into the given surface.
+
+        :Note: Dynamic sprites are not scaled by the 'layers' method, so it is
+               only used for layers without dynamic sprites.
+
+        :Parameters:
+            surf : Surface
+                Surface to render onto. With the 'offscreen' method all of it
+                is overwritten.
+            layers : list
+                The SpriteLayers to render, in draw order.
+            zoom : float
+                The zoom factor in range (0, ...], 1.0 renders normally.
+            method : string
+                Optional, 'layers' or 'offscreen'. Defaults to None: both are
+                timed once for each zoom and surface size and the faster one
+                is used from then on.
+            verbose : bool
+                Optional, defaults to False. Prints the timed choice of the
+                method.
+
+        :returns: the method used
+        """
+        if method is None:
+            if any(layer.has_sprites() for layer in layers \
+                                                if not layer.is_object_group):
+                method = 'offscreen'
+            else:
+                method_key = (zoom, surf.get_size())
+                method = self._zoom_methods.get(method_key, None)
+                if method is None:
+                    method = self._measure_zoom_methods(surf, layers, zoom, \
+                                                        verbose=verbose)
+                    self._zoom_methods[method_key] = method
+
+        cam_rect = self._cam_rect
+        margin = self._margin
+        center_x, center_y = cam_rect.center
+        surf_w, surf_h = surf.get_size()
+        try:
+            if method == 'offscreen':
+                size = (int(ceil(surf_w / zoom)), int(ceil(surf_h / zoom)))
+                offscreen = self._zoom_surf
+                if offscreen is None or offscreen.get_size() != size:
+                    offscreen = pygame.Surface(size, 0, surf)
+                    self._zoom_surf = offscreen
+                offscreen.fill((0, 0, 0))
+                self._cam_rect = pygame.Rect((0, 0), size)
+                self._cam_rect.center = (center_x, center_y)
+                self.set_camera_margin(*margin)
+                for layer in layers:
+                    self.render_layer(offscreen, layer)
+                pygame.transform.scale(offscreen, (surf_w, surf_h), surf)
+            elif method == 'layers':
+                self._cam_rect = pygame.Rect(0, 0, surf_w, surf_h)
+                self._cam_rect.center = (center_x * zoom, center_y * zoom)
+                self.set_camera_margin(*margin)
+                for layer in layers:
+                    if not layer.is_object_group:
+                        self.render_layer(surf, layer.get_scaled(zoom))
+            else:
+                raise ValueError("unknown zoom method: %s" % (method,))
+        finally:
+            self._cam_rect = cam_rect
+            self.set_camera_margin(*margin)
+        return method
+
+    def _measure_zoom_methods(self, surf, layers, zoom, num_frames=3, \
+                              verbose=False):
+        """
+        Times the zoom methods and returns the name of the faster one, printed
+        if verbose.
+        """
+        target = pygame.Surface(surf.get_size(), 0, surf)
+        best_method = None
+        best_time = None
+        for method in ('layers', 'offscreen'):
+            # first render is not timed (building the scaled layers)
+            self.render_layers_zoomed(target, layers, zoom, method)
+            start = time.perf_counter()
+            for frame in range(num_frames):
+                self.render_layers_zoomed(target, layers, zoom, method)
+            elapsed = time.perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+                best_method = method
+        if verbose:
+            print('%s: zoom %s rendered with %s (%.3f ms)' % \
+                  (self.__class__.__name__, zoom, best_method, \
+                   1000.0 * best_time / num_frames))
+        return best_method
+
     def pick_layer(self, layer, screen_x, screen_y):
         """
         Returns the sprite at the given screen position or None regardless of
@@ -1105,8 +2335,7 @@ class RendererPygame(object):
                 self.screen_to_world(layer, screen_x, screen_y)
 
             r = pygame.Rect(world_pos_x, world_pos_y, 1, 1)
-            indices = r.collidelistall(layer.sprites)
-            return [layer.sprites[idx] for idx in indices]
+            return layer.get_sprites_in_rect(r)
         return []
 
     def screen_to_world(self, layer, screen_x, screen_y):
@@ -1364,8 +2593,7 @@ class IsometricRendererPygame(RendererPygame):
                 self.screen_to_world(layer, screen_x, screen_y)
 
             r = pygame.Rect(world_pos_x, world_pos_y, 1, 1)
-            indices = r.collidelistall(layer.sprites)
-            return [layer.sprites[idx] for idx in indices]
+            return layer.get_sprites_in_rect(r)
         return []
 
     def screen_to_world(self, layer, screen_x, screen_y):
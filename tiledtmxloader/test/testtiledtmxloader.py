@@ -117,6 +117,16 @@ class MapLoadTestsPygame(unittest.TestCase):
             world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode("minix_base64_gzip_dtd.tmx")
             self.resourceloader.load(world_map)
             
+    def test_load_object_shapes(self):
+        world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode("objects.tmx")
+        door, pond, path = world_map.layers[1].objects
+        self.assertEqual((24, 0, 24, 28), (door.x, door.y, door.width, door.height))
+        self.assertEqual(None, door.polygon)
+        self.assertEqual(None, door.polyline)
+        self.assertEqual([(0.0, 0.0), (30.0, 0.0), (15.0, 24.5)], pond.polygon)
+        self.assertEqual(None, pond.polyline)
+        self.assertEqual([(0.0, 0.0), (96.0, 5.0)], path.polyline)
+
     def test_get_list_of_quad_coords(self):
         if _has_pygame:
             layer = tiledtmxloader.helperspygame.SpriteLayer
@@ -132,6 +142,104 @@ class MapLoadTestsPygame(unittest.TestCase):
             expected = ((3, 3), (4, 3), (5, 3), (3, 4), (4, 4), (5, 4), (3, 5), (4, 5), (5, 5))
             self.compare(expected, coords)
             
+    def test_collapse_reuses_levels_and_images(self):
+        if _has_pygame:
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode("minix.tmx")
+            self.resourceloader.load(world_map)
+            layer = tiledtmxloader.helperspygame.SpriteLayer(0, self.resourceloader, \
+                                    tiledtmxloader.helperspygame.SpriteImageCache())
+            collapsed = layer.get_collapsed(4)
+            self.assertEqual(4, collapsed.get_collapse_level())
+            self.assertTrue(collapsed is layer.get_collapsed(4))
+            self.assertTrue(layer.get_collapsed(2) is tiledtmxloader.helperspygame.SpriteLayer.collapse(layer))
+            self.assertEqual(layer.num_tiles_x, len(layer.content2D[0]))
+
+            # same tiles in another layer use the cached images
+            num_images = len(layer._image_cache)
+            other = tiledtmxloader.helperspygame.SpriteLayer(0, self.resourceloader, layer._image_cache)
+            other.get_collapsed(4)
+            self.assertEqual(num_images, len(layer._image_cache))
+
+    def test_scale_shares_scaled_images(self):
+        if _has_pygame:
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode("minix.tmx")
+            self.resourceloader.load(world_map)
+            layer = tiledtmxloader.helperspygame.SpriteLayer(0, self.resourceloader)
+            scaled = layer.get_scaled(1.5)
+            self.assertTrue(scaled is layer.get_scaled(1.5, 1.5))
+            self.assertTrue(layer is layer.get_scaled(1.0))
+
+            images = {}
+            for row_orig, row in zip(layer.content2D, scaled.content2D):
+                for sprite_orig, sprite in zip(row_orig, row):
+                    if sprite_orig:
+                        images.setdefault(sprite_orig.key, set()).add(id(sprite.image))
+            for key, ids in images.items():
+                self.assertEqual(1, len(ids), "tile %s scaled more than once" % (key,))
+
+            for idx in range(tiledtmxloader.helperspygame.SpriteLayer.max_scaled_layers):
+                layer.get_scaled(2.0 + idx)
+            self.assertFalse((1.5, 1.5) in layer._scaled_layers)
+
+    def test_sprite_grid_follows_updated_sprites(self):
+        if _has_pygame:
+            Sprite = tiledtmxloader.helperspygame.SpriteLayer.Sprite
+            grid = tiledtmxloader.helperspygame.SpriteGrid(32, 32)
+            sprites = [Sprite(None, pygame.Rect(x * 10, 0, 8, 8 + x)) for x in range(10)]
+            for sprite in sprites:
+                grid.add(sprite)
+            self.assertEqual(sprites[:4], grid.query(pygame.Rect(0, 0, 38, 4)))
+            self.assertEqual(17, grid.get_max_height())
+
+            sprites[0].rect.topleft = (500, 500)
+            grid.update(sprites[0])
+            self.assertEqual([sprites[0]], grid.query(pygame.Rect(490, 490, 20, 20)))
+            self.assertEqual(sprites[1:4], grid.query(pygame.Rect(0, 0, 38, 4)))
+
+            grid.remove(sprites[9])
+            grid.remove(sprites[2])
+            self.assertFalse(sprites[2] in grid)
+            self.assertEqual(8, len(grid))
+            self.assertEqual(16, grid.get_max_height())
+            self.assertEqual([sprites[1], sprites[3]], grid.query(pygame.Rect(0, 0, 38, 4)))
+
+    def test_sprite_grid_keeps_draw_order(self):
+        if _has_pygame:
+            Sprite = tiledtmxloader.helperspygame.SpriteLayer.Sprite
+            grid = tiledtmxloader.helperspygame.SpriteGrid(32, 32)
+            sprites = [Sprite(None, pygame.Rect(x * 10, 100 - x * 10, 8, 8)) for x in range(5)]
+            for sprite in sprites:
+                grid.add(sprite)
+            self.assertEqual(sprites[::-1], grid.get_draw_order())
+
+            sprites[4].rect.top = 200
+            grid.update(sprites[4])
+            sprites[0].rect.top = 0
+            grid.update(sprites[0])
+            self.assertEqual([sprites[0], sprites[3], sprites[2], sprites[1], sprites[4]], grid.get_draw_order())
+            self.assertEqual([sprites[0], sprites[3]], grid.query(pygame.Rect(0, 0, 38, 75), True))
+
+            grid.remove(sprites[2])
+            self.assertEqual([sprites[0], sprites[3], sprites[1], sprites[4]], grid.get_draw_order())
+
+    def test_render_layers_same_as_render_layer(self):
+        if _has_pygame:
+            world_map = tiledtmxloader.tmxreader.TileMapParser().parse_decode("minix.tmx")
+            self.resourceloader.load(world_map)
+            layers = [tiledtmxloader.helperspygame.SpriteLayer(0, self.resourceloader) for idx in range(3)]
+            layers[1].position_x = 5
+            image = pygame.Surface((20, 40))
+            image.fill((255, 0, 0))
+            layers[2].add_sprite(tiledtmxloader.helperspygame.SpriteLayer.Sprite(image, pygame.Rect(100, 100, 20, 40)))
+            renderer = tiledtmxloader.helperspygame.RendererPygame()
+            renderer.set_camera_position_and_size(120, 110, 300, 200)
+            expected = pygame.Surface((300, 200))
+            for layer in layers:
+                renderer.render_layer(expected, layer)
+            captured = pygame.Surface((300, 200))
+            renderer.render_layers(captured, layers)
+            self.assertEqual(pygame.image.tostring(expected, 'RGB'), pygame.image.tostring(captured, 'RGB'))
+
     def compare(self, expected, captured):
         """
         Helper method to compare to lists.
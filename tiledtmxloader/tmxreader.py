@@ -580,6 +580,10 @@ class MapObjectGroupLayer(object):
             map_obj.y = int(map_obj.y)
             map_obj.width = int(map_obj.width)
             map_obj.height = int(map_obj.height)
+            if map_obj.polygon is not None:
+                map_obj.polygon = _convert_points(map_obj.polygon)
+            if map_obj.polyline is not None:
+                map_obj.polyline = _convert_points(map_obj.polyline)
 
 #  -----------------------------------------------------------------------------
 
@@ -602,6 +606,12 @@ class MapObject(object):
             source path of the image for this object
         image : :class:TileImage
             after loading this is the pygame surface containing the image
+        polygon : list
+            the points [(x, y), ...] of a polygon object relative to its
+            position, None for other objects
+        polyline : list
+            the points [(x, y), ...] of a polyline object relative to its
+            position, None for other objects
     """
     def __init__(self):
         self.name = None
@@ -612,8 +622,17 @@ class MapObject(object):
         self.type = None
         self.image_source = None
         self.image = None
+        self.polygon = None
+        self.polyline = None
         self.properties = {} # {name: value}
 
+def _convert_points(points):
+    """
+    Converts the points attribute of a polygon or a polyline, "x,y x,y ...",
+    to a list of (x, y) tuples of floats.
+    """
+    return [tuple(float(value) for value in point.split(',')) for point in points.split()]
+
 #  -----------------------------------------------------------------------------
 def decode_base64(in_str, string_encoding='latin-1'):
     """
@@ -832,6 +851,10 @@ class TileMapParser(object):
             for img_node in self._get_nodes(node.childNodes, 'image'):
                 tiled_object.image_source = \
                                         img_node.attributes['source'].nodeValue
+            for polygon_node in self._get_nodes(node.childNodes, 'polygon'):
+                tiled_object.polygon = polygon_node.attributes['points'].nodeValue
+            for polyline_node in self._get_nodes(node.childNodes, 'polyline'):
+                tiled_object.polyline = polyline_node.attributes['points'].nodeValue
             object_group.objects.append(tiled_object)
         # ISSUE 9
         world_map.layers.append(object_group)
@@ -7,10 +7,12 @@ import os
 import math
 import glob
 import re
+import struct
+import numpy
 import pygame
 import vectors
 from common import *
-from avatar import create_avatar
+from avatar import Avatar, create_avatar
 
 class WorldLayerInfo():
     def __init__(self, idx, layer, sprite_layer):
@@ -18,6 +20,630 @@ class WorldLayerInfo():
         self.layer = layer
         self.sprite_layer = sprite_layer
 
+class HeadlessLayer():
+    """
+    Stands in for the SpriteLayer of a tile layer in a headless world: it has
+    the tiles of metadata layers (with their rects and gids, see
+    World.get_pos_info) but no images, and only keeps the set of its sprites.
+    """
+    def __init__(self, world_map, layer, with_tiles):
+        self.name = layer.name
+        self.tilewidth = world_map.tilewidth
+        self.tileheight = world_map.tileheight
+        self.num_tiles_x = layer.width
+        self.num_tiles_y = layer.height
+        self.visible = layer.visible
+        self.is_object_group = False
+        self.sprites = set()
+        self.content2D = None
+        self._tile_sizes = {}  # {gid: (width, height)} as the loader gives them
+        if with_tiles:
+            self.content2D = self._get_tiles(world_map, layer)
+
+    def _get_tiles(self, world_map, layer):
+        content2D = [[None] * self.num_tiles_x for ypos in range(self.num_tiles_y)]
+        for xpos, column in enumerate(layer.content2D):
+            for ypos, gid in enumerate(column):
+                if gid:
+                    content2D[ypos][xpos] = self.create_tile(world_map, xpos, ypos, gid)
+        return content2D
+
+    def create_tile(self, world_map, tile_x, tile_y, gid):
+        """
+        :Returns: the sprite of a tile of the layer (without image).
+        """
+        flip_mask = ~(tiledtmxloader.tmxreader.AbstractResourceLoader.FLIP_X | \
+                      tiledtmxloader.tmxreader.AbstractResourceLoader.FLIP_Y | \
+                      tiledtmxloader.tmxreader.AbstractResourceLoader.FLIP_DIAGONAL)
+        size = self._tile_sizes.get(gid, None)
+        if size is None:
+            size = self._tile_sizes[gid] = self._get_tile_size(world_map, gid & flip_mask)
+        width, height = size
+        # taller tiles reach up (see the resource loader)
+        offset_y = max(0, height - self.tileheight)
+        rect = pygame.Rect(tile_x * self.tilewidth, tile_y * self.tileheight - offset_y, width, height)
+        return tiledtmxloader.helperspygame.SpriteLayer.Sprite(None, rect, key=[gid])
+
+    def _get_tile_size(self, world_map, gid):
+        tile_set = None
+        for candidate in world_map.tile_sets:
+            if int(candidate.firstgid) <= gid and (tile_set is None or int(candidate.firstgid) > int(tile_set.firstgid)):
+                tile_set = candidate
+        if tile_set is not None and tile_set.tilewidth and tile_set.tileheight:
+            return int(tile_set.tilewidth), int(tile_set.tileheight)
+        return self.tilewidth, self.tileheight
+
+    def add_sprite(self, sprite):
+        self.sprites.add(sprite)
+
+    def remove_sprite(self, sprite):
+        self.sprites.discard(sprite)
+
+    def contains_sprite(self, sprite):
+        return sprite in self.sprites
+
+    def update_sprite(self, sprite):
+        pass
+
+class CollisionGrid():
+    """
+    The BlockIn edge masks of the tiles of a metadata layer in a uint8 grid
+    (bytearray, index tile_y * num_tiles_x + tile_x), built once at load
+    time. For each tile the rects of the neighbours blocking an avatar on it
+    are kept too, so checking a move only needs a few integer tests (see
+    get_blocked_steps).
+
+    The bits of a mask are the edges blocking an avatar moving into the
+    tile upwards (1<<0), downwards (1<<1), to the left (1<<2) and to the
+    right (1<<3), see NEIGHBOURS.
+    """
+    # (dir_x, dir_y, bits) of the neighbour tiles, a neighbour blocks with
+    # the edges facing the tile of the avatar only
+    NEIGHBOURS = [
+        (-1, -1, 1<<0|1<<2), (0, -1, 1<<0), ( 1, -1, 1<<0|1<<3),
+        (-1,  0,      1<<2), (0,  0,   15), ( 1,  0,      1<<3),
+        (-1,  1, 1<<1|1<<2), (0,  1, 1<<1), ( 1,  1, 1<<1|1<<3)
+    ]
+    # distance in pixels kept to an edge after a swept contact, so the
+    # rounded collision box does not overlap the tile
+    SKIN = 1.0
+
+    def __init__(self, tiles, metadata_layer):
+        self.tiles = tiles
+        self.metadata_layer = metadata_layer
+        self.tilewidth = metadata_layer.tilewidth
+        self.tileheight = metadata_layer.tileheight
+        self.num_tiles_y = len(metadata_layer.content2D)
+        self.num_tiles_x = len(metadata_layer.content2D[0]) if self.num_tiles_y else 0
+        self.masks = bytearray(self.num_tiles_x * self.num_tiles_y)
+        self.rects = [None] * len(self.masks)  # (left, top, right, bottom) of the tiles with a mask
+        self.blocking_rects = [()] * len(self.masks)  # rects of the neighbours blocking each tile
+        for tile_y in range(self.num_tiles_y):
+            for tile_x in range(self.num_tiles_x):
+                self._read_tile(tile_x, tile_y)
+        for tile_y in range(self.num_tiles_y):
+            for tile_x in range(self.num_tiles_x):
+                self._update_blocking_rects(tile_x, tile_y)
+
+    def _read_tile(self, tile_x, tile_y):
+        idx = tile_y * self.num_tiles_x + tile_x
+        mask = 0
+        rect = None
+        sprite = self.metadata_layer.content2D[tile_y][tile_x]
+        if sprite is not None:
+            tiles = [self.tiles[k] for k in sprite.key if k in self.tiles]
+            if tiles:
+                mask = int(tiles[0].properties.get('BlockIn', 0)) & 15
+            if mask:
+                rect = (sprite.rect.left, sprite.rect.top, sprite.rect.right, sprite.rect.bottom)
+        self.masks[idx] = mask
+        self.rects[idx] = rect
+
+    def _update_blocking_rects(self, tile_x, tile_y):
+        rects = []
+        for dir_x, dir_y, bits in self.NEIGHBOURS:
+            # indices outside wrap around like the rows of content2D do
+            idx = ((tile_y + dir_y) % self.num_tiles_y) * self.num_tiles_x + (tile_x + dir_x) % self.num_tiles_x
+            if self.masks[idx] & bits:
+                rects.append(self.rects[idx])
+        self.blocking_rects[tile_y * self.num_tiles_x + tile_x] = tuple(rects) if rects else ()
+
+    def update_tile(self, tile_x, tile_y):
+        """
+        Reads the mask of a tile again from the metadata layer, call it after
+        changing the tile.
+        """
+        self._read_tile(tile_x, tile_y)
+        for dir_x, dir_y, bits in self.NEIGHBOURS:
+            self._update_blocking_rects((tile_x + dir_x) % self.num_tiles_x, (tile_y + dir_y) % self.num_tiles_y)
+
+    def is_walkable(self, tile_x, tile_y):
+        """
+        If an avatar can stand on a tile: a tile blocks the collision box of
+        an avatar on it with all its BlockIn edges (the (0, 0) neighbour of
+        NEIGHBOURS), so a tile with any of them is only crossed by avatars
+        changing the level on it.
+        """
+        return not self.masks[tile_y * self.num_tiles_x + tile_x]
+
+    def get_walkable(self):
+        """
+        :Returns: bytes, 1 for the tiles an avatar can stand on (see
+                  is_walkable), in the order of masks.
+        """
+        return bytes(not mask for mask in self.masks)
+
+    def get_blocked_steps(self, rect, tile_x, tile_y, step_x, step_y):
+        """
+        Checks a collision box against the tiles around it, like
+        pygame.Rect.colliderect with the rects of the blocking tiles.
+
+        :Parameters:
+            rect : pygame.Rect
+                the collision box
+            tile_x : int
+                tile of the collision box in x direction
+            tile_y : int
+                tile of the collision box in y direction
+            step_x : int
+                step in x direction
+            step_y : int
+                step in y direction
+
+        :Returns: tuple (blocked_x, blocked_y), if the steps collide.
+        """
+        blocking_rects = self.blocking_rects[(tile_y % self.num_tiles_y) * self.num_tiles_x + tile_x % self.num_tiles_x]
+        if not blocking_rects:
+            return False, False
+        left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+        blocked_x = blocked_y = False
+        for tile_left, tile_top, tile_right, tile_bottom in blocking_rects:
+            if top < tile_bottom and bottom > tile_top and \
+               left + step_x < tile_right and right + step_x > tile_left:
+                blocked_x = True
+            if left < tile_right and right > tile_left and \
+               top + step_y < tile_bottom and bottom + step_y > tile_top:
+                blocked_y = True
+        return blocked_x, blocked_y
+
+    def sweep(self, left, top, right, bottom, step_x, step_y):
+        """
+        Swept collision of a box moving by a step of any length against the
+        tiles. The tiles are visited in the order the box enters them (a DDA
+        along the tile columns or rows, whichever the step crosses more of)
+        up to the first contact. An edge of a tile blocks the box coming
+        from its side only, like the BlockIn bits; a box already overlapping
+        a tile can leave it.
+
+        :Parameters:
+            left, top, right, bottom : float
+                the collision box
+            step_x : float
+                step in x direction
+            step_y : float
+                step in y direction
+
+        :Returns: tuple (time, slide_x, slide_y), the part of the step (0 to
+                  1) done until the first contact, 1 without any, and the
+                  rest of the step along the blocking edges.
+        """
+        if not step_x and not step_y:
+            return 1.0, 0.0, 0.0
+        along_x = abs(step_x) * self.tileheight >= abs(step_y) * self.tilewidth
+        if along_x:
+            low, high, step, size = left, right, step_x, self.tilewidth
+            side_low, side_high, side_step, side_size = top, bottom, step_y, self.tileheight
+        else:
+            low, high, step, size = top, bottom, step_y, self.tileheight
+            side_low, side_high, side_step, side_size = left, right, step_x, self.tilewidth
+        if step > 0:
+            first, last, direction = int(low // size), int(math.ceil((high + step) / size)) - 1, 1
+        else:
+            first, last, direction = int(math.ceil(high / size)) - 1, int((low + step) // size), -1
+        num_tiles_x, num_tiles_y = self.num_tiles_x, self.num_tiles_y
+        masks, rects = self.masks, self.rects
+        best_time = 1.0
+        hit_x = hit_y = False
+        for column in range(first, last + direction, direction):
+            # the times the box overlaps the column, and the rows it covers
+            if step > 0:
+                enter, leave = (column * size - high) / step, ((column + 1) * size - low) / step
+            else:
+                enter, leave = ((column + 1) * size - low) / step, (column * size - high) / step
+            enter = max(enter, 0.0)
+            if enter > best_time:
+                break
+            leave = min(leave, 1.0)
+            side_offsets = (side_step * enter, side_step * leave)
+            first_row = int((side_low + min(side_offsets)) // side_size)
+            last_row = int(math.ceil((side_high + max(side_offsets)) / side_size)) - 1
+            for row in range(first_row, last_row + 1):
+                tile_x, tile_y = (column, row) if along_x else (row, column)
+                if not (0 <= tile_x < num_tiles_x and 0 <= tile_y < num_tiles_y):
+                    continue
+                idx = tile_y * num_tiles_x + tile_x
+                mask = masks[idx]
+                if not mask:
+                    continue
+                time, blocks_x, blocks_y = self._sweep_tile(rects[idx], mask, left, top, right, bottom, step_x, step_y)
+                if not (blocks_x or blocks_y):
+                    continue
+                if time < best_time:
+                    best_time, hit_x, hit_y = time, blocks_x, blocks_y
+                elif time == best_time:
+                    hit_x, hit_y = hit_x or blocks_x, hit_y or blocks_y
+        if not (hit_x or hit_y):
+            return 1.0, 0.0, 0.0
+        rest = 1.0 - best_time
+        return best_time, (0.0 if hit_x else step_x * rest), (0.0 if hit_y else step_y * rest)
+
+    @staticmethod
+    def _sweep_tile(rect, mask, left, top, right, bottom, step_x, step_y):
+        """
+        Swept AABB test of a box against the rect of a tile.
+
+        :Returns: tuple (time, blocks_x, blocks_y) of the contact, (1, False,
+                  False) without one.
+        """
+        tile_left, tile_top, tile_right, tile_bottom = rect
+        if step_x > 0:
+            enter_x, leave_x = (tile_left - right) / step_x, (tile_right - left) / step_x
+        elif step_x < 0:
+            enter_x, leave_x = (tile_right - left) / step_x, (tile_left - right) / step_x
+        elif left < tile_right and right > tile_left:
+            enter_x, leave_x = -math.inf, math.inf
+        else:
+            return 1.0, False, False
+        if step_y > 0:
+            enter_y, leave_y = (tile_top - bottom) / step_y, (tile_bottom - top) / step_y
+        elif step_y < 0:
+            enter_y, leave_y = (tile_bottom - top) / step_y, (tile_top - bottom) / step_y
+        elif top < tile_bottom and bottom > tile_top:
+            enter_y, leave_y = -math.inf, math.inf
+        else:
+            return 1.0, False, False
+        enter = max(enter_x, enter_y)
+        if enter >= min(leave_x, leave_y) or enter < 0.0 or enter >= 1.0:
+            return 1.0, False, False
+        # the edge the box enters through blocks it moving in that
+        # direction, like NEIGHBOURS
+        blocks_x = enter_x == enter and (mask & (1<<3 if step_x > 0 else 1<<2)) != 0
+        blocks_y = enter_y == enter and (mask & (1<<1 if step_y > 0 else 1<<0)) != 0
+        return enter, blocks_x, blocks_y
+
+    def get_swept_step(self, left, top, right, bottom, step_x, step_y):
+        """
+        Moves a collision box by a step of any length (see sweep): up to
+        SKIN pixels before the first blocking edge, then it slides along the
+        edge with the rest of the step.
+
+        :Returns: tuple (step_x, step_y) the box can do.
+        """
+        move_x = move_y = 0.0
+        # after two contacts the box is blocked in both directions
+        for contact in range(2):
+            time, slide_x, slide_y = self.sweep(left + move_x, top + move_y, right + move_x, bottom + move_y, step_x, step_y)
+            if time >= 1.0:
+                return move_x + step_x, move_y + step_y
+            contact_x = step_x * time
+            contact_y = step_y * time
+            if step_x and not slide_x:
+                contact_x = math.copysign(max(abs(contact_x) - self.SKIN, 0.0), step_x)
+            if step_y and not slide_y:
+                contact_y = math.copysign(max(abs(contact_y) - self.SKIN, 0.0), step_y)
+            move_x += contact_x
+            move_y += contact_y
+            step_x, step_y = slide_x, slide_y
+            if not step_x and not step_y:
+                break
+        return move_x, move_y
+
+class Heightfield():
+    """
+    The heights of the tiles of a metadata layer in float arrays indexed
+    [tile_y, tile_x], baked once at load time from the Height, XSlope and
+    YSlope properties (in tile heights): the height at the tile center and
+    its change from the left to the right and from the top to the bottom
+    border, all in pixels. Tiles without a Height are at height 0.
+    """
+    def __init__(self, tiles, metadata_layer):
+        self.tiles = tiles
+        self.metadata_layer = metadata_layer
+        self.tilewidth = metadata_layer.tilewidth
+        self.tileheight = metadata_layer.tileheight
+        self.num_tiles_y = len(metadata_layer.content2D)
+        self.num_tiles_x = len(metadata_layer.content2D[0]) if self.num_tiles_y else 0
+        shape = (self.num_tiles_y, self.num_tiles_x)
+        self.has_height = numpy.zeros(shape, bool)
+        self.height = numpy.zeros(shape)
+        self.x_slope = numpy.zeros(shape)
+        self.y_slope = numpy.zeros(shape)
+        for tile_y in range(self.num_tiles_y):
+            for tile_x in range(self.num_tiles_x):
+                self.update_tile(tile_x, tile_y)
+
+    def update_tile(self, tile_x, tile_y):
+        """
+        Reads the height of a tile again from the metadata layer, call it
+        after changing the tile.
+        """
+        height = None
+        sprite = self.metadata_layer.content2D[tile_y][tile_x]
+        if sprite is not None:
+            tiles = [self.tiles[k] for k in sprite.key if k in self.tiles]
+            if tiles:
+                properties = tiles[0].properties
+                height = properties.get('Height', None)
+        if height is None:
+            self.has_height[tile_y, tile_x] = False
+            self.height[tile_y, tile_x] = self.x_slope[tile_y, tile_x] = self.y_slope[tile_y, tile_x] = 0.0
+        else:
+            self.has_height[tile_y, tile_x] = True
+            self.height[tile_y, tile_x] = self.tileheight * float(height)
+            self.x_slope[tile_y, tile_x] = self.tileheight * float(properties.get('XSlope', 0.0))
+            self.y_slope[tile_y, tile_x] = self.tileheight * float(properties.get('YSlope', 0.0))
+
+    def get_tile_plane(self, tile_x, tile_y):
+        """
+        :Returns: tuple (height, x_slope, y_slope) of a tile in pixels or None
+                  if it has no height.
+        """
+        tile_x %= self.num_tiles_x
+        tile_y %= self.num_tiles_y
+        if not self.has_height[tile_y, tile_x]:
+            return None
+        return self.height[tile_y, tile_x].item(), self.x_slope[tile_y, tile_x].item(), self.y_slope[tile_y, tile_x].item()
+
+    def sample(self, xs, ys):
+        """
+        Heights at world positions, on the plane of their tiles.
+
+        :Parameters:
+            xs : float or array
+                x coordinates
+            ys : float or array
+                y coordinates, same shape as xs
+
+        :Returns: the height for a single position, otherwise an array of
+                  the heights.
+        """
+        tilewidth = self.tilewidth
+        tileheight = self.tileheight
+        if isinstance(xs, (int, float)) and isinstance(ys, (int, float)):
+            tile_x = int(xs // tilewidth)
+            tile_y = int(ys // tileheight)
+            plane = self.get_tile_plane(tile_x, tile_y)
+            if plane is None:
+                return 0.0
+            height, x_slope, y_slope = plane
+            rel_x = (xs - tile_x * tilewidth) / tilewidth - 0.5
+            rel_y = (ys - tile_y * tileheight) / tileheight - 0.5
+            return height + x_slope * rel_x + y_slope * rel_y
+
+        xs = numpy.asarray(xs, numpy.float64)
+        ys = numpy.asarray(ys, numpy.float64)
+        tile_x = numpy.floor_divide(xs, tilewidth)
+        tile_y = numpy.floor_divide(ys, tileheight)
+        # indices outside wrap around like the rows of content2D do
+        idx_x = tile_x.astype(numpy.int64) % self.num_tiles_x
+        idx_y = tile_y.astype(numpy.int64) % self.num_tiles_y
+        rel_x = (xs - tile_x * tilewidth) / tilewidth - 0.5
+        rel_y = (ys - tile_y * tileheight) / tileheight - 0.5
+        heights = self.height[idx_y, idx_x] + self.x_slope[idx_y, idx_x] * rel_x + self.y_slope[idx_y, idx_x] * rel_y
+        return numpy.where(self.has_height[idx_y, idx_x], heights, 0.0)
+
+class SpatialHash():
+    """
+    The avatars of a level in a uniform grid of cells by the position of
+    their feet (pos_x, pos_y), to find the avatars near a position without
+    looking at all of them. A cell keeps its avatars in the order they
+    entered it (dict), the queries return them cell by cell, row by row.
+    """
+
+    def __init__(self, cell_width, cell_height):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.cells = {}  # {(cell_x, cell_y): {avatar: None}}
+        self.avatar_cells = {}  # {avatar: (cell_x, cell_y)}
+
+    def __len__(self):
+        return len(self.avatar_cells)
+
+    def __contains__(self, avatar):
+        return avatar in self.avatar_cells
+
+    def get_cell(self, pos_x, pos_y):
+        return int(pos_x // self.cell_width), int(pos_y // self.cell_height)
+
+    def update(self, avatar, pos_x, pos_y):
+        """
+        Adds an avatar or moves it to the cell of a new position.
+        """
+        cell = (int(pos_x // self.cell_width), int(pos_y // self.cell_height))
+        old_cell = self.avatar_cells.get(avatar, None)
+        if cell == old_cell:
+            return
+        if old_cell is not None:
+            self._remove_from_cell(avatar, old_cell)
+        self.avatar_cells[avatar] = cell
+        avatars = self.cells.get(cell, None)
+        if avatars is None:
+            avatars = self.cells[cell] = {}
+        avatars[avatar] = None
+
+    def remove(self, avatar):
+        cell = self.avatar_cells.pop(avatar, None)
+        if cell is not None:
+            self._remove_from_cell(avatar, cell)
+
+    def _remove_from_cell(self, avatar, cell):
+        avatars = self.cells[cell]
+        del avatars[avatar]
+        if not avatars:
+            del self.cells[cell]
+
+    def get_avatars_in_cells(self, left, top, right, bottom):
+        """
+        :Returns: list of the avatars of the cells overlapping a rect, some
+                  may be outside of it.
+        """
+        first_x, first_y = self.get_cell(left, top)
+        last_x, last_y = self.get_cell(right, bottom)
+        cells = self.cells
+        found = []
+        if (last_x - first_x + 1) * (last_y - first_y + 1) > len(cells):
+            # a large rect, fewer cells are used
+            for cell_y, cell_x in sorted((cell_y, cell_x) for cell_x, cell_y in cells):
+                if first_x <= cell_x <= last_x and first_y <= cell_y <= last_y:
+                    found.extend(cells[(cell_x, cell_y)])
+            return found
+        for cell_y in range(first_y, last_y + 1):
+            for cell_x in range(first_x, last_x + 1):
+                avatars = cells.get((cell_x, cell_y), None)
+                if avatars:
+                    found.extend(avatars)
+        return found
+
+    def query_rect(self, left, top, right, bottom):
+        """
+        :Returns: list of the avatars with left <= pos_x < right and
+                  top <= pos_y < bottom (like pygame.Rect.collidepoint).
+        """
+        return [avatar for avatar in self.get_avatars_in_cells(left, top, right, bottom)
+                if left <= avatar.pos_x < right and top <= avatar.pos_y < bottom]
+
+    def query_radius(self, pos_x, pos_y, radius):
+        """
+        :Returns: list of the avatars at most radius pixels from a position.
+        """
+        radius_squared = radius * radius
+        found = []
+        for avatar in self.get_avatars_in_cells(pos_x - radius, pos_y - radius, pos_x + radius, pos_y + radius):
+            dist_x = avatar.pos_x - pos_x
+            dist_y = avatar.pos_y - pos_y
+            if dist_x * dist_x + dist_y * dist_y <= radius_squared:
+                found.append(avatar)
+        return found
+
+class Trigger():
+    """
+    A region of a level raising events when the feet of an avatar enter or
+    leave it (see World.update_avatar_triggers): a rect or a polygon in map
+    pixels, e.g. of an object of the map (see from_map_object).
+    """
+
+    def __init__(self, level, left, top, right, bottom, polygon=None, id=None, type=None, properties=None):
+        self.level = level
+        # bounds, left <= pos_x < right and top <= pos_y < bottom
+        self.left = left
+        self.top = top
+        self.right = right
+        self.bottom = bottom
+        self.polygon = polygon  # [(pos_x, pos_y), ...] or None for the rect
+        self.id = id
+        self.type = type
+        self.properties = properties or {}
+
+    @staticmethod
+    def from_map_object(level, map_object, offset_x=0, offset_y=0):
+        """
+        The trigger of a rect or a polygon object of the map, its position is
+        relative to offset_x, offset_y (the object group).
+
+        :Returns: the Trigger, None for other objects (points, polylines).
+        """
+        pos_x = offset_x + map_object.x
+        pos_y = offset_y + map_object.y
+        properties = map_object.properties
+        id = properties.get('Id', map_object.name)
+        type = properties.get('Type', map_object.type)
+        if map_object.polygon:
+            polygon = [(pos_x + point_x, pos_y + point_y) for point_x, point_y in map_object.polygon]
+            xs = [point_x for point_x, point_y in polygon]
+            ys = [point_y for point_x, point_y in polygon]
+            return Trigger(level, min(xs), min(ys), max(xs), max(ys), polygon, id, type, properties)
+        if map_object.polyline is None and map_object.width > 0 and map_object.height > 0:
+            return Trigger(level, pos_x, pos_y, pos_x + map_object.width, pos_y + map_object.height,
+                           None, id, type, properties)
+        return None
+
+    def contains(self, pos_x, pos_y):
+        if not (self.left <= pos_x < self.right and self.top <= pos_y < self.bottom):
+            return False
+        polygon = self.polygon
+        if polygon is None:
+            return True
+        # even-odd rule, a ray to the right crossing the edges
+        inside = False
+        prev_x, prev_y = polygon[-1]
+        for point_x, point_y in polygon:
+            if (point_y > pos_y) != (prev_y > pos_y) and \
+               pos_x < point_x + (pos_y - point_y) * (prev_x - point_x) / (prev_y - point_y):
+                inside = not inside
+            prev_x, prev_y = point_x, point_y
+        return inside
+
+class TriggerGrid():
+    """
+    The triggers of a level in a uniform grid of cells, a trigger is in all
+    the cells its bounds overlap. Finding the triggers at a position only
+    looks at the triggers of its cell, a position in a cell without any
+    costs a dict lookup.
+    """
+
+    def __init__(self, cell_width, cell_height):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.cells = {}  # {(cell_x, cell_y): [trigger]}
+        self.triggers = {}  # {trigger: None}
+        self._cell_keys = None
+
+    def __len__(self):
+        return len(self.triggers)
+
+    def get_cell(self, pos_x, pos_y):
+        return int(pos_x // self.cell_width), int(pos_y // self.cell_height)
+
+    def _get_cells(self, trigger):
+        for cell_y in range(int(trigger.top // self.cell_height), int(math.ceil(trigger.bottom / self.cell_height))):
+            for cell_x in range(int(trigger.left // self.cell_width), int(math.ceil(trigger.right / self.cell_width))):
+                yield cell_x, cell_y
+
+    def add(self, trigger):
+        self.triggers[trigger] = None
+        for cell in self._get_cells(trigger):
+            self.cells.setdefault(cell, []).append(trigger)
+        self._cell_keys = None
+
+    def remove(self, trigger):
+        del self.triggers[trigger]
+        for cell in self._get_cells(trigger):
+            triggers = self.cells[cell]
+            triggers.remove(trigger)
+            if not triggers:
+                del self.cells[cell]
+        self._cell_keys = None
+
+    def get_triggers_at(self, pos_x, pos_y):
+        """
+        :Returns: list of the triggers containing a position, in the order
+                  they were added.
+        """
+        triggers = self.cells.get((int(pos_x // self.cell_width), int(pos_y // self.cell_height)), None)
+        if not triggers:
+            return []
+        return [trigger for trigger in triggers if trigger.contains(pos_x, pos_y)]
+
+    def get_cell_keys(self):
+        """
+        :Returns: sorted numpy array of the cells with triggers as keys
+                  cell_x * 2**32 + cell_y, for vectorized lookups (see
+                  crowd.Crowd.tick).
+        """
+        if self._cell_keys is None:
+            self._cell_keys = numpy.array(sorted(cell_x * 2**32 + cell_y for cell_x, cell_y in self.cells), numpy.int64)
+        return self._cell_keys
+
 class WorldLevel():
     def __init__(self, level, tiles):
         self.level = level
@@ -25,6 +651,8 @@ class WorldLevel():
         self.all_layers_info = []
         self.avatar_layer = None
         self.metadata_layer = None
+        self.collision_grid = None
+        self.heightfield = None
 
     def add_layer(self, idx, layer, sprite_layer):
         if int(layer.properties.get('Level', 0)) != self.level:
@@ -42,16 +670,44 @@ class World():
     METERS_PER_LAYER = 2.0
     VPIXELS_PER_LAYER = 46.0 # METERS_PER_LAYER * VPIXELS_PER_METER
 
-    def __init__(self, map):
+    def __init__(self, map, headless=False):
+        """
+        A headless world is only simulated, it loads no images and has no
+        renderer, the tile layers are HeadlessLayers. Several headless worlds
+        can share the same map.
+        """
         self.map = map
+        self.headless = headless
         self.avatars = set()
         self.avatars_dict = {}
+        # {layer_level: SpatialHash} of the avatars, see update_avatar_position
+        self.spatial_hashes = {}
+        # {avatar: serial} in the order the avatars were added, the avatar
+        # collisions are resolved in it
+        self.avatar_serials = {}
         self.camera_layer_level = None
+        # (pos_x, pos_y) of the map the camera follows, see set_camera_position
+        self.camera_position = None
+        self.camera_z = 0.0
         self.show_layer_level_up = False
+        # functions (layer_level, tile_x, tile_y) called after a metadata tile changed
+        self.metadata_listeners = []
+        # {(layer_level, tile_x, tile_y)} of the changed metadata tiles, kept
+        # in the snapshots
+        self.edited_tiles = set()
+        # {layer_level: TriggerGrid}, see add_trigger
+        self.trigger_grids = {}
+        # {avatar: tuple of the triggers it is in}
+        self.avatar_triggers = {}
+        # functions (avatar, trigger, entered) called after an avatar entered
+        # (entered is True) or left a trigger, see update_avatar_triggers
+        self.trigger_listeners = []
 
         # load the images using pygame
-        self.resources = tiledtmxloader.helperspygame.ResourceLoaderPygame()
-        self.resources.load(self.map)
+        self.resources = None
+        if not headless:
+            self.resources = tiledtmxloader.helperspygame.ResourceLoaderPygame()
+            self.resources.load(self.map)
 
         # prepare map rendering
         assert self.map.orientation == "orthogonal"
@@ -60,12 +716,14 @@ class World():
         #    json.dump(self.map, f, cls=JSONDebugEncoder, indent=2, sort_keys=True)
 
         # renderer
-        self.renderer = tiledtmxloader.helperspygame.RendererPygame()
+        self.renderer = None
+        if not headless:
+            self.renderer = tiledtmxloader.helperspygame.RendererPygame()
 
         self.world_layers = {}
         self.all_sprite_layers = []
 
-        for idx, layer in enumerate(self.resources.world_map.layers):
+        for idx, layer in enumerate(self.map.layers):
             layer_level = int(layer.properties.get('Level', 0))
             if layer.is_object_group:
                 print("Objects Layer '{}' ({}): {}".format(layer.name, 'visible' if layer.visible else 'not visible', layer.properties))
@@ -78,26 +736,65 @@ class World():
                         create_avatar(self, layer_level, obj.x, obj.y, obj_id, obj.properties)
                     else:
                         print("Object '{}' ('{}') at x={}, y={}".format(obj_id, obj_type, obj.x, obj.y))
+                        trigger = Trigger.from_map_object(layer_level, obj, layer.x, layer.y)
+                        if trigger:
+                            self.add_trigger(trigger)
             else:
                 print("Tiled Layer '{}' ({}): {} ({}x{})".format(layer.name, 'visible' if layer.visible else 'not visible',
                     layer.properties, layer.width, layer.height))
                 if layer_level not in self.world_layers:
                     self.world_layers[layer_level] = WorldLevel(layer_level, self.map.tiles)
-                sprite_layer = tiledtmxloader.helperspygame.get_layer_at_index(idx, self.resources)
+                if headless:
+                    sprite_layer = HeadlessLayer(self.map, layer, layer.properties.get('Metadata', None))
+                else:
+                    sprite_layer = tiledtmxloader.helperspygame.get_layer_at_index(idx, self.resources)
+                    # the avatars update their sprites when they move
+                    sprite_layer.use_sprite_index = True
                 self.world_layers[layer_level].add_layer(idx, layer, sprite_layer)
                 self.all_sprite_layers.append(sprite_layer)
 
+        for world_level in self.world_layers.values():
+            if world_level.metadata_layer:
+                world_level.collision_grid = CollisionGrid(self.map.tiles, world_level.metadata_layer.sprite_layer)
+                world_level.heightfield = Heightfield(self.map.tiles, world_level.metadata_layer.sprite_layer)
+
     def get_avatar_layer(self, layer_level):
         return self.world_layers[layer_level].avatar_layer
 
     def get_metadata_layer(self, layer_level):
         return self.world_layers[layer_level].metadata_layer
 
+    def get_collision_grid(self, layer_level):
+        return self.world_layers[layer_level].collision_grid
+
+    def get_heightfield(self, layer_level):
+        return self.world_layers[layer_level].heightfield
+
+    def update_metadata_tile(self, layer_level, tile_x, tile_y):
+        """
+        Call it after changing a tile of the metadata layer of a level, it
+        updates the collision grid and the heightfield of the level and calls
+        the metadata_listeners.
+        """
+        self.edited_tiles.add((layer_level, tile_x, tile_y))
+        world_level = self.world_layers[layer_level]
+        world_level.collision_grid.update_tile(tile_x, tile_y)
+        world_level.heightfield.update_tile(tile_x, tile_y)
+        for listener in self.metadata_listeners:
+            listener(layer_level, tile_x, tile_y)
+
+    def sample_height(self, xs, ys, layer_level):
+        """
+        Heights at world positions of a level, for a single position or
+        arrays of them (see Heightfield.sample).
+        """
+        return self.world_layers[layer_level].heightfield.sample(xs, ys)
+
     def adjust_layer_level_visibility(self):
         show_layer_level = self.camera_layer_level
         if self.show_layer_level_up:
             show_layer_level += 1
-        for idx, layer in enumerate(self.resources.world_map.layers):
+        for idx, layer in enumerate(self.map.layers):
             if not layer.is_object_group:
                 layer_level = int(layer.properties.get('Level', 0))
                 is_metadata = layer.properties.get('Metadata', None)
@@ -106,6 +803,8 @@ class World():
                     sprite_layer.visible = True
                 else:
                     sprite_layer.visible = False
+        if self.renderer:
+            self.renderer.invalidate()
 
     def set_camera_layer_level(self, new_layer_level):
         if new_layer_level == self.camera_layer_level:
@@ -114,7 +813,10 @@ class World():
         self.adjust_layer_level_visibility()
 
     def set_camera_position(self, pos_x, pos_y, pos_z):
-        self.renderer.set_camera_position(pos_x, pos_y - pos_z)
+        self.camera_position = (pos_x, pos_y)
+        self.camera_z = pos_z
+        if self.renderer:
+            self.renderer.set_camera_position(pos_x, pos_y - pos_z)
         if not self.show_layer_level_up and pos_z >= 1.5 * self.VPIXELS_PER_METER:
             self.show_layer_level_up = True
             self.adjust_layer_level_visibility()
@@ -133,10 +835,17 @@ class World():
 
     def is_walkable(self, pos_x, pos_y, metadata_layer):
         """
-        Just checks if a position in world coordinates is walkable.
+        Just checks if a position in world coordinates is walkable, like the
+        collision of the avatars (see CollisionGrid.is_walkable) and the
+        pathfinding.NavGrid.
         """
         tile_x = int(pos_x // metadata_layer.tilewidth)
         tile_y = int(pos_y // metadata_layer.tileheight)
+        for world_level in self.world_layers.values():
+            collision_grid = world_level.collision_grid
+            if collision_grid and collision_grid.metadata_layer is metadata_layer and \
+               not collision_grid.is_walkable(tile_x, tile_y):
+                return False
         this_sprite = metadata_layer.content2D[tile_y][tile_x]
         if this_sprite is not None:
             this_tile = self.map.tiles[this_sprite.key[0]]
@@ -148,42 +857,391 @@ class World():
         self.avatars.add(avatar)
         if avatar.id:
             self.avatars_dict[avatar.id] = avatar
+        self.avatar_serials.setdefault(avatar, len(self.avatar_serials))
+        self.update_avatar_position(avatar)
+        self.update_avatar_triggers(avatar)
+
+    def get_spatial_hash(self, layer_level):
+        spatial_hash = self.spatial_hashes.get(layer_level, None)
+        if spatial_hash is None:
+            # cells of 2x2 tiles
+            spatial_hash = self.spatial_hashes[layer_level] = SpatialHash(2 * self.map.tilewidth, 2 * self.map.tileheight)
+        return spatial_hash
+
+    def update_avatar_position(self, avatar):
+        """
+        Moves an avatar of the world in the spatial hashes after its position
+        or level changed (see Avatar.execute_move).
+        """
+        if avatar not in self.avatars:
+            return
+        spatial_hash = self.get_spatial_hash(avatar.layer)
+        if avatar not in spatial_hash:
+            for other_hash in self.spatial_hashes.values():
+                other_hash.remove(avatar)
+        spatial_hash.update(avatar, avatar.pos_x, avatar.pos_y)
+
+    def get_trigger_grid(self, layer_level):
+        trigger_grid = self.trigger_grids.get(layer_level, None)
+        if trigger_grid is None:
+            # cells of 2x2 tiles, like the spatial hashes
+            trigger_grid = self.trigger_grids[layer_level] = TriggerGrid(2 * self.map.tilewidth, 2 * self.map.tileheight)
+        return trigger_grid
+
+    def add_trigger(self, trigger):
+        """
+        Adds a trigger, the avatars already in it enter it with their next
+        move.
+        """
+        self.get_trigger_grid(trigger.level).add(trigger)
+
+    def remove_trigger(self, trigger):
+        """
+        Removes a trigger, the avatars in it leave it.
+        """
+        self.get_trigger_grid(trigger.level).remove(trigger)
+        for avatar, triggers in list(self.avatar_triggers.items()):
+            if trigger in triggers:
+                self._set_avatar_triggers(avatar, tuple(other for other in triggers if other is not trigger))
+                for listener in self.trigger_listeners:
+                    listener(avatar, trigger, False)
+
+    def get_triggers_at(self, layer_level, pos_x, pos_y):
+        """
+        :Returns: list of the triggers of a level containing a position.
+        """
+        trigger_grid = self.trigger_grids.get(layer_level, None)
+        if not trigger_grid:
+            return []
+        return trigger_grid.get_triggers_at(pos_x, pos_y)
+
+    def _set_avatar_triggers(self, avatar, triggers):
+        if triggers:
+            self.avatar_triggers[avatar] = triggers
+        else:
+            self.avatar_triggers.pop(avatar, None)
+
+    def update_avatar_triggers(self, avatar):
+        """
+        Raises the events of the triggers an avatar of the world left or
+        entered with its feet after it moved (see Avatar.update_tile): the
+        trigger_listeners are called for the left triggers first, then for
+        the entered ones. Only the triggers of the cell of the avatar are
+        looked at.
+        """
+        if avatar not in self.avatars:
+            return
+        trigger_grid = self.trigger_grids.get(avatar.layer, None)
+        triggers = tuple(trigger_grid.get_triggers_at(avatar.pos_x, avatar.pos_y)) if trigger_grid else ()
+        old_triggers = self.avatar_triggers.get(avatar, ())
+        if triggers == old_triggers:
+            return
+        self._set_avatar_triggers(avatar, triggers)
+        for trigger in old_triggers:
+            if trigger not in triggers:
+                for listener in self.trigger_listeners:
+                    listener(avatar, trigger, False)
+        for trigger in triggers:
+            if trigger not in old_triggers:
+                for listener in self.trigger_listeners:
+                    listener(avatar, trigger, True)
+
+    def get_avatars_in_radius(self, layer_level, pos_x, pos_y, radius):
+        """
+        :Returns: list of the avatars of a level whose feet are at most radius
+                  pixels from a position.
+        """
+        return self.get_spatial_hash(layer_level).query_radius(pos_x, pos_y, radius)
+
+    def get_avatars_in_rect(self, layer_level, rect):
+        """
+        :Returns: list of the avatars of a level whose feet are in a rect
+                  (pygame.Rect or (left, top, width, height)).
+        """
+        left, top, width, height = rect
+        return self.get_spatial_hash(layer_level).query_rect(left, top, left + width, top + height)
+
+    def get_avatar_pairs(self, layer_level):
+        """
+        Broadphase of the avatar collisions: the pairs of avatars of a level
+        near enough in the spatial hash for their feet boxes to overlap.
+        Pairs of avatars of the same Crowd are left to it.
+
+        :Returns: list of (avatar, other avatar), in the order of their
+                  serials.
+        """
+        spatial_hash = self.spatial_hashes.get(layer_level, None)
+        if not spatial_hash:
+            return []
+        serials = self.avatar_serials
+        max_width = max(avatar.rect.width for avatar in spatial_hash.avatar_cells)
+        height = Avatar.COLLISION_HEIGHT
+        pairs = []
+        for avatar in spatial_hash.avatar_cells:
+            serial = serials[avatar]
+            pos_x = avatar.pos_x
+            pos_y = avatar.pos_y
+            for other in spatial_hash.get_avatars_in_cells(pos_x - max_width, pos_y - height,
+                                                           pos_x + max_width, pos_y + height):
+                if serials[other] > serial and abs(other.pos_x - pos_x) < max_width and \
+                   abs(other.pos_y - pos_y) < height and (avatar.crowd is None or avatar.crowd is not other.crowd):
+                    pairs.append((avatar, other))
+        pairs.sort(key=lambda pair: (serials[pair[0]], serials[pair[1]]))
+        return pairs
+
+    def resolve_avatar_collisions(self):
+        """
+        Pushes the avatars whose feet boxes overlap apart, half each (see
+        Avatar.get_push and Avatar.push). The pushes of all pairs are summed
+        first and then done in the order of the serials of the avatars, so
+        the same avatars at the same positions always give the same result.
+
+        :Returns: number of overlapping pairs.
+        """
+        pushes = {}
+        num_overlaps = 0
+        for layer_level in sorted(self.spatial_hashes):
+            for avatar, other in self.get_avatar_pairs(layer_level):
+                push = avatar.get_push(other)
+                if push is None:
+                    continue
+                num_overlaps += 1
+                push_x, push_y = pushes.get(avatar, (0.0, 0.0))
+                pushes[avatar] = (push_x + push[0], push_y + push[1])
+                push_x, push_y = pushes.get(other, (0.0, 0.0))
+                pushes[other] = (push_x - push[0], push_y - push[1])
+        for avatar in sorted(pushes, key=self.avatar_serials.get):
+            avatar.push(self, *pushes[avatar])
+        return num_overlaps
+
+    def begin_tick(self):
+        """
+        Called before each fixed simulation tick, see Avatar.interpolate.
+        """
+        for avatar in self.avatars:
+            avatar.begin_tick()
+
+    def end_tick(self):
+        for avatar in self.avatars:
+            avatar.end_tick()
+
+    def interpolate_avatars(self, alpha):
+        """
+        Places the avatars between the last two ticks for rendering.
+
+        :Parameters:
+            alpha : float
+                time since the last tick as fraction of the tick duration
+        """
+        for avatar in self.avatars:
+            avatar.interpolate(alpha)
 
     # pygame.draw.lines(screen, color, closed, pointlist, thickness)
     # pygame.draw.rect(screen, color, (x,y,width,height), thickness)
     # pygame.draw.circle(screen, color, (x,y), radius, thickness)
     # pygame.draw.arc(screen, color, (x,y,width,height), start_angle, stop_angle, thickness)
 
+    def get_metadata_gid(self, layer_level, tile_x, tile_y):
+        """
+        :Returns: the gid of a tile of the metadata layer of a level, 0 for
+                  none.
+        """
+        sprite = self.get_metadata_layer(layer_level).sprite_layer.content2D[tile_y][tile_x]
+        return sprite.key[0] if sprite is not None and sprite.key else 0
+
+    def set_metadata_gid(self, layer_level, tile_x, tile_y, gid):
+        """
+        Replaces a tile of the metadata layer of a level by the tile gid (0
+        for none), see update_metadata_tile.
+        """
+        metadata_layer = self.get_metadata_layer(layer_level).sprite_layer
+        sprite = None
+        if gid:
+            if self.headless:
+                sprite = metadata_layer.create_tile(self.map, tile_x, tile_y, gid)
+            else:
+                offset_x, offset_y, image = self.resources.indexed_tiles[gid]
+                rect = image.get_rect()
+                rect.topleft = (tile_x * metadata_layer.tilewidth + offset_x, tile_y * metadata_layer.tileheight + offset_y)
+                sprite = tiledtmxloader.helperspygame.SpriteLayer.Sprite(image, rect, key=[gid])
+        metadata_layer.content2D[tile_y][tile_x] = sprite
+        self.update_metadata_tile(layer_level, tile_x, tile_y)
+
+    # snapshots: a header, the avatar records and the tile records
+    SNAPSHOT_MAGIC = b'WSNP'
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_DELTA = 1 << 0
+    SNAPSHOT_CAMERA_POSITION = 1 << 1
+    # magic, version, flags, avatars of the world, avatar records, tile
+    # records, camera layer level (-1 for none), show_layer_level_up and the
+    # camera position
+    SNAPSHOT_HEADER = struct.Struct('<4sHHiiiiB3xddd')
+    SNAPSHOT_AVATAR = numpy.dtype([('serial', '<i4'), ('pos_x', '<f8'), ('pos_y', '<f8'), ('z', '<f8'),
+                                   ('distance', '<f8'), ('layer', '<i4'), ('dir_id', 'u1'), ('move_id', 'u1')])
+    SNAPSHOT_TILE = numpy.dtype([('layer_level', '<i4'), ('tile_x', '<i4'), ('tile_y', '<i4'), ('gid', '<u4')])
+
+    def _get_snapshot_records(self):
+        avatar_records = numpy.array([
+            (serial, avatar.pos_x, avatar.pos_y, avatar.z, avatar.distance, avatar.layer, avatar.dir_id, avatar.move_id)
+            for serial, avatar in enumerate(self.avatar_serials)], self.SNAPSHOT_AVATAR)
+        tile_records = numpy.array([
+            (layer_level, tile_x, tile_y, self.get_metadata_gid(layer_level, tile_x, tile_y))
+            for layer_level, tile_x, tile_y in sorted(self.edited_tiles)], self.SNAPSHOT_TILE)
+        return avatar_records, tile_records
+
+    def _parse_snapshot(self, blob):
+        header = self.SNAPSHOT_HEADER.unpack_from(blob)
+        magic, version, flags, num_avatars, num_avatar_records, num_tile_records = header[:6]
+        if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+            raise ValueError("not a world snapshot of version {}".format(self.SNAPSHOT_VERSION))
+        offset = self.SNAPSHOT_HEADER.size
+        avatar_records = numpy.frombuffer(blob, self.SNAPSHOT_AVATAR, num_avatar_records, offset)
+        offset += avatar_records.nbytes
+        tile_records = numpy.frombuffer(blob, self.SNAPSHOT_TILE, num_tile_records, offset)
+        return header, avatar_records, tile_records
+
+    def snapshot(self, base=None):
+        """
+        Saves the dynamic state of the world, the map and the sprite layers
+        are not in it: the states of the avatars (position, z, layer,
+        direction and animation), the changed metadata tiles (see
+        update_metadata_tile) and the camera. The triggers an avatar is in
+        are found again by restore, they raise no events.
+
+        :Parameters:
+            base : bytes
+                Optional, a full snapshot of the world, only the avatars and
+                tiles changed since it are saved (a delta snapshot for
+                autosaves). Defaults to None (a full snapshot).
+
+        :Returns: the snapshot, bytes.
+        """
+        avatar_records, tile_records = self._get_snapshot_records()
+        flags = 0
+        if base is not None:
+            base_header, base_avatar_records, base_tile_records = self._parse_snapshot(base)
+            if base_header[2] & self.SNAPSHOT_DELTA:
+                raise ValueError("the base of a delta snapshot is a full snapshot")
+            if len(base_avatar_records) != len(avatar_records):
+                raise ValueError("avatars were added since the base snapshot")
+            avatar_records = avatar_records[avatar_records != base_avatar_records]
+            base_tiles = set(base_tile_records.tolist())
+            tile_records = numpy.array([record for record in tile_records.tolist() if record not in base_tiles] +
+                                       [(layer_level, tile_x, tile_y, self.get_metadata_gid(layer_level, tile_x, tile_y))
+                                        for layer_level, tile_x, tile_y, gid in base_tiles
+                                        if (layer_level, tile_x, tile_y) not in self.edited_tiles],
+                                       self.SNAPSHOT_TILE)
+            flags |= self.SNAPSHOT_DELTA
+        camera_x, camera_y = 0.0, 0.0
+        if self.camera_position is not None:
+            camera_x, camera_y = self.camera_position
+            flags |= self.SNAPSHOT_CAMERA_POSITION
+        camera_layer_level = -1 if self.camera_layer_level is None else self.camera_layer_level
+        header = self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, flags,
+                                           len(self.avatar_serials), len(avatar_records), len(tile_records),
+                                           camera_layer_level, self.show_layer_level_up,
+                                           camera_x, camera_y, self.camera_z)
+        return b''.join((header, avatar_records.tobytes(), tile_records.tobytes()))
+
+    def restore(self, blob, base=None):
+        """
+        Restores a snapshot of the world (see snapshot), without loading the
+        map again. The world has the avatars it had at the snapshot, they are
+        matched in the order they were added, avatars are not created or
+        removed.
+
+        :Parameters:
+            blob : bytes
+                the snapshot
+            base : bytes
+                the full snapshot a delta snapshot was made against, it is
+                restored first
+        """
+        header, avatar_records, tile_records = self._parse_snapshot(blob)
+        (magic, version, flags, num_avatars, num_avatar_records, num_tile_records,
+         camera_layer_level, show_layer_level_up, camera_x, camera_y, camera_z) = header
+        if num_avatars != len(self.avatar_serials):
+            raise ValueError("snapshot of {} avatars, the world has {}".format(num_avatars, len(self.avatar_serials)))
+        tiles = {}
+        if flags & self.SNAPSHOT_DELTA:
+            if base is None:
+                raise ValueError("a delta snapshot is restored with its base")
+            base_header, base_avatar_records, base_tile_records = self._parse_snapshot(base)
+            if base_header[2] & self.SNAPSHOT_DELTA or base_header[3] != num_avatars:
+                raise ValueError("not the base of the delta snapshot")
+            base_avatar_records = base_avatar_records.copy()
+            base_avatar_records[avatar_records['serial']] = avatar_records
+            avatar_records = base_avatar_records
+            tiles.update(((layer_level, tile_x, tile_y), gid) for layer_level, tile_x, tile_y, gid in base_tile_records.tolist())
+        tiles.update(((layer_level, tile_x, tile_y), gid) for layer_level, tile_x, tile_y, gid in tile_records.tolist())
+
+        # the tiles changed since the snapshot go back to the map
+        for layer_level, tile_x, tile_y in list(self.edited_tiles):
+            if (layer_level, tile_x, tile_y) not in tiles:
+                map_layer = self.get_metadata_layer(layer_level).layer
+                tiles[(layer_level, tile_x, tile_y)] = map_layer.content2D[tile_x][tile_y]
+        edited_tiles = set()
+        for (layer_level, tile_x, tile_y), gid in sorted(tiles.items()):
+            if gid != self.get_metadata_gid(layer_level, tile_x, tile_y):
+                self.set_metadata_gid(layer_level, tile_x, tile_y, gid)
+            if gid != self.get_metadata_layer(layer_level).layer.content2D[tile_x][tile_y]:
+                edited_tiles.add((layer_level, tile_x, tile_y))
+        self.edited_tiles = edited_tiles
+
+        avatars = list(self.avatar_serials)
+        for serial, pos_x, pos_y, z, distance, layer, dir_id, move_id in avatar_records.tolist():
+            avatars[serial].set_state(self, pos_x, pos_y, z, layer, dir_id, move_id, distance)
+        for avatar in avatars:
+            if avatar in self.avatars:
+                self._set_avatar_triggers(avatar, tuple(self.get_triggers_at(avatar.layer, avatar.pos_x, avatar.pos_y)))
+
+        self.show_layer_level_up = bool(show_layer_level_up)
+        if camera_layer_level >= 0:
+            self.camera_layer_level = camera_layer_level
+            self.adjust_layer_level_visibility()
+        if flags & self.SNAPSHOT_CAMERA_POSITION:
+            self.set_camera_position(camera_x, camera_y, camera_z)
+
     def draw_avatar_boxes(self, screen):
+        """
+        Draws the tile and collision boxes of the avatars (debugging).
+
+        :Returns: list of the rects drawn on the screen.
+        """
         color_red = (255,0,0)
         color_green = (0,255,0)
         color_blue = (0,0,255)
         color_white = (255,255,255)
         color_black = (0,0,0)
 
+        drawn_rects = []
         for avatar in self.avatars:
             avatar_sprite_layer = self.get_avatar_layer(avatar.layer).sprite_layer
             metadata_sprite_layer = self.get_metadata_layer(avatar.layer).sprite_layer
 
-            #pos_x, pos_y = avatar.get_map_pos()
-            #pos_x, pos_y, tile_x, tile_y, sprite, tiles = avatar.get_map_pos_info(self, metadata_sprite_layer)
-            pos_x, pos_y, tile_x, tile_y, tile_avg_height, tile_x_slope, tile_y_slope, sprite, tiles = avatar.get_map_pos_height_info(self, metadata_sprite_layer)
-
-            mx = (pos_x // metadata_sprite_layer.tilewidth) * metadata_sprite_layer.tilewidth
-            my = (pos_y // metadata_sprite_layer.tileheight) * metadata_sprite_layer.tileheight
-            mx, my = self.renderer.world_to_screen(avatar_sprite_layer, mx, my)
-            pygame.draw.rect(screen, color_blue, [mx, my,  metadata_sprite_layer.tilewidth, metadata_sprite_layer.tileheight], 2)
-
-            if not tile_avg_height is None:
-                h_avg = metadata_sprite_layer.tileheight * tile_avg_height
-                h_dx = (metadata_sprite_layer.tileheight * tile_x_slope) / 2.0
-                h_dy = (metadata_sprite_layer.tileheight * tile_y_slope) / 2.0
-                pygame.draw.lines(screen, color_blue, True, [
-                    (mx,                                   my                                     - (h_avg - h_dx - h_dy)),
-                    (mx + metadata_sprite_layer.tilewidth, my                                     - (h_avg + h_dx - h_dy)),
-                    (mx + metadata_sprite_layer.tilewidth, my + metadata_sprite_layer.tileheight  - (h_avg + h_dx + h_dy)),
-                    (mx,                                   my + metadata_sprite_layer.tileheight  - (h_avg - h_dx + h_dy))
-                ], 2)
+            pos_x, pos_y = avatar.get_map_pos()
+            tile_x = int(pos_x // metadata_sprite_layer.tilewidth)
+            tile_y = int(pos_y // metadata_sprite_layer.tileheight)
+
+            left = tile_x * metadata_sprite_layer.tilewidth
+            top = tile_y * metadata_sprite_layer.tileheight
+            mx, my = self.renderer.world_to_screen(avatar_sprite_layer, left, top)
+            drawn_rects.append(pygame.draw.rect(screen, color_blue, [mx, my,  metadata_sprite_layer.tilewidth, metadata_sprite_layer.tileheight], 2))
+
+            if self.get_heightfield(avatar.layer).get_tile_plane(tile_x, tile_y) is not None:
+                # the heights of the corners of the tile, the right and bottom
+                # ones sampled just inside it to stay on its plane
+                right = numpy.nextafter(left + metadata_sprite_layer.tilewidth, left)
+                bottom = numpy.nextafter(top + metadata_sprite_layer.tileheight, top)
+                heights = self.sample_height([left, right, right, left], [top, top, bottom, bottom], avatar.layer)
+                drawn_rects.append(pygame.draw.lines(screen, color_blue, True, [
+                    (mx,                                   my                                     - heights[0]),
+                    (mx + metadata_sprite_layer.tilewidth, my                                     - heights[1]),
+                    (mx + metadata_sprite_layer.tilewidth, my + metadata_sprite_layer.tileheight  - heights[2]),
+                    (mx,                                   my + metadata_sprite_layer.tileheight  - heights[3])
+                ], 2))
 
             px, py = self.renderer.world_to_screen(avatar_sprite_layer, avatar.rect.x, avatar.rect.y)
-            pygame.draw.rect(screen, color_red, [px, py, avatar.rect.width, avatar.rect.height], 2)
+            drawn_rects.append(pygame.draw.rect(screen, color_red, [px, py, avatar.rect.width, avatar.rect.height], 2))
+
+        return drawn_rects